@@ -0,0 +1,65 @@
+"""
+Closure suite of bench.run: blast radius / reachable-from-set queries on chains of tiers,
+the recursion depth grows with the number of pods (PER_TIER pods per hop)
+    python -m bench.run --suite closure --grid deep --engines kubesv,python
+Phases: parse, <engine>.build, <engine>.blast_radius, <engine>.can_reach, <engine>.reachable_from_set
+"""
+from typing import *
+
+import kubesv.kubesv.postprocess as ksv
+from kubesv.kubesv.snapshot import ClusterSnapshot
+
+from .harness import Trial
+
+PER_TIER = 10
+
+# engine name -> get_fixpoint_engine options
+ENGINES: Dict[str, Dict[str, Any]] = {
+    "kubesv": {"engine": "datalog"},
+    "python": {"engine": "python"},
+}
+
+
+def tier_manifests(n_tiers: int, per_tier: int = PER_TIER) -> List[dict]:
+    """
+    pods of tier i only talk to tier i + 1: paths are chains of n_tiers - 1 hops
+    """
+    tier = lambda t: {"matchLabels": {"tier": str(t)}}
+    return (
+        [{"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": "default"}}] +
+        [{"apiVersion": "v1", "kind": "Pod", "metadata": {
+            "name": "pod-{}-{}".format(t, i), "namespace": "default", "labels": {"tier": str(t)}}}
+            for t in range(n_tiers) for i in range(per_tier)] +
+        [{"apiVersion": "networking.k8s.io/v1", "kind": "NetworkPolicy", "metadata": {
+            "name": "tier-{}".format(t), "namespace": "default"}, "spec": {
+            "podSelector": tier(t),
+            "policyTypes": ["Ingress", "Egress"],
+            "ingress": [{"from": [{"podSelector": tier(t - 1)}]}],
+            "egress": [{"to": [{"podSelector": tier(t + 1)}]}]}}
+            for t in range(n_tiers)])
+
+
+def scale(n_pods: int) -> Dict[str, Any]:
+    return {"suite": "closure", "pods": n_pods, "per_tier": PER_TIER}
+
+
+def closure(manifests: List[dict], engines: Sequence[str]) -> Callable[[Trial], None]:
+    def run(trial: Trial):
+        with trial.phase("parse"):
+            snapshot = ClusterSnapshot.from_objects(manifests)
+        n_pods = len(snapshot.pods)
+
+        for engine in engines:
+            with trial.phase(engine + ".build"):
+                gi = snapshot.build(check_self_ingress_traffic=False, **ENGINES[engine])
+            with trial.phase(engine + ".blast_radius"):
+                _, reached = ksv.blast_radius(gi, 0)
+            with trial.phase(engine + ".can_reach"):
+                _, reaching = ksv.can_reach(gi, [n_pods - 1])
+            with trial.phase(engine + ".reachable_from_set"):
+                ksv.reachable_from(gi, range(0, n_pods, max(1, n_pods // 10)))
+
+            # the chain reaches every later tier
+            assert len(reached) == n_pods - PER_TIER, (engine, len(reached))
+            assert len(reaching) == n_pods - PER_TIER, (engine, len(reaching))
+    return run
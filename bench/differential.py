@@ -0,0 +1,355 @@
+"""
+Differential check of kano, kubesv and their optimized variants on generated clusters
+    python -m bench.differential --pods 20,50,100 --seeds 3 --out diff.json --repro-dir repro/
+Clusters have a namespace per --pods-per-namespace pods (at least two from 10 pods by default),
+so peers and selectors that cross namespaces are compared too.
+Every variant answers every check on the same snapshot, a result that differs from the reference
+(or an exception) is a mismatch, reported with its timings and a minimized reproducing cluster:
+the manifests are shrunk (ddmin over pods and policies, then unused namespaces) while the mismatch persists.
+A variant is compared against the first variant of its family (its unoptimized reference),
+the family references against the first variant, on pod checks only: kano splits policies into
+ingress/egress ones and checks shadow/conflict per pod, its policy pairs are not kubesv's
+(see the FIXME of kano.algorithm.policy_shadow).
+Exit status 1 if a mismatch was found
+"""
+import argparse
+import json
+import os
+import sys
+from time import perf_counter
+from typing import *
+
+import yaml
+import z3
+
+from kano_py.kano.model import ReachabilityMatrix
+from kano_py.kano.parser import ConfigParser
+from kano_py.tests.generate import ClusterGenerator
+from kubesv.kubesv.postprocess import QuerySession
+from kubesv.kubesv.runner import run_checks
+from kubesv.kubesv.snapshot import ClusterSnapshot
+
+from .run import FLAGS, KANO_CHECKS, KUBESV_CHECKS
+
+POD_CHECKS = ["all_reachable", "all_isolated", "user_crosscheck", "system_isolation"]
+POLICY_CHECKS = ["policy_shadow", "policy_conflict"]
+CHECKS = POD_CHECKS + POLICY_CHECKS
+
+# results and seconds per check ("build" included)
+Outcome = Tuple[Dict[str, Any], Dict[str, float]]
+
+
+class Variant(NamedTuple):
+    """
+    run(snapshot, checks) -> ({check: result or exception}, {phase: seconds})
+    family: compared against the first variant of the family, policy checks never leave the family
+    """
+    name: str
+    family: str
+    run: Callable[[ClusterSnapshot, Sequence[str]], Outcome]
+
+
+def normalize(result: Any) -> FrozenSet[Any]:
+    # (sat, answers) of kubesv, collections of kano; pairs as tuples
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], z3.CheckSatResult):
+        result = result[1]
+    return frozenset(tuple(item) if isinstance(item, list) else item for item in result)
+
+
+def timed(checks: Sequence[str], prepare: Callable[[], Any], answer: Callable[[Any, str], Any]) -> Outcome:
+    """
+    prepare() once, then answer(prepared, check) per check; exceptions are results
+    """
+    results, timings = {}, {}
+    start = perf_counter()
+    try:
+        prepared = prepare()
+    except Exception as e:
+        return {check: e for check in checks}, {"build": perf_counter() - start}
+    timings["build"] = perf_counter() - start
+
+    for check in checks:
+        start = perf_counter()
+        try:
+            results[check] = normalize(answer(prepared, check))
+        except Exception as e:
+            results[check] = e
+        timings[check] = perf_counter() - start
+    return results, timings
+
+
+def kano_variant(**options) -> Callable[[ClusterSnapshot, Sequence[str]], Outcome]:
+    algorithms = dict(KANO_CHECKS)
+
+    def run(snapshot: ClusterSnapshot, checks: Sequence[str]) -> Outcome:
+        def prepare():
+            parser = ConfigParser()
+            containers, policies = parser.load_snapshot(snapshot)
+            matrix = ReachabilityMatrix.build_matrix(containers, policies,
+                namespaces=parser.namespaces, **dict(FLAGS, **options))
+            return matrix, containers, policies
+        return timed(checks, prepare, lambda prepared, check: algorithms[check](*prepared))
+    return run
+
+
+def kubesv_variant(**options) -> Callable[[ClusterSnapshot, Sequence[str]], Outcome]:
+    queries = dict(KUBESV_CHECKS)
+
+    def run(snapshot: ClusterSnapshot, checks: Sequence[str]) -> Outcome:
+        # checks add relations to gi: one build per check, the build time is the first one
+        results, timings = {}, {}
+        for check in checks:
+            result, timing = timed([check], lambda: snapshot.build(**dict(FLAGS, **options)),
+                lambda gi, check: queries[check](gi))
+            results.update(result)
+            timings.setdefault("build", timing.pop("build"))
+            timings.update(timing)
+        return results, timings
+    return run
+
+
+def session_variant(**options) -> Callable[[ClusterSnapshot, Sequence[str]], Outcome]:
+    # pod checks answered from the cached edge relation
+    queries = {
+        "all_reachable": lambda session: session.all_reach_isolate()[0],
+        "all_isolated": lambda session: session.all_reach_isolate()[1],
+        "user_crosscheck": lambda session: session.user_crosscheck("User"),
+        "system_isolation": lambda session: session.system_isolation(0),
+        "policy_shadow": QuerySession.policy_shadow,
+        "policy_conflict": QuerySession.policy_conflict,
+    }
+
+    def run(snapshot: ClusterSnapshot, checks: Sequence[str]) -> Outcome:
+        return timed(checks, lambda: QuerySession(snapshot.build(**dict(FLAGS, **options))),
+            lambda session, check: queries[check](session))
+    return run
+
+
+def parallel_variant(**options) -> Callable[[ClusterSnapshot, Sequence[str]], Outcome]:
+    calls = {check: (check,) for check in CHECKS}
+    calls["user_crosscheck"] = ("user_crosscheck", "User")
+    calls["system_isolation"] = ("system_isolation", 0)
+
+    def run(snapshot: ClusterSnapshot, checks: Sequence[str]) -> Outcome:
+        # one program image, the checks run in a process pool (timed together)
+        def prepare():
+            return run_checks(snapshot.build(**dict(FLAGS, **options)), [calls[check] for check in checks])
+        return timed(checks, prepare, lambda answers, check: answers[calls[check]])
+    return run
+
+
+VARIANTS: List[Variant] = [
+    Variant("kano", "kano", kano_variant(build_transpose_matrix=True)),
+    Variant("kano.rows", "kano", kano_variant(build_transpose_matrix=False)),
+    Variant("kubesv", "kubesv", kubesv_variant(ground_default_pod=True)),
+    Variant("kubesv.negation", "kubesv", kubesv_variant(ground_default_pod=False)),
+    Variant("kubesv.precomputed", "kubesv", kubesv_variant(ground_default_pod=True, precompute_selection=True)),
+    Variant("kubesv.finite_domain", "kubesv", kubesv_variant(ground_default_pod=True, finite_domain=True)),
+    Variant("kubesv.python", "kubesv", kubesv_variant(ground_default_pod=True, engine="python")),
+    Variant("kubesv.session", "kubesv", session_variant(ground_default_pod=True)),
+    Variant("kubesv.parallel", "kubesv", parallel_variant(ground_default_pod=True)),
+]
+
+
+def reference_of(variants: Sequence[Variant], variant: Variant, check: str) -> Optional[Variant]:
+    family = next(v for v in variants if v.family == variant.family)
+    if family is not variant:
+        return family
+    if check in POD_CHECKS and variant is not variants[0]:
+        return variants[0]
+    return None
+
+
+def disagree(expected: Any, actual: Any) -> bool:
+    if isinstance(expected, Exception) or isinstance(actual, Exception):
+        return type(expected) is not type(actual)
+    return expected != actual
+
+
+class Mismatch(NamedTuple):
+    """
+    missing: in the reference answer only, extra: in the variant answer only
+    manifests: the minimized cluster, both answers are recomputed on it
+    """
+    check: str
+    variant: str
+    reference: str
+    scale: Dict[str, Any]
+    expected: Any
+    actual: Any
+    manifests: List[dict]
+    timings: Dict[str, float]
+
+    @property
+    def missing(self) -> FrozenSet[Any]:
+        if isinstance(self.expected, Exception) or isinstance(self.actual, Exception):
+            return frozenset()
+        return self.expected - self.actual
+
+    @property
+    def extra(self) -> FrozenSet[Any]:
+        if isinstance(self.expected, Exception) or isinstance(self.actual, Exception):
+            return frozenset()
+        return self.actual - self.expected
+
+    def to_dict(self) -> Dict[str, Any]:
+        def show(answer):
+            return repr(answer) if isinstance(answer, Exception) else sorted(answer, key=repr)
+        return {
+            "check": self.check,
+            "variant": self.variant,
+            "reference": self.reference,
+            "scale": self.scale,
+            "expected": show(self.expected),
+            "actual": show(self.actual),
+            "missing": sorted(self.missing, key=repr),
+            "extra": sorted(self.extra, key=repr),
+            "manifests": self.manifests,
+            "timings": self.timings,
+        }
+
+    def __str__(self) -> str:
+        if isinstance(self.expected, Exception) or isinstance(self.actual, Exception):
+            detail = "{!r} vs {!r}".format(self.expected, self.actual)
+        else:
+            detail = "missing {} extra {}".format(sorted(self.missing, key=repr), sorted(self.extra, key=repr))
+        return "{} {} vs {} ({} objects): {}".format(
+            self.check, self.variant, self.reference, len(self.manifests), detail)
+
+
+def compare(snapshot: ClusterSnapshot, variant: Variant, reference: Variant, check: str) -> Optional[Tuple[Any, Any]]:
+    """
+    (expected, actual) if the two variants disagree on check, None otherwise (or when the reference fails)
+    """
+    expected = reference.run(snapshot, [check])[0][check]
+    if isinstance(expected, Exception):
+        return None
+    actual = variant.run(snapshot, [check])[0][check]
+    return (expected, actual) if disagree(expected, actual) else None
+
+
+def minimize(manifests: List[dict], reproduces: Callable[[List[dict]], bool], max_tests=500) -> List[dict]:
+    """
+    ddmin over the pods and policies (namespaces are kept), then drop the namespaces one by one
+    reproduces(manifests) must hold for the given manifests, at most max_tests calls
+    """
+    tests = 0
+
+    def test(candidate: List[dict]) -> bool:
+        nonlocal tests
+        tests += 1
+        return reproduces(candidate)
+
+    namespaces = [m for m in manifests if m["kind"] == "Namespace"]
+    objects = [m for m in manifests if m["kind"] != "Namespace"]
+    n = 2
+    while len(objects) >= 2 and tests < max_tests:
+        size = -(-len(objects) // n)
+        for start in range(0, len(objects), size):
+            candidate = objects[:start] + objects[start + size:]
+            if tests < max_tests and test(namespaces + candidate):
+                objects, n = candidate, max(n - 1, 2)
+                break
+        else:
+            if n >= len(objects):
+                break
+            n = min(n * 2, len(objects))
+
+    for namespace in list(namespaces):
+        if tests >= max_tests:
+            break
+        candidate = [m for m in namespaces if m is not namespace]
+        if test(candidate + objects):
+            namespaces = candidate
+    return namespaces + objects
+
+
+def differential(manifests: List[dict], scale: Dict[str, Any], variants: Sequence[Variant],
+        checks: Sequence[str] = CHECKS, max_tests=500) -> Tuple[List[Mismatch], Dict[str, Dict[str, float]]]:
+    """
+    Mismatches of the variants against their references and the timings of every variant
+    """
+    snapshot = ClusterSnapshot.from_objects(manifests)
+    outcomes = {variant.name: variant.run(snapshot, checks) for variant in variants}
+
+    mismatches = []
+    for variant in variants:
+        results, timings = outcomes[variant.name]
+        for check in checks:
+            reference = reference_of(variants, variant, check)
+            if reference is None:
+                continue
+            expected = outcomes[reference.name][0][check]
+            if isinstance(expected, Exception) or not disagree(expected, results[check]):
+                continue
+
+            def reproduces(candidate: List[dict]) -> bool:
+                if not any(m["kind"] == "Pod" for m in candidate):
+                    return False
+                return compare(ClusterSnapshot.from_objects(candidate), variant, reference, check) is not None
+
+            reduced = minimize(manifests, reproduces, max_tests)
+            expected, actual = compare(ClusterSnapshot.from_objects(reduced), variant, reference, check)
+            mismatches.append(Mismatch(check, variant.name, reference.name, scale,
+                expected, actual, reduced, {check: timings[check]}))
+    return mismatches, {name: timings for name, (_, timings) in outcomes.items()}
+
+
+def write_repro(directory: str, index: int, mismatch: Mismatch):
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, "{:03d}-{}-{}.yaml".format(index, mismatch.check, mismatch.variant))
+    with open(filename, "w") as f:
+        f.write("# {}\n".format(mismatch))
+        yaml.safe_dump_all(mismatch.manifests, f, default_flow_style=False, sort_keys=False)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pods", type=lambda s: [int(n) for n in s.split(",")], default=[10, 20, 50, 100],
+        help="comma separated pod counts, increasing")
+    parser.add_argument("--seeds", type=int, default=3, help="clusters per size (seeds 0..seeds-1)")
+    parser.add_argument("--pods-per-namespace", type=int, default=5)
+    parser.add_argument("--variants", type=lambda s: s.split(","),
+        default=[variant.name for variant in VARIANTS if variant.name != "kubesv.parallel"],
+        help="comma separated, the first one is the reference: {}".format(", ".join(v.name for v in VARIANTS)))
+    parser.add_argument("--checks", type=lambda s: s.split(","), default=CHECKS)
+    parser.add_argument("--max-tests", type=int, default=500, help="check runs per minimization")
+    parser.add_argument("--out", help="write the mismatches and timings as JSON")
+    parser.add_argument("--repro-dir", help="write each minimized cluster as yaml")
+    args = parser.parse_args(argv)
+
+    by_name = {variant.name: variant for variant in VARIANTS}
+    unknown = [name for name in args.variants if name not in by_name]
+    if unknown:
+        parser.error("unknown variants: {}".format(", ".join(unknown)))
+    variants = [by_name[name] for name in args.variants]
+
+    mismatches, runs = [], []
+    for n_pods in args.pods:
+        for seed in range(args.seeds):
+            scale = {"pods": n_pods, "policies": n_pods // 2,
+                "namespaces": max(1, n_pods // args.pods_per_namespace), "seed": seed}
+            manifests = ClusterGenerator(seed=seed, pods=scale["pods"], policies=scale["policies"],
+                namespaces=scale["namespaces"]).manifests()
+            found, timings = differential(manifests, scale, variants, args.checks, args.max_tests)
+            mismatches.extend(found)
+            runs.append({"scale": scale, "timings": timings, "mismatches": len(found)})
+
+            print("pods={pods} seed={seed}: {} mismatches".format(len(found), **scale))
+            for name, timing in timings.items():
+                print("  {:<22} {}".format(name, "  ".join("{} {:.4f}s".format(k, v) for k, v in timing.items())))
+            for mismatch in found:
+                print("  MISMATCH", mismatch)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"runs": runs, "mismatches": [m.to_dict() for m in mismatches]}, f, indent=2, default=str)
+            f.write("\n")
+    if args.repro_dir:
+        for i, mismatch in enumerate(mismatches):
+            write_repro(args.repro_dir, i, mismatch)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
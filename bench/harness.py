@@ -0,0 +1,157 @@
+"""
+Benchmark harness: named phases timed over repeated trials (after warmup runs),
+results written as JSON and compared against a stored baseline
+With memory=True one more run measures the memory of each phase (kubesv.metrics.measure_memory),
+apart from the timed trials: tracemalloc would slow them down
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from contextlib import contextmanager
+from time import perf_counter
+from typing import *
+
+from kubesv.kubesv import metrics
+
+
+class Trial:
+    """
+    Phase durations (and memory, when profiling) of one run, a phase entered twice accumulates
+        with trial.phase("kubesv.build"):
+            ...
+    """
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.memory: Dict[str, Dict[str, int]] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        memory = {}
+        start = perf_counter()
+        try:
+            with metrics.measure_memory(memory):
+                yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + perf_counter() - start
+            if memory:
+                # peaks of the largest pass, retained memory of all passes
+                before = self.memory.setdefault(name, {})
+                for key, value in memory.items():
+                    before[key] = max(before.get(key, value), value) if key.endswith("_peak") else before.get(key, 0) + value
+
+
+def summarize(times: List[float]) -> Dict[str, Any]:
+    return {
+        "times": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+def run_trials(run: Callable[[Trial], None], trials=5, warmup=1, memory=False) -> Dict[str, Dict[str, Any]]:
+    """
+    run(trial) times its phases on the given Trial, warmup runs are discarded
+    Phases are reported in the order of the first trial
+    memory: one more (untimed) run under metrics.profile_memory, its bytes per phase as summary["memory"]
+    """
+    for _ in range(warmup):
+        run(Trial())
+
+    samples: Dict[str, List[float]] = {}
+    for _ in range(trials):
+        trial = Trial()
+        run(trial)
+        for name, duration in trial.phases.items():
+            samples.setdefault(name, []).append(duration)
+    summaries = {name: summarize(times) for name, times in samples.items()}
+
+    if memory:
+        trial = Trial()
+        with metrics.profile_memory():
+            run(trial)
+        for name, usage in trial.memory.items():
+            if name in summaries:
+                summaries[name]["memory"] = usage
+    return summaries
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict[str, Any]:
+    import bitarray
+    import z3
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "z3": z3.get_version_string(),
+        "bitarray": bitarray.__version__,
+    }
+
+
+def scale_key(scale: Dict[str, Any]) -> str:
+    return json.dumps(scale, sort_keys=True)
+
+
+def write_results(path: str, results: List[Dict[str, Any]], meta: Dict[str, Any]):
+    """
+    {"meta": {...}, "results": [{"scale": {...}, "phases": {name: summary}}, ...]}
+    """
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+        f.write("\n")
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+class Regression(NamedTuple):
+    scale: Dict[str, Any]
+    phase: str
+    baseline: float
+    current: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline if self.baseline else float("inf")
+
+    def __str__(self) -> str:
+        return "{} {}: {:.4f}s -> {:.4f}s (x{:.2f})".format(
+            scale_key(self.scale), self.phase, self.baseline, self.current, self.ratio)
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], threshold=0.2, min_delta=0.005) -> List[Regression]:
+    """
+    Phases whose median got slower than the baseline median by more than threshold (relative)
+    and min_delta seconds (absolute, below that it is timer noise)
+    Scales and phases missing from the baseline are skipped
+    """
+    base = {scale_key(entry["scale"]): entry["phases"] for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        phases = base.get(scale_key(entry["scale"]))
+        if phases is None:
+            continue
+        for name, summary in entry["phases"].items():
+            if name not in phases:
+                continue
+            before, after = phases[name]["median"], summary["median"]
+            if after > before * (1 + threshold) and after - before > min_delta:
+                regressions.append(Regression(entry["scale"], name, before, after))
+    return regressions
@@ -0,0 +1,206 @@
+"""
+Kano / kubesv benchmark over a grid of generated clusters
+    python -m bench.run --grid default --trials 5 --out bench_results.json --baseline bench/baseline.json
+--generator synthetic builds the clusters in memory (ClusterGenerator: Zipf labels, namespaces,
+matchExpressions, replica groups), parse is then the snapshot compilation of the manifests
+Phases: parse, kano.build, kano.<check>, kubesv.build, kubesv.<check>
+--events also writes the finer kubesv.metrics events (encode/solve/decode, counts, z3 statistics)
+--memory adds the peak/retained bytes of each phase (python objects and process RSS), from one
+extra profiled run after the timed trials
+--suite closure runs the recursive reachability queries on chains of tiers instead (bench/closure.py)
+Exit status 1 if a phase regressed against the baseline
+"""
+import argparse
+import json
+import random
+import sys
+import tempfile
+from typing import *
+
+import kano_py.kano.algorithm as kano
+import kubesv.kubesv.postprocess as ksv
+from kano_py.kano.model import ReachabilityMatrix
+from kano_py.kano.parser import ConfigParser
+from kano_py.tests.generate import ConfigFiles, ClusterGenerator
+from kubesv.kubesv import metrics
+from kubesv.kubesv.snapshot import ClusterSnapshot
+
+from . import closure
+from .harness import Trial, run_trials, environment, write_results, load_results, compare
+
+
+def scale(n_pods: int) -> Dict[str, int]:
+    # the proportions test.py used
+    return {
+        "podN": n_pods,
+        "policyN": n_pods // 2,
+        "keyL": max(1, n_pods // 10),
+        "userL": 5,
+        "selectedLL": 3,
+        "allowpodLL": 3,
+    }
+
+
+GRIDS: Dict[str, List[int]] = {
+    "smoke": [50, 100],
+    "default": list(range(100, 1100, 100)),
+    "large": [2000, 5000],
+    "production": [10000, 100000],
+    # closure suite: 50 to 400 tiers deep
+    "deep": [500, 1000, 2000, 4000],
+}
+
+# --engines default of each suite
+SUITE_ENGINES = {
+    "audit": "kano,kubesv",
+    "closure": "kubesv,python",
+}
+
+# same configuration on both sides
+FLAGS = {
+    "check_self_ingress_traffic": True,
+    "check_select_by_no_policy": True,
+}
+
+KANO_CHECKS: List[Tuple[str, Callable]] = [
+    ("all_reachable", lambda matrix, containers, policies: kano.all_reachable(matrix)),
+    ("all_isolated", lambda matrix, containers, policies: kano.all_isolated(matrix)),
+    ("user_crosscheck", lambda matrix, containers, policies: kano.user_crosscheck(matrix, containers, "User")),
+    ("system_isolation", lambda matrix, containers, policies: kano.system_isolation(matrix, 0)),
+    ("policy_shadow", lambda matrix, containers, policies: kano.policy_shadow(matrix, policies, containers)),
+    ("policy_conflict", lambda matrix, containers, policies: kano.policy_conflict(matrix, policies, containers)),
+]
+
+KUBESV_CHECKS: List[Tuple[str, Callable]] = [
+    ("all_reachable", ksv.all_reachable_native),
+    ("all_isolated", ksv.all_isolated_native),
+    ("user_crosscheck", lambda gi: ksv.user_crosscheck(gi, "User")),
+    ("system_isolation", lambda gi: ksv.system_isolation(gi, 0)),
+    ("policy_shadow", ksv.policy_shadow),
+    ("policy_conflict", ksv.policy_conflict),
+]
+
+
+def generate(directory: str, params: Dict[str, int], seed: int):
+    # ConfigFiles draws from the global random
+    random.seed(seed)
+    ConfigFiles(directory, **params).generateConfigFiles()
+
+
+def synthetic(params: Dict[str, int], seed: int) -> ClusterGenerator:
+    return ClusterGenerator(seed=seed, pods=params["podN"], policies=params["policyN"],
+        namespaces=max(1, params["podN"] // 100), users=params["userL"])
+
+
+def audit(parse: Callable[[], ClusterSnapshot], engines: Sequence[str]) -> Callable[[Trial], None]:
+    def run(trial: Trial):
+        with trial.phase("parse"):
+            snapshot = parse()
+
+        if "kano" in engines:
+            with trial.phase("kano.build"):
+                parser = ConfigParser()
+                containers, policies = parser.load_snapshot(snapshot)
+                matrix = ReachabilityMatrix.build_matrix(containers, policies,
+                    build_transpose_matrix=True, namespaces=parser.namespaces, **FLAGS)
+            for name, check in KANO_CHECKS:
+                with trial.phase("kano." + name):
+                    check(matrix, containers, policies)
+
+        if "kubesv" in engines:
+            # checks add relations to gi: a fresh build per trial
+            with trial.phase("kubesv.build"):
+                gi = snapshot.build(ground_default_pod=True, **FLAGS)
+            for name, check in KUBESV_CHECKS:
+                with trial.phase("kubesv." + name):
+                    check(gi)
+    return run
+
+
+def with_events(run: Callable[[Trial], None], stream: TextIO, params: Dict[str, int]) -> Callable[[Trial], None]:
+    # events carry the scale, the sink costs a little time, every trial pays it alike
+    def write(event: metrics.Event):
+        stream.write(json.dumps(dict(event.to_dict(), scale=params), default=str))
+        stream.write("\n")
+
+    def run_with_events(trial: Trial):
+        metrics.add_sink(write)
+        try:
+            run(trial)
+        finally:
+            metrics.remove_sink(write)
+    return run_with_events
+
+
+def megabytes(n: int) -> str:
+    return "{:.1f}MB".format(n / 2 ** 20)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid", choices=sorted(GRIDS), default="smoke")
+    parser.add_argument("--pods", type=lambda s: [int(n) for n in s.split(",")],
+        help="comma separated pod counts, overrides --grid")
+    parser.add_argument("--suite", choices=sorted(SUITE_ENGINES), default="audit")
+    parser.add_argument("--engines", help="comma separated, kano,kubesv (audit) or kubesv,python (closure)")
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--generator", choices=["files", "synthetic"], default="files")
+    parser.add_argument("--out", help="write the results as JSON")
+    parser.add_argument("--events", help="write the metrics events of every run (warmups included) as JSON lines")
+    parser.add_argument("--memory", action="store_true", help="profile the memory of each phase (one extra run)")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown flagged as a regression")
+    parser.add_argument("--min-delta", type=float, default=0.005, help="absolute slowdown (s) below which timings are noise")
+    args = parser.parse_args(argv)
+
+    engines = (args.engines or SUITE_ENGINES[args.suite]).split(",")
+    events = open(args.events, "w") if args.events else None
+    results = []
+    for n_pods in args.pods or GRIDS[args.grid]:
+        params = scale(n_pods) if args.suite == "audit" else closure.scale(n_pods)
+        with tempfile.TemporaryDirectory() as directory:
+            if args.suite == "closure":
+                run = closure.closure(closure.tier_manifests(n_pods // closure.PER_TIER), engines)
+            elif args.generator == "synthetic":
+                manifests = synthetic(params, args.seed).manifests()
+                run = audit(lambda: ClusterSnapshot.from_objects(manifests), engines)
+            else:
+                generate(directory, params, args.seed)
+                run = audit(lambda: ClusterSnapshot.from_directory(directory), engines)
+            if events is not None:
+                run = with_events(run, events, params)
+            phases = run_trials(run, trials=args.trials, warmup=args.warmup, memory=args.memory)
+        key = dict(params, seed=args.seed) if args.suite == "audit" else params
+        if args.suite == "audit" and args.generator != "files":
+            key["generator"] = args.generator
+        results.append({"scale": key, "phases": phases})
+
+        print("pods={}".format(n_pods))
+        for name, summary in phases.items():
+            line = "  {:<26} median {:.4f}s  min {:.4f}s  stdev {:.4f}s".format(
+                name, summary["median"], summary["min"], summary["stdev"])
+            if "memory" in summary:
+                line += "  " + "  ".join("{} {}".format(key, megabytes(value)) for key, value in summary["memory"].items())
+            print(line)
+
+    if events is not None:
+        events.close()
+
+    meta = dict(environment(), trials=args.trials, warmup=args.warmup, engines=engines, memory=args.memory)
+    if args.out:
+        write_results(args.out, results, meta)
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline), args.threshold, args.min_delta)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+        print("no regression against {}".format(args.baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
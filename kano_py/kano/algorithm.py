@@ -1,6 +1,8 @@
 from .model import *
+from .model import metrics
 
 
+@metrics.instrument("kano.all_reachable")
 def all_reachable(matrix: ReachabilityMatrix) -> List[int]:
     all_reachables = set()
     for i in range(matrix.container_size):
@@ -9,6 +11,7 @@ def all_reachable(matrix: ReachabilityMatrix) -> List[int]:
     return all_reachables
 
 
+@metrics.instrument("kano.all_isolated")
 def all_isolated(matrix: ReachabilityMatrix) -> List[int]:
     all_isolated = set()
     for i in range(matrix.container_size):
@@ -24,6 +27,7 @@ def user_hashmap(containers: List[Container], label: str) -> Dict[str, bitarray]
     return user_map
 
 
+@metrics.instrument("kano.user_crosscheck")
 def user_crosscheck(
         matrix: ReachabilityMatrix, 
         containers: List[Container],
@@ -42,6 +46,7 @@ def user_crosscheck(
     return user_crosslist
 
 
+@metrics.instrument("kano.system_isolation")
 def system_isolation(matrix: ReachabilityMatrix, idx: int) -> List[int]:
     """
     System isolation. 
@@ -55,6 +60,7 @@ def system_isolation(matrix: ReachabilityMatrix, idx: int) -> List[int]:
     return isolations
 
 
+@metrics.instrument("kano.policy_shadow")
 def policy_shadow(matrix: ReachabilityMatrix, policies: List[Policy], containers: List[Container]) -> List[Tuple[int, int]]:
     """
     Policy shadow. 
@@ -81,6 +87,7 @@ def policy_shadow(matrix: ReachabilityMatrix, policies: List[Policy], containers
     return pols
 
 
+@metrics.instrument("kano.policy_conflict")
 def policy_conflict(matrix: ReachabilityMatrix, policies: List[Policy], containers: List[Container]) -> List[Tuple[int, int]]:
     """
     Policy conflict. 
@@ -1,44 +1,349 @@
 """
 Kubernetes configuration files models
 """
-from kubesv.kubesv.constraint import build
+try:
+    from kubesv.kubesv.constraint import build
+    from kubesv.kubesv import metrics
+except ImportError:
+    # kubesv is the package itself (its own tests, or installed)
+    from kubesv.constraint import build
+    from kubesv import metrics
 from typing import *
 from typing_extensions import *
 from dataclasses import dataclass, field
+from collections.abc import Mapping as AbstractMapping
+from array import array
 from bitarray import bitarray
+from bitarray.util import zeros, ones
+from bisect import bisect_right
 from abc import abstractmethod
+from contextvars import ContextVar
+
+
+class LabelTable:
+    """
+    Shared, interned label storage
+    Every label key and value is stored once and referred to by an integer id.
+    Label sets are hash-consed: containers (and selectors) with the same labels share one LabelSet.
+    Models intern into the table of the innermost `with table:` block, see label_table()
+    """
+
+    def __init__(self):
+        self.key_ids: Dict[str, int] = {}
+        self.value_ids: Dict[str, int] = {}
+        self.keys: List[str] = []
+        self.values: List[str] = []
+        self.label_sets: Dict[bytes, "LabelSet"] = {}
+        self.tokens = []
+
+    def __enter__(self) -> "LabelTable":
+        self.tokens.append(CURRENT_LABEL_TABLE.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        CURRENT_LABEL_TABLE.reset(self.tokens.pop())
+
+    def key_id(self, key: str) -> int:
+        kid = self.key_ids.get(key)
+        if kid is None:
+            kid = len(self.keys)
+            self.key_ids[key] = kid
+            self.keys.append(key)
+        return kid
+
+    def value_id(self, value: str) -> int:
+        vid = self.value_ids.get(value)
+        if vid is None:
+            vid = len(self.values)
+            self.value_ids[value] = vid
+            self.values.append(value)
+        return vid
+
+    def find_key(self, key: str) -> int:
+        # -1 if the key is never seen, so no label set can contain it
+        return self.key_ids.get(key, -1)
+
+    def find_value(self, value: str) -> int:
+        return self.value_ids.get(value, -1)
+
+    def intern(self, labels: Optional[Mapping[str, str]]) -> Optional["LabelSet"]:
+        if labels is None:
+            return None
+        if isinstance(labels, LabelSet) and labels.table is self:
+            return labels
+
+        ids = array('i')
+        for kid, vid in sorted((self.key_id(k), self.value_id(v)) for k, v in labels.items()):
+            ids.append(kid)
+            ids.append(vid)
+
+        encoded = ids.tobytes()
+        label_set = self.label_sets.get(encoded)
+        if label_set is None:
+            label_set = LabelSet(self, ids)
+            self.label_sets[encoded] = label_set
+        return label_set
+
+
+# a ConfigParser interns into its own table (freed with its models), models built outside
+# of a `with table:` block intern into the default table, emptied by reset_label_table()
+CURRENT_LABEL_TABLE: ContextVar[Optional[LabelTable]] = ContextVar("CURRENT_LABEL_TABLE", default=None)
+default_label_table = LabelTable()
+
+
+def label_table() -> LabelTable:
+    table = CURRENT_LABEL_TABLE.get()
+    return table if table is not None else default_label_table
+
+
+def reset_label_table():
+    """
+    Start a new default table, models built before keep the old one (their LabelSets refer to it)
+    """
+    global default_label_table
+    default_label_table = LabelTable()
+
+
+class LabelSet(AbstractMapping):
+    """
+    Read-only label mapping backed by a LabelTable
+    ids holds (key_id, value_id) pairs sorted by key_id
+    """
+    __slots__ = ('table', 'ids')
+
+    def __init__(self, table: LabelTable, ids: array):
+        self.table = table
+        self.ids = ids
+
+    def pairs(self) -> Iterator[Tuple[int, int]]:
+        it = iter(self.ids)
+        return zip(it, it)
+
+    def value_id_of(self, kid: int) -> int:
+        ids = self.ids
+        for i in range(0, len(ids), 2):
+            if ids[i] == kid:
+                return ids[i + 1]
+            if ids[i] > kid:
+                break
+        return -1
+
+    def __getitem__(self, key: str) -> str:
+        kid = self.table.find_key(key)
+        vid = self.value_id_of(kid) if kid >= 0 else -1
+        if vid < 0:
+            raise KeyError(key)
+        return self.table.values[vid]
+
+    def __iter__(self) -> Iterator[str]:
+        keys = self.table.keys
+        for kid in self.ids[::2]:
+            yield keys[kid]
+
+    def __len__(self) -> int:
+        return len(self.ids) // 2
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, LabelSet) and other.table is self.table:
+            return self.ids == other.ids
+        return AbstractMapping.__eq__(self, other)
+
+    def __hash__(self) -> int:
+        return hash(self.ids.tobytes())
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
 
 
-@dataclass
 class Container:
-    name: str
-    labels: Dict[str, str]
-
-    select_policies: List[int] = field(default_factory=list)
-    allow_policies: List[int] = field(default_factory=list)
+    """
+    Slotted container model, keeps the dataclass style constructor, repr and equality
+    Policy memberships are compact int arrays filled by ReachabilityMatrix.build_matrix
+    """
+    __slots__ = ('name', 'labels', 'select_policies', 'allow_policies', 'namespace')
+
+    def __init__(self, name: str, labels: Mapping[str, str],
+            select_policies: Optional[Iterable[int]] = None,
+            allow_policies: Optional[Iterable[int]] = None,
+            namespace: str = "default"):
+        self.name = name
+        self.labels = label_table().intern(labels)
+        self.namespace = namespace
+        self.select_policies = array('i', select_policies if select_policies is not None else ())
+        self.allow_policies = array('i', allow_policies if allow_policies is not None else ())
 
     def getValueOrDefault(self, key: str, value: str):
-        if key in self.labels:
-            return self.labels[key]
-        return value
+        return self.labels.get(key, value)
     
     def getLabels(self):
         return self.labels
 
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.name == other.name and self.labels == other.labels and \
+            self.select_policies == other.select_policies and \
+            self.allow_policies == other.allow_policies and \
+            self.namespace == other.namespace
+
+    def __repr__(self) -> str:
+        return "Container(name={!r}, labels={!r}, select_policies={!r}, allow_policies={!r}, namespace={!r})".format(
+            self.name, self.labels, self.select_policies.tolist(), self.allow_policies.tolist(), self.namespace)
+
+
+@dataclass
+class Namespace:
+    name: str
+    labels: Dict[str, str] = None
+
+    def __post_init__(self):
+        self.labels = label_table().intern(self.labels if self.labels is not None else {})
+
+
+class NamespaceIndex:
+    """
+    namespace name -> bitset of the containers in it,
+    plus namespace labels to resolve namespaceSelector into ORs of these masks
+    """
+
+    def __init__(self, containers: List[Container], namespaces: Optional[List[Namespace]] = None) -> None:
+        self.container_size = len(containers)
+        self.empty = zeros(self.container_size)
+        self.masks: Dict[str, bitarray] = {}
+        for i, container in enumerate(containers):
+            mask = self.masks.get(container.namespace)
+            if mask is None:
+                mask = self.masks[container.namespace] = zeros(self.container_size)
+            mask[i] = True
+
+        no_labels = label_table().intern({})
+        self.labels: Dict[str, LabelSet] = {name: no_labels for name in self.masks}
+        for ns in namespaces or ():
+            self.labels[ns.name] = ns.labels
+
+    def mask(self, name: Optional[str]) -> bitarray:
+        # None stands for cluster-wide
+        if name is None:
+            return ~self.empty
+        return self.masks.get(name, self.empty)
+
+    def select(self, selector: "LabelSelector") -> bitarray:
+        result = zeros(self.container_size)
+        for name, labels in self.labels.items():
+            if name in self.masks and selector.matches(labels):
+                result |= self.masks[name]
+        return result
+
+
+@dataclass(frozen=True)
+class LabelExpression:
+    """
+    A matchExpressions requirement
+    NotIn and DoesNotExist also match objects without the key
+    """
+    IN: ClassVar[int] = 0
+    NOT_IN: ClassVar[int] = 1
+    EXISTS: ClassVar[int] = 2
+    DOES_NOT_EXIST: ClassVar[int] = 3
+
+    key: str
+    operator: int
+    values: Tuple[str, ...] = ()
+
+    @staticmethod
+    def from_operator(key: str, operator: str, values: Optional[Iterable[str]] = None) -> "LabelExpression":
+        op = operator.lower()
+        if op == "in":
+            return LabelExpression(key, LabelExpression.IN, tuple(values or ()))
+        if op == "notin":
+            return LabelExpression(key, LabelExpression.NOT_IN, tuple(values or ()))
+        if op == "exists":
+            return LabelExpression(key, LabelExpression.EXISTS)
+        # also accept the "DoesNotExists" spelling used in kubesv samples
+        if op in ("doesnotexist", "doesnotexists"):
+            return LabelExpression(key, LabelExpression.DOES_NOT_EXIST)
+        raise ValueError("unknown label selector operator: {}".format(operator))
+
+    def matches(self, labels: Mapping[str, str]) -> bool:
+        if self.operator == LabelExpression.EXISTS:
+            return self.key in labels
+        if self.operator == LabelExpression.DOES_NOT_EXIST:
+            return self.key not in labels
+        matched = labels.get(self.key) in self.values
+        return matched if self.operator == LabelExpression.IN else not matched
+
 
 @dataclass
-class PolicySelect:
-    labels: Dict[str, str]
+class LabelSelector:
+    """
+    matchLabels and matchExpressions are ANDed,
+    a selector without both selects everything
+    """
+    labels: Optional[Dict[str, str]] = None
+    expressions: Optional[Tuple[LabelExpression, ...]] = None
+
+    def __post_init__(self):
+        self.labels = label_table().intern(self.labels)
+        if self.expressions is not None:
+            self.expressions = tuple(self.expressions)
+
+    def matches(self, labels: Mapping[str, str], matcher: "LabelRelation[str]" = None) -> bool:
+        if self.labels is not None:
+            for k, v in self.labels.items():
+                if k not in labels:
+                    return False
+                if matcher is None:
+                    if labels[k] != v:
+                        return False
+                elif not matcher.match(v, labels[k]):
+                    return False
+        if self.expressions is not None:
+            for expr in self.expressions:
+                if not expr.matches(labels):
+                    return False
+        return True
+
+
+@dataclass
+class PolicyPeer:
+    """
+    One from/to item of a policy rule
+    pod_selector and namespace_selector are ANDed, a peer without both (e.g. ipBlock) selects no container
+    """
+    pod_selector: Optional[LabelSelector] = None
+    namespace_selector: Optional[LabelSelector] = None
+
+    def matches(self, labels: Mapping[str, str], namespace_labels: Mapping[str, str],
+            matcher: "LabelRelation[str]" = None) -> bool:
+        if self.pod_selector is None and self.namespace_selector is None:
+            return False
+        if self.namespace_selector is not None and not self.namespace_selector.matches(namespace_labels):
+            return False
+        return self.pod_selector is None or self.pod_selector.matches(labels, matcher)
+
+
+@dataclass
+class PolicySelect(LabelSelector):
     is_allow_all = False
     is_deny_all = False
 
 
 @dataclass
-class PolicyAllow:
-    labels: Dict[str, str]
+class PolicyAllow(LabelSelector):
+    """
+    peers are ORed; without peers the allow side is its own label selector
+    """
+    peers: Optional[List[PolicyPeer]] = None
     is_allow_all = False
     is_deny_all = False
 
+    def matches(self, labels: Mapping[str, str], matcher: "LabelRelation[str]" = None,
+            namespace_labels: Mapping[str, str] = None) -> bool:
+        if self.peers is None:
+            return super().matches(labels, matcher)
+        namespace_labels = namespace_labels if namespace_labels is not None else {}
+        return any(peer.matches(labels, namespace_labels, matcher) for peer in self.peers)
+
 
 @dataclass
 class PolicyDirection:
@@ -56,9 +361,51 @@ PolicyIngress = PolicyDirection(True)
 PolicyEgress = PolicyDirection(False)
 
 
+MIN_PORT = 1
+MAX_PORT = 65535
+DEFAULT_PROTOCOLS = ("TCP", "UDP", "SCTP")
+
+
+@dataclass(frozen=True)
+class PolicyPort:
+    """
+    port None matches every port of the protocol, a str port is a named port
+    end_port makes [port, end_port] a range
+    """
+    protocol: str = "TCP"
+    port: Optional[Union[int, str]] = None
+    end_port: Optional[int] = None
+
+    def interval(self) -> Optional[Tuple[int, int]]:
+        # half-open numeric interval, None for named ports
+        if self.port is None:
+            return (MIN_PORT, MAX_PORT + 1)
+        if isinstance(self.port, str):
+            return None
+        return (self.port, (self.end_port if self.end_port is not None else self.port) + 1)
+
+
 @dataclass
 class PolicyProtocol:
-    protocols: List[str]
+    """
+    protocols: a list of PolicyPort, or the flat [protocol, port, protocol, port, ...] form
+    ports is None when the policy is not restricted by port
+    """
+    protocols: List[Any]
+
+    def __post_init__(self):
+        self.ports: Optional[Tuple[PolicyPort, ...]] = None
+        if not self.protocols:
+            return
+        if all(isinstance(p, PolicyPort) for p in self.protocols):
+            self.ports = tuple(self.protocols)
+            return
+        ports = []
+        for protocol, port in zip(self.protocols[::2], self.protocols[1::2]):
+            if isinstance(port, str) and port.isdigit():
+                port = int(port)
+            ports.append(PolicyPort(protocol.upper(), port))
+        self.ports = tuple(ports)
 
 
 T = TypeVar('T')
@@ -73,16 +420,41 @@ class DefaultEqualityLabelRelation(LabelRelation):
         return rule == value
 
 
-@dataclass
+DEFAULT_LABEL_RELATION = DefaultEqualityLabelRelation()
+
+
 class Policy:
-    name: str
-    selector: PolicySelect
-    allow: PolicyAllow
-    direction: PolicyDirection
-    protocol: PolicyProtocol
-    matcher: LabelRelation[str] = DefaultEqualityLabelRelation()
-    working_select_set: bitarray = None
-    working_allow_set: bitarray = None
+    """
+    Slotted policy model, keeps the dataclass style constructor, repr and equality
+    namespace: the namespace the policy lives in, None for a cluster-wide policy
+    """
+    __slots__ = ('name', 'selector', 'allow', 'direction', 'protocol', 'matcher',
+        'working_select_set', 'working_allow_set', 'namespace')
+
+    def __init__(self, name: str, selector: PolicySelect, allow: PolicyAllow,
+            direction: PolicyDirection, protocol: PolicyProtocol,
+            matcher: LabelRelation[str] = None,
+            working_select_set: bitarray = None,
+            working_allow_set: bitarray = None,
+            namespace: Optional[str] = None):
+        self.name = name
+        self.selector = selector
+        self.allow = allow
+        self.direction = direction
+        self.protocol = protocol
+        self.matcher = matcher if matcher is not None else DEFAULT_LABEL_RELATION
+        self.working_select_set = working_select_set
+        self.working_allow_set = working_allow_set
+        self.namespace = namespace
+
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in Policy.__slots__)
+
+    def __repr__(self) -> str:
+        return "Policy({})".format(", ".join(
+            "{}={!r}".format(f, getattr(self, f)) for f in Policy.__slots__))
 
     @property
     def working_selector(self):
@@ -97,23 +469,25 @@ class Policy:
             return self.allow
         return self.selector
 
-    def select_policy(self, container: Container) -> bool:
-        cl = container.labels
-        sl = self.working_selector.labels
-        for k, v in cl.items():
-            if k in sl.keys() and \
-                not self.matcher.match(sl[k], v):
+    def match_labels(self, rule: LabelSet, labels: LabelSet) -> bool:
+        if type(self.matcher) is DefaultEqualityLabelRelation:
+            # equal strings share the same interned id
+            for kid, vid in labels.pairs():
+                rule_vid = rule.value_id_of(kid)
+                if rule_vid >= 0 and rule_vid != vid:
+                    return False
+            return True
+        for k, v in labels.items():
+            if k in rule and \
+                not self.matcher.match(rule[k], v):
                 return False
         return True
 
+    def select_policy(self, container: Container) -> bool:
+        return self.working_selector.matches(container.labels, self.matcher)
+
     def allow_policy(self, container: Container) -> bool:
-        cl = container.labels
-        al = self.working_allow.labels
-        for k, v in cl.items():
-            if k in al.keys() and \
-                not self.matcher.match(al[k], v):
-                return False
-        return True
+        return self.working_allow.matches(container.labels, self.matcher)
 
     def is_ingress(self):
         return self.direction.is_ingress()
@@ -128,91 +502,228 @@ class Policy:
 
 class ReachabilityMatrix:
     @staticmethod
-    def build_matrix(containers: List[Container], policies: List[Policy], 
-            check_self_ingress_traffic=True, 
+    def evaluate_policies(containers: List[Container], policies: List[Policy],
             check_select_by_no_policy=True,
-            build_transpose_matrix=False):
+            namespaces: Optional[List[Namespace]] = None) -> Tuple[List[Tuple[bool, bitarray, bitarray, bitarray]], bitarray]:
+        """
+        Select/allow sets of every policy, independent of ports
+        Return (is_ingress, select_set, allow_set, newly isolated set) per policy in order, and all isolated containers
+        namespaces: namespace labels for namespaceSelector, unlisted namespaces have no labels
+        """
         n_container = len(containers)
-        labelMap: Dict[str, bitarray] = DefaultDict(lambda: bitarray('0' * n_container))
-        have_seen = bitarray('0' * n_container)
-        in_matrix = [bitarray('1' * n_container) for _ in range(n_container)]
-        out_matrix = [bitarray('1' * n_container) for _ in range(n_container)]
+        # indexed by interned ids: key -> containers having the key, (key, value) -> containers having the label
+        keyMap: Dict[int, bitarray] = DefaultDict(lambda: zeros(n_container))
+        pairMap: Dict[Tuple[int, int], bitarray] = DefaultDict(lambda: zeros(n_container))
+        no_container = zeros(n_container)
+        have_seen = zeros(n_container)
         if not check_select_by_no_policy:
-            in_matrix = [bitarray('0' * n_container) for _ in range(n_container)]
-            out_matrix = [bitarray('0' * n_container) for _ in range(n_container)]
-            have_seen = bitarray('1' * n_container)
-
-        for i, container in enumerate(containers):
-            for key, value in container.labels.items():
-                labelMap[key][i] = True
-
+            have_seen = ones(n_container)
+
+        namespace_index = NamespaceIndex(containers, namespaces)
+        # namespace selectors are shared between peers, resolve each one once
+        namespace_selections: Dict[int, bitarray] = {}
+
+        # ids are compared within one table: the containers' one, labels of other tables are interned into it
+        table = containers[0].labels.table if containers else label_table()
+        label_sets = [table.intern(c.labels) for c in containers]
+        # column views, avoid attribute lookups in the loops below
+        select_lists = [c.select_policies for c in containers]
+        allow_lists = [c.allow_policies for c in containers]
+
+        for i, labels in enumerate(label_sets):
+            for kid, vid in labels.pairs():
+                keyMap[kid][i] = True
+                pairMap[kid, vid][i] = True
+
+        def expression_set(expr: LabelExpression) -> bitarray:
+            kid = table.find_key(expr.key)
+            has_key = keyMap.get(kid, no_container)
+            if expr.operator == LabelExpression.EXISTS:
+                return has_key
+            if expr.operator == LabelExpression.DOES_NOT_EXIST:
+                return ~has_key
+            in_set = zeros(n_container)
+            for v in expr.values:
+                in_set |= pairMap.get((kid, table.find_value(v)), no_container)
+            if expr.operator == LabelExpression.IN:
+                return in_set
+            return ~in_set
+
+        def selector_set(selector: LabelSelector, policy: Policy, base: bitarray) -> bitarray:
+            # start from the namespace mask, only its containers are candidates
+            result = base.copy()
+            if not result.any():
+                return result
+            labels = table.intern(selector.labels)
+            if labels is not None:
+                if type(policy.matcher) is DefaultEqualityLabelRelation:
+                    for kid, vid in labels.pairs():
+                        result &= pairMap.get((kid, vid), no_container)
+                else:
+                    # dealing with not matched values (needs a customized predicate)
+                    for kid, _ in labels.pairs():
+                        result &= keyMap.get(kid, no_container)
+                    for idx in list(result.search(1)):
+                        if not policy.match_labels(labels, label_sets[idx]):
+                            result[idx] = False
+            if selector.expressions is not None:
+                for expr in selector.expressions:
+                    result &= expression_set(expr)
+            return result
+
+        def peer_set(peer: PolicyPeer, policy: Policy, policy_namespace: bitarray) -> bitarray:
+            if peer.pod_selector is None and peer.namespace_selector is None:
+                return zeros(n_container)
+            # pods of the namespaces matched by namespaceSelector, otherwise of the policy's own namespace
+            base = policy_namespace
+            if peer.namespace_selector is not None:
+                key = id(peer.namespace_selector)
+                base = namespace_selections.get(key)
+                if base is None:
+                    base = namespace_selections[key] = namespace_index.select(peer.namespace_selector)
+            if peer.pod_selector is None:
+                return base.copy()
+            return selector_set(peer.pod_selector, policy, base)
+
+        def side_set(side: LabelSelector, policy: Policy, policy_namespace: bitarray) -> bitarray:
+            peers = getattr(side, "peers", None)
+            if peers is None:
+                return selector_set(side, policy, policy_namespace)
+            # peers are ORed
+            result = zeros(n_container)
+            for peer in peers:
+                result |= peer_set(peer, policy, policy_namespace)
+            return result
+
+        # (is_ingress, select_set, allow_set, newly isolated set) of each policy, in order
+        updates = []
         for i, policy in enumerate(policies):
-            select_set = bitarray(n_container)
-            select_set.setall(True)
-            allow_set = bitarray(n_container)
-            allow_set.setall(True)
-
             # work as all direction being egress
-            for k, v in policy.working_selector.labels.items():
-                if k in labelMap.keys():
-                    select_set &= labelMap[k]
-            for k, v in policy.working_allow.labels.items():
-                if k in labelMap.keys():
-                    allow_set &= labelMap[k]
-            
-            # dealing with not matched values (needs a customized predicate)
-            for idx in range(n_container):
-                if select_set[idx] and not policy.select_policy(containers[idx]):
-                    select_set[idx] = False
-                if allow_set[idx] and not policy.allow_policy(containers[idx]):
-                    allow_set[idx] = False
+            working_selector = policy.working_selector
+            working_allow = policy.working_allow
+            policy_namespace = namespace_index.mask(policy.namespace)
+            select_set = side_set(working_selector, policy, policy_namespace)
+            allow_set = side_set(working_allow, policy, policy_namespace)
             
             policy.store_bcp(select_set, allow_set)
 
-            if policy.working_allow.is_allow_all:
+            if working_allow.is_allow_all:
                 allow_set.setall(True)
-            elif policy.working_allow.is_deny_all:
+            elif working_allow.is_deny_all:
                 allow_set.setall(False)
             
-            if policy.working_selector.is_allow_all:
+            if working_selector.is_allow_all:
                 select_set.setall(True)
-            elif policy.working_selector.is_deny_all:
+            elif working_selector.is_deny_all:
                 select_set.setall(False)            
 
-            for idx in range(n_container):
-                if allow_set[idx]:
-                    if policy.is_ingress() and not have_seen[idx]:
-                        out_matrix[idx].setall(False)
-                        for j in range(n_container):
-                            in_matrix[j][idx] = False
-                        have_seen[idx] = True
-                    containers[idx].allow_policies.append(i)
-            for idx in range(n_container):
-                if select_set[idx]:
-                    if policy.is_egress() and not have_seen[idx]:
-                        out_matrix[idx].setall(False)
-                        for j in range(n_container):
-                            in_matrix[j][idx] = False
-                        have_seen[idx] = True
-                    if policy.is_ingress():   
-                        in_matrix[idx] |= allow_set
-                    else:
-                        out_matrix[idx] |= allow_set
-                    containers[idx].select_policies.append(i)
-
-        matrix = [bitarray('0' * n_container) for _ in range(n_container)]
+            # the first policy touching a container isolates it (allowed side of ingress, selected side of egress)
+            is_ingress = policy.is_ingress()
+            new_seen = (allow_set if is_ingress else select_set) & ~have_seen
+            have_seen |= new_seen
+
+            for idx in allow_set.search(1):
+                allow_lists[idx].append(i)
+            for idx in select_set.search(1):
+                select_lists[idx].append(i)
+            updates.append((is_ingress, select_set, allow_set, new_seen))
+
+        return updates, have_seen
+
+    @staticmethod
+    def accumulate(n_container: int,
+            updates: List[Tuple[bool, bitarray, bitarray, bitarray]],
+            have_seen: bitarray,
+            check_self_ingress_traffic=True,
+            check_select_by_no_policy=True,
+            contributors: Optional[AbstractSet[int]] = None) -> List[bitarray]:
+        """
+        Reachability rows from evaluated policies
+        Isolation comes from every policy, allowed traffic only from contributors (all policies if None)
+        """
+        out_matrix = [ones(n_container) for _ in range(n_container)]
+        if not check_select_by_no_policy:
+            out_matrix = [zeros(n_container) for _ in range(n_container)]
+
+        for i, (is_ingress, select_set, allow_set, new_seen) in enumerate(updates):
+            for idx in new_seen.search(1):
+                out_matrix[idx].setall(False)
+            if not is_ingress and (contributors is None or i in contributors):
+                for idx in select_set.search(1):
+                    out_matrix[idx] |= allow_set
+
+        # isolating a container clears its column of in_matrix, which also drops the ingress bits
+        # set by earlier policies: replay ingress policies backwards, masking columns isolated later
+        in_matrix = [~have_seen for _ in range(n_container)]
+        cleared_after = zeros(n_container)
+        for i in range(len(updates) - 1, -1, -1):
+            is_ingress, select_set, allow_set, new_seen = updates[i]
+            if is_ingress and (contributors is None or i in contributors):
+                allowed = allow_set & ~cleared_after
+                for idx in select_set.search(1):
+                    in_matrix[idx] |= allowed
+            cleared_after |= new_seen
+
+        matrix = [None] * n_container
         for i in range(n_container):
             if check_self_ingress_traffic:
                 in_matrix[i][i] = True
             matrix[i] = in_matrix[i] & out_matrix[i]
 
-        return ReachabilityMatrix(n_container, matrix, build_transpose_matrix)
+        return matrix
+
+    @staticmethod
+    def build_matrix(containers: List[Container], policies: List[Policy], 
+            check_self_ingress_traffic=True, 
+            check_select_by_no_policy=True,
+            build_transpose_matrix=False,
+            namespaces: Optional[List[Namespace]] = None):
+        """
+        Reachability over any port: a policy allows traffic if it allows it on some port
+        """
+        with metrics.phase("kano.build") as measure:
+            updates, have_seen = ReachabilityMatrix.evaluate_policies(containers, policies,
+                check_select_by_no_policy=check_select_by_no_policy,
+                namespaces=namespaces)
+            matrix = ReachabilityMatrix.accumulate(len(containers), updates, have_seen,
+                check_self_ingress_traffic=check_self_ingress_traffic,
+                check_select_by_no_policy=check_select_by_no_policy)
+            result = ReachabilityMatrix(len(containers), matrix, build_transpose_matrix)
+            if metrics.enabled():
+                measure.counts.update(
+                    containers=len(containers), policies=len(policies),
+                    edges=sum(row.count() for row in result.matrix))
+        return result
+
+    @staticmethod
+    def build_layers(containers: List[Container], policies: List[Policy],
+            check_self_ingress_traffic=True,
+            check_select_by_no_policy=True,
+            build_transpose_matrix=True,
+            namespaces: Optional[List[Namespace]] = None) -> "ReachabilityLayers":
+        """
+        One reachability matrix per port class (ports sharing the same policy treatment)
+        """
+        n_container = len(containers)
+        updates, have_seen = ReachabilityMatrix.evaluate_policies(containers, policies,
+            check_select_by_no_policy=check_select_by_no_policy,
+            namespaces=namespaces)
+        classes = port_classes(policies)
+        unrestricted = frozenset(i for i, p in enumerate(policies) if policy_ports(p) is None)
+        matrices = []
+        for port_class in classes:
+            matrix = ReachabilityMatrix.accumulate(n_container, updates, have_seen,
+                check_self_ingress_traffic=check_self_ingress_traffic,
+                check_select_by_no_policy=check_select_by_no_policy,
+                contributors=unrestricted | port_class.policies)
+            matrices.append(ReachabilityMatrix(n_container, matrix, build_transpose_matrix))
+        return ReachabilityLayers(classes, matrices)
 
     def build_tranpose(self):
-        self.transpose_matrix = [bitarray('0' * self.container_size) for _ in range(self.container_size)]
-        for i in range(self.container_size):
-            for j in range(self.container_size):
-                self.transpose_matrix[i][j] = self.matrix[j][i]
+        self.transpose_matrix = [zeros(self.container_size) for _ in range(self.container_size)]
+        for i, row in enumerate(self.matrix):
+            for j in row.search(1):
+                self.transpose_matrix[j][i] = True
 
     def __init__(self, container_size: int, matrix: Any, build_transpose_matrix=False) -> None:
         self.container_size = container_size
@@ -237,3 +748,127 @@ class ReachabilityMatrix:
         for i in range(self.container_size):
             value[i] = self.matrix[i][index]
         return value
+
+
+def policy_ports(policy: Policy) -> Optional[Tuple[PolicyPort, ...]]:
+    # None when the policy applies to every port
+    protocol = policy.protocol
+    if protocol is None:
+        return None
+    if not isinstance(protocol, PolicyProtocol):
+        protocol = PolicyProtocol(list(protocol))
+    return protocol.ports
+
+
+@dataclass
+class PortClass:
+    """
+    Ports treated the same way by every port restricted policy
+    policies: port restricted policies allowing these ports
+    ranges: half-open (protocol, start, end) port intervals, names: (protocol, named port)
+    """
+    index: int
+    policies: FrozenSet[int]
+    ranges: List[Tuple[str, int, int]] = field(default_factory=list)
+    names: List[Tuple[str, str]] = field(default_factory=list)
+
+
+def port_classes(policies: List[Policy]) -> List[PortClass]:
+    """
+    Split (protocol, port) into equivalence classes of policy treatment,
+    class 0 holds the ports no port restricted policy allows
+    """
+    intervals: Dict[str, List[Tuple[int, int, int]]] = DefaultDict(list)
+    named: Dict[Tuple[str, str], Set[int]] = DefaultDict(set)
+    for i, policy in enumerate(policies):
+        ports = policy_ports(policy)
+        if ports is None:
+            continue
+        for port in ports:
+            interval = port.interval()
+            if interval is None:
+                named[port.protocol, port.port].add(i)
+            else:
+                intervals[port.protocol].append((interval[0], interval[1], i))
+
+    by_signature: Dict[FrozenSet[int], PortClass] = {}
+
+    def class_of(signature: FrozenSet[int]) -> PortClass:
+        port_class = by_signature.get(signature)
+        if port_class is None:
+            port_class = PortClass(len(by_signature), signature)
+            by_signature[signature] = port_class
+        return port_class
+
+    class_of(frozenset())
+
+    # sweep the port line of each protocol, every elementary interval gets the set of policies covering it
+    for protocol in sorted(set(DEFAULT_PROTOCOLS) | set(intervals)):
+        starts: Dict[int, List[int]] = DefaultDict(list)
+        ends: Dict[int, List[int]] = DefaultDict(list)
+        for start, end, i in intervals[protocol]:
+            starts[start].append(i)
+            ends[end].append(i)
+        bounds = sorted({MIN_PORT, MAX_PORT + 1} | set(starts) | set(ends))
+
+        active: Dict[int, int] = DefaultDict(int)
+        for lo, hi in zip(bounds, bounds[1:]):
+            for i in ends.get(lo, ()):
+                active[i] -= 1
+                if active[i] == 0:
+                    del active[i]
+            for i in starts.get(lo, ()):
+                active[i] += 1
+            ranges = class_of(frozenset(active)).ranges
+            if ranges and ranges[-1][0] == protocol and ranges[-1][2] == lo:
+                ranges[-1] = (protocol, ranges[-1][1], hi)
+            else:
+                ranges.append((protocol, lo, hi))
+
+    for (protocol, name), pols in named.items():
+        class_of(frozenset(pols)).names.append((protocol, name))
+
+    return list(by_signature.values())
+
+
+class ReachabilityLayers:
+    """
+    Port and protocol aware reachability, one matrix per PortClass
+    """
+
+    def __init__(self, classes: List[PortClass], matrices: List[ReachabilityMatrix]) -> None:
+        self.classes = classes
+        self.matrices = matrices
+        self.starts: Dict[str, List[int]] = DefaultDict(list)
+        self.start_classes: Dict[str, List[int]] = DefaultDict(list)
+        self.named: Dict[Tuple[str, str], int] = {}
+        for port_class in classes:
+            for protocol, name in port_class.names:
+                self.named[protocol, name] = port_class.index
+        for protocol, start, port_class in sorted(
+                (r[0], r[1], c.index) for c in classes for r in c.ranges):
+            self.starts[protocol].append(start)
+            self.start_classes[protocol].append(port_class)
+
+    def class_index(self, port: Union[int, str], protocol: str = "TCP") -> int:
+        protocol = protocol.upper()
+        if isinstance(port, str):
+            if not port.isdigit():
+                return self.named.get((protocol, port), 0)
+            port = int(port)
+        pos = bisect_right(self.starts.get(protocol, []), port) - 1
+        if pos < 0 or port > MAX_PORT:
+            return 0
+        return self.start_classes[protocol][pos]
+
+    def layer(self, port: Union[int, str], protocol: str = "TCP") -> ReachabilityMatrix:
+        return self.matrices[self.class_index(port, protocol)]
+
+    def reachable(self, src: int, dst: int, port: Union[int, str], protocol: str = "TCP") -> bool:
+        return self.layer(port, protocol)[src, dst]
+
+    def sources(self, dst: int, port: Union[int, str], protocol: str = "TCP") -> bitarray:
+        """
+        containers that can reach dst on port/protocol
+        """
+        return self.layer(port, protocol).getcol(dst)
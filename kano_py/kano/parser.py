@@ -13,6 +13,9 @@ class ConfigParser:
         self.filepath = filepath
         self.containers = []
         self.policies = []
+        self.namespaces = []
+        # labels of the parsed models, dropped with the parser
+        self.label_table = LabelTable()
 
     def parse(self, filepath=None): 
         if filepath == None:
@@ -49,49 +52,159 @@ class ConfigParser:
 
         return self.containers, self.policies
 
+    @staticmethod
+    def create_selector(data, cls=LabelSelector):
+        # an empty (or null) selector selects everything
+        if data is None:
+            return cls()
+        expressions = None
+        if data.get('matchExpressions') is not None:
+            expressions = [
+                LabelExpression.from_operator(expr['key'], expr['operator'], expr.get('values'))
+                for expr in data['matchExpressions']
+            ]
+        return cls(data.get('matchLabels'), expressions)
+
+    @staticmethod
+    def create_allow(rule, peers_key):
+        # missing or empty from/to matches all peers
+        if rule is None or not rule.get(peers_key):
+            allow = PolicyAllow()
+            allow.is_allow_all = True
+            return allow
+
+        peers = []
+        for peer in rule[peers_key]:
+            pod_selector = None
+            namespace_selector = None
+            if 'podSelector' in peer:
+                pod_selector = ConfigParser.create_selector(peer['podSelector'])
+            if 'namespaceSelector' in peer:
+                namespace_selector = ConfigParser.create_selector(peer['namespaceSelector'])
+            peers.append(PolicyPeer(pod_selector, namespace_selector))
+        return PolicyAllow(peers=peers)
+
+    @staticmethod
+    def create_protocol(rule):
+        # missing or empty ports matches all ports
+        if rule is None or not rule.get('ports'):
+            return None
+        return PolicyProtocol([
+            PolicyPort((p.get('protocol') or 'TCP').upper(), p.get('port'), p.get('endPort'))
+            for p in rule['ports']
+        ])
+
+    def create_rules(self, name, namespace, select, rules, peers_key, direction):
+        self.add_rules(name, namespace, select, direction, [
+            (ConfigParser.create_allow(rule, peers_key), ConfigParser.create_protocol(rule))
+            for rule in rules or ()
+        ])
+
+    def add_rules(self, name, namespace, select, direction, allows):
+        # a policy type without rules selects (isolates) pods but allows nothing
+        if not allows:
+            allow = PolicyAllow()
+            allow.is_deny_all = True
+            self.policies.append(Policy(name, select, allow, direction, None, namespace=namespace))
+            return
+
+        for allow, protocol in allows:
+            self.policies.append(Policy(name, select, allow, direction, protocol, namespace=namespace))
+
     def create_object(self, data):
+        with self.label_table:
+            self.create_model(data)
+
+    def create_model(self, data):
+        namespace = data['metadata'].get('namespace') or 'default'
         if data['kind'] == 'NetworkPolicy':
-            select = data['spec']['podSelector']['matchLabels']
-            if 'Ingress' in data['spec']['policyTypes']:
-                for ing in data['spec']['ingress']:
-                    allow = None
-                    ports = None
-                    for f in ing['from']:
-                        if 'podSelector' in f:
-                            allow = f['podSelector']['matchLabels']
-                        if 'ports' in f:
-                            ports = [f['ports']['protocol'], f['ports']['port']]
-                    new_policy = Policy(data['metadata']['name']+'-ingress', PolicySelect(select), PolicyAllow(allow), PolicyIngress, ports)
-                    self.policies.append(new_policy)
-
-            if 'Egress' in data['spec']['policyTypes']:
-                for eg in data['spec']['egress']:
-                    allow = None
-                    ports = None
-                    for t in eg['to']:
-                        if 'podSelector' in t:
-                            allow = t['podSelector']['matchLabels']
-                        if 'ports' in t:
-                            ports = [t['ports']['protocol'], t['ports']['port']]
-                    new_policy = Policy(data['metadata']['name']+'-egress', PolicySelect(select), PolicyAllow(allow), PolicyEgress, ports)
-                    self.policies.append(new_policy)
+            spec = data['spec']
+            select = ConfigParser.create_selector(spec.get('podSelector'), PolicySelect)
+            policy_types = spec.get('policyTypes')
+            if policy_types is None:
+                # k8s default: always Ingress, Egress if egress rules are given
+                policy_types = ['Ingress'] + (['Egress'] if 'egress' in spec else [])
+
+            if 'Ingress' in policy_types:
+                self.create_rules(data['metadata']['name']+'-ingress', namespace, select, spec.get('ingress'), 'from', PolicyIngress)
+
+            if 'Egress' in policy_types:
+                self.create_rules(data['metadata']['name']+'-egress', namespace, select, spec.get('egress'), 'to', PolicyEgress)
 
         elif data['kind'] == 'Pod':
-            labels = data['metadata']['labels']
+            labels = data['metadata'].get('labels') or {}
             # XXX: use pod name as container name since they are the label owners
             """
             for container in data['spec']['containers']:
                 new_container = Container(container['name'], labels)
             """
-            new_container = Container(data['metadata']['name'], labels)
+            new_container = Container(data['metadata']['name'], labels, namespace=namespace)
             self.containers.append(new_container)
 
+        elif data['kind'] == 'Namespace':
+            self.namespaces.append(Namespace(data['metadata']['name'], data['metadata'].get('labels')))
+
+
+    @staticmethod
+    def snapshot_selector(selector, cls=LabelSelector):
+        # requirements are (operator, key, values) with the LabelExpression operator encoding
+        if selector is None:
+            return cls()
+        return cls(None, [LabelExpression(key, operator, values) for operator, key, values in selector.requirements])
+
+    @staticmethod
+    def snapshot_allow(rule):
+        if not rule.peers:
+            allow = PolicyAllow()
+            allow.is_allow_all = True
+            return allow
+
+        return PolicyAllow(peers=[
+            PolicyPeer(
+                ConfigParser.snapshot_selector(peer.pod_selector) if peer.pod_selector is not None else None,
+                ConfigParser.snapshot_selector(peer.namespace_selector) if peer.namespace_selector is not None else None)
+            for peer in rule.peers
+        ])
+
+    @staticmethod
+    def snapshot_protocol(rule):
+        if not rule.ports:
+            return None
+        return PolicyProtocol([PolicyPort(protocol, port, end_port) for port, protocol, end_port in rule.ports])
+
+    def load_snapshot(self, snapshot):
+        """
+        Read a kubesv ClusterSnapshot (duck-typed, no kubesv import) instead of parsing yaml again
+        """
+        with self.label_table:
+            return self.load_models(snapshot)
+
+    def load_models(self, snapshot):
+        for pod in snapshot.pods:
+            self.containers.append(Container(pod.name, pod.labels, namespace=pod.namespace))
+        for ns in snapshot.namespaces:
+            self.namespaces.append(Namespace(ns.name, ns.labels))
+
+        for pol in snapshot.policies:
+            select = ConfigParser.snapshot_selector(pol.pod_selector, PolicySelect)
+            for enabled, rules, suffix, direction in [
+                    (pol.is_ingress, pol.ingress, '-ingress', PolicyIngress),
+                    (pol.is_egress, pol.egress, '-egress', PolicyEgress)]:
+                if enabled:
+                    self.add_rules(pol.name + suffix, pol.namespace, select, direction, [
+                        (ConfigParser.snapshot_allow(rule), ConfigParser.snapshot_protocol(rule))
+                        for rule in rules or ()
+                    ])
+
+        return self.containers, self.policies
 
     def print_all(self):
         for c in self.containers:
             print(c)
         for p in self.policies:
             print(p)
+        for ns in self.namespaces:
+            print(ns)
 
 def main():
    cp = ConfigParser()
@@ -2,7 +2,15 @@ import os
 import random
 import yaml
 from collections import OrderedDict
+from itertools import accumulate
+from typing import *
 from ..kano.model import *
+from kubesv.kubesv.snapshot import ClusterSnapshot
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
 
 class ConfigFiles:
     def __init__(self, directory='data', podN=100,nsN=5,policyN=50,podLL=5,nsLL=5,keyL=5,valueL=10,userL=5,selectedLL=3,allowNSLL=3,allowpodLL=3):
@@ -110,6 +118,184 @@ class ConfigFiles:
         return self.containers
 
 
+def zipf_weights(n: int, exponent: float) -> List[float]:
+    # cumulative weights of ranks 1..n with probability ~ 1 / rank^exponent, for random.choices
+    return list(accumulate(1.0 / (rank ** exponent) for rank in range(1, n + 1)))
+
+
+class ClusterGenerator:
+    """
+    Seeded synthetic cluster built in memory, as k8s manifest dicts
+    - pods come in replica groups (a deployment): same namespace, same labels, app=<group>
+    - label keys, label values, namespaces and policy targets follow Zipf popularity
+    - namespaces carry team/env labels, selectors mix matchLabels and matchExpressions
+    - policies are ingress only, egress only or both (ingress_mix, egress_mix, the rest both)
+    Same seed and parameters -> same cluster. snapshot() feeds kano and kubesv, export() writes yaml
+    """
+    OPERATORS = ["In", "NotIn", "Exists", "DoesNotExist"]
+    PORTS = [80, 443, 8080, 5432, 6379, 9090]
+
+    def __init__(self, seed=0, pods=1000, namespaces=20, policies=500,
+            keys=20, values=50, users=5, labels_per_group=(1, 5), replicas=(1, 8),
+            zipf=1.1, match_expressions=0.3, namespace_peers=0.3, ports=0.3,
+            ingress_mix=0.6, egress_mix=0.2, peers_per_rule=(1, 3), rules_per_policy=(1, 2)):
+        self.rng = random.Random(seed)
+        self.n_pods = pods
+        self.n_namespaces = max(1, namespaces)
+        self.n_policies = policies
+        self.keys = ["key{}".format(i) for i in range(keys)]
+        self.values = ["value{}".format(i) for i in range(values)]
+        self.users = ["user{}".format(i) for i in range(users)]
+        self.labels_per_group = labels_per_group
+        self.replicas = replicas
+        self.zipf = zipf
+        self.match_expressions = match_expressions
+        self.namespace_peers = namespace_peers
+        self.ports = ports
+        self.ingress_mix = ingress_mix
+        self.egress_mix = egress_mix
+        self.peers_per_rule = peers_per_rule
+        self.rules_per_policy = rules_per_policy
+
+        self.namespaces: List[dict] = []
+        self.pods: List[dict] = []
+        self.policies: List[dict] = []
+        # (namespace, labels) per replica group
+        self.groups: List[Tuple[str, Dict[str, str]]] = []
+        self.generate()
+
+    def generate(self):
+        rng, zipf = self.rng, self.zipf
+        teams = ["team{}".format(i) for i in range(max(1, self.n_namespaces // 4))]
+        namespace_names = ["ns{}".format(i) for i in range(self.n_namespaces)]
+        for name in namespace_names:
+            self.namespaces.append({
+                "apiVersion": "v1",
+                "kind": "Namespace",
+                "metadata": {"name": name, "labels": {
+                    "kubernetes.io/metadata.name": name,
+                    "team": rng.choice(teams),
+                    "env": rng.choice(["prod", "staging", "dev"]),
+                }},
+            })
+
+        # popularity draws in bulk: one choices call per distribution
+        n_groups = max(1, self.n_pods * 2 // (self.replicas[0] + self.replicas[1]))
+        group_namespaces = rng.choices(namespace_names, cum_weights=zipf_weights(len(namespace_names), zipf), k=n_groups)
+        key_weights, value_weights = zipf_weights(len(self.keys), zipf), zipf_weights(len(self.values), zipf)
+        n_labels = [rng.randint(*self.labels_per_group) for _ in range(n_groups)]
+        keys = rng.choices(self.keys, cum_weights=key_weights, k=sum(n_labels))
+        values = rng.choices(self.values, cum_weights=value_weights, k=sum(n_labels))
+        users = rng.choices(self.users, k=n_groups)
+
+        offset = 0
+        for g in range(n_groups):
+            labels = dict(zip(keys[offset:offset + n_labels[g]], values[offset:offset + n_labels[g]]))
+            offset += n_labels[g]
+            labels["app"] = "app{}".format(g)
+            labels["User"] = users[g]
+            self.groups.append((group_namespaces[g], labels))
+
+        # replica counts, groups scale up again while pods are missing (replica names continue)
+        replicas = [0] * n_groups
+        g = 0
+        while len(self.pods) < self.n_pods:
+            namespace, labels = self.groups[g % n_groups]
+            for _ in range(min(rng.randint(*self.replicas), self.n_pods - len(self.pods))):
+                self.pods.append({
+                    "apiVersion": "v1",
+                    "kind": "Pod",
+                    "metadata": {
+                        "name": "{}-{}".format(labels["app"], replicas[g % n_groups]),
+                        "namespace": namespace,
+                        "labels": dict(labels),
+                    },
+                })
+                replicas[g % n_groups] += 1
+            g += 1
+
+        targets = rng.choices(range(n_groups), cum_weights=zipf_weights(n_groups, zipf), k=self.n_policies)
+        for i, target in enumerate(targets):
+            self.policies.append(self.policy(i, target))
+
+    def selector(self, labels: Dict[str, str]) -> dict:
+        """
+        Selects a replica group: by app (matchLabels) or by one of its labels (matchExpressions)
+        """
+        rng = self.rng
+        if rng.random() >= self.match_expressions:
+            return {"matchLabels": {"app": labels["app"]}}
+        key = rng.choice([k for k in labels if k != "User"])
+        operator = rng.choice(self.OPERATORS)
+        if operator in ("Exists", "DoesNotExist"):
+            return {"matchExpressions": [{"key": key, "operator": operator}]}
+        values = {labels[key]} | set(rng.sample(self.values, 2))
+        if operator == "NotIn":
+            values.discard(labels[key])
+        return {"matchExpressions": [{"key": key, "operator": operator, "values": sorted(values)}]}
+
+    def peer(self) -> dict:
+        rng = self.rng
+        namespace, labels = rng.choice(self.groups)
+        peer = {"podSelector": self.selector(labels)}
+        if rng.random() < self.namespace_peers:
+            ns = self.namespaces[rng.randrange(len(self.namespaces))]["metadata"]["labels"]
+            key = rng.choice(["team", "env"])
+            peer["namespaceSelector"] = {"matchLabels": {key: ns[key]}}
+        return peer
+
+    def rule(self, peers_key: str) -> dict:
+        rng = self.rng
+        rule = {peers_key: [self.peer() for _ in range(rng.randint(*self.peers_per_rule))]}
+        if rng.random() < self.ports:
+            rule["ports"] = [{"protocol": "TCP", "port": port} for port in rng.sample(self.PORTS, rng.randint(1, 2))]
+        return rule
+
+    def policy(self, i: int, target: int) -> dict:
+        rng = self.rng
+        namespace, labels = self.groups[target]
+        mix = rng.random()
+        if mix < self.ingress_mix:
+            types = ["Ingress"]
+        elif mix < self.ingress_mix + self.egress_mix:
+            types = ["Egress"]
+        else:
+            types = ["Ingress", "Egress"]
+
+        spec = {"podSelector": self.selector(labels), "policyTypes": types}
+        if "Ingress" in types:
+            spec["ingress"] = [self.rule("from") for _ in range(rng.randint(*self.rules_per_policy))]
+        if "Egress" in types:
+            spec["egress"] = [self.rule("to") for _ in range(rng.randint(*self.rules_per_policy))]
+        return {
+            "apiVersion": "networking.k8s.io/v1",
+            "kind": "NetworkPolicy",
+            "metadata": {"name": "policy{}".format(i), "namespace": namespace},
+            "spec": spec,
+        }
+
+    def manifests(self) -> List[dict]:
+        return self.namespaces + self.pods + self.policies
+
+    def snapshot(self) -> ClusterSnapshot:
+        return ClusterSnapshot.from_objects(self.manifests())
+
+    def export(self, directory: str, per_object=False):
+        """
+        cluster.yaml with every manifest, or one file per object (the ConfigFiles layout)
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if not per_object:
+            with open(os.path.join(directory, "cluster.yaml"), "w") as f:
+                yaml.dump_all(self.manifests(), f, Dumper=SafeDumper, default_flow_style=False, sort_keys=False)
+            return
+        for manifest in self.manifests():
+            filename = "{}-{}-{}.yml".format(manifest["kind"].lower(),
+                manifest["metadata"].get("namespace", ""), manifest["metadata"]["name"])
+            with open(os.path.join(directory, filename), "w") as f:
+                yaml.dump(manifest, f, Dumper=SafeDumper, default_flow_style=False, sort_keys=False)
+
 if __name__ == "__main__":
     config = ConfigFiles()
     config.generateConfigFiles()
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from .context import sample
+from kano.model import *
+from kano.parser import ConfigParser
 
 import unittest
+from types import SimpleNamespace as Obj
 
 
 class AdvancedTestSuite(unittest.TestCase):
@@ -11,6 +14,248 @@ class AdvancedTestSuite(unittest.TestCase):
     def test_thoughts(self):
         self.assertIsNone(None)
 
+    def test_label_interning(self):
+        containers, policies = sample.paper_example()
+        a, d = containers[0], containers[3]
+        # same key/value strings share the same ids
+        self.assertIs(a.labels.table, d.labels.table)
+        self.assertEqual(list(a.labels.pairs())[1], list(d.labels.pairs())[1])
+        self.assertEqual(a.labels, {"app": "Alice", "role": "Nginx"})
+        self.assertEqual(a.getValueOrDefault("app", ""), "Alice")
+        self.assertEqual(a.getValueOrDefault("user", ""), "")
+        # identical label sets are hash-consed
+        self.assertIs(Container("X", {"role": "Nginx", "app": "Alice"}).labels, a.labels)
+        self.assertTrue(policies[2].allow_policy(a))
+        self.assertFalse(policies[2].allow_policy(containers[1]))
+
+    def test_label_table_scope(self):
+        # a parser interns into its own table, not the default one
+        cp = ConfigParser()
+        cp.create_object({"kind": "Pod", "metadata": {"name": "web", "labels": {"scoped": "yes"}}})
+        self.assertIs(cp.containers[0].labels.table, cp.label_table)
+        self.assertEqual(label_table().find_key("scoped"), -1)
+
+        # labels of another table are interned into the containers' table when building
+        policy = Policy("web", PolicySelect({"scoped": "yes"}), PolicyAllow({"scoped": "yes"}), PolicyEgress, None)
+        self.assertIsNot(policy.selector.labels.table, cp.label_table)
+        matrix = ReachabilityMatrix.build_matrix(cp.containers, [policy])
+        self.assertEqual(matrix.getrow(0).tolist(), [1])
+
+        reset_label_table()
+        self.assertEqual(label_table().find_key("scoped"), -1)
+        self.assertEqual(policy.selector.labels, {"scoped": "yes"})
+
+    def test_policy_semantics(self):
+        cp = ConfigParser()
+        for name, labels in [("db", {"role": "db"}), ("web", {"role": "web", "env": "prod"}),
+                ("dev", {"role": "web", "env": "dev"}), ("job", {"tier": "batch"})]:
+            cp.create_object({"kind": "Pod", "metadata": {"name": name, "labels": labels}})
+        cp.create_object({
+            "kind": "NetworkPolicy",
+            "metadata": {"name": "db"},
+            "spec": {
+                "podSelector": {"matchExpressions": [{"key": "role", "operator": "In", "values": ["db"]}]},
+                "ingress": [{"from": [
+                    {"podSelector": {"matchExpressions": [
+                        {"key": "env", "operator": "NotIn", "values": ["dev"]},
+                        {"key": "role", "operator": "Exists"}]}},
+                    {"podSelector": {"matchLabels": {"tier": "batch"}}},
+                    {"namespaceSelector": {"matchLabels": {"project": "other"}}},
+                ]}],
+            },
+        })
+        cp.create_object({
+            "kind": "NetworkPolicy",
+            "metadata": {"name": "deny-job"},
+            "spec": {"podSelector": {"matchLabels": {"tier": "batch"}}, "policyTypes": ["Egress"]},
+        })
+        containers, policies = cp.containers, cp.policies
+        self.assertEqual(len(policies), 2)
+        self.assertTrue(policies[1].allow.is_deny_all)
+
+        matrix = ReachabilityMatrix.build_matrix(containers, policies, check_self_ingress_traffic=False)
+        # db accepts web (prod) and job peers, not dev nor itself
+        self.assertEqual(matrix.getcol(0).tolist(), [0, 1, 0, 0])
+        # job can not send anything
+        self.assertEqual(matrix.getrow(3).count(), 0)
+
+        # the namespace selector peer matches the whole namespace,
+        # db itself is isolated by its policy and can not send
+        matrix = ReachabilityMatrix.build_matrix(containers, policies, check_self_ingress_traffic=False,
+            namespaces=[Namespace("default", {"project": "other"})])
+        self.assertEqual(matrix.getcol(0).tolist(), [0, 1, 1, 0])
+
+    def test_port_layers(self):
+        containers, policies = sample.paper_example()
+        policies.append(Policy("E", PolicySelect({"role": "DB"}), PolicyAllow({"app": "User"}),
+            PolicyIngress, PolicyProtocol([PolicyPort("TCP", 3000, 3400)])))
+        layers = ReachabilityMatrix.build_layers(containers, policies)
+        # 3306 (A, C, D, E), 3000-3305 and 3307-3400 (E), 8080 (B), everything else
+        self.assertEqual(len(layers.classes), 4)
+        self.assertEqual(layers.class_index(3306), layers.class_index("3306", "tcp"))
+        self.assertEqual(layers.class_index(3306, "UDP"), 0)
+        self.assertEqual(layers.class_index(3000), layers.class_index(3400))
+        # User -> Tomcat on 8080 only
+        self.assertTrue(layers.reachable(4, 2, 8080))
+        self.assertFalse(layers.reachable(4, 2, 3306))
+        # who can reach the DB on a given port
+        self.assertEqual(layers.sources(1, 3306).tolist(), [0, 0, 0, 0, 1])
+        self.assertEqual(layers.sources(1, 3100).tolist(), [0, 0, 0, 0, 1])
+        self.assertEqual(layers.sources(1, 8080).count(), 0)
+        # the port agnostic matrix is the union of the layers
+        fresh_containers, _ = sample.paper_example()
+        matrix = ReachabilityMatrix.build_matrix(fresh_containers, policies)
+        for i in range(len(containers)):
+            union = zeros(len(containers))
+            for layer in layers.matrices:
+                union |= layer.getrow(i)
+            self.assertEqual(matrix.getrow(i), union)
+
+    def test_namespaces(self):
+        cp = ConfigParser()
+        cp.create_object({"kind": "Namespace", "metadata": {"name": "prod", "labels": {"env": "prod"}}})
+        for name, ns in [("a", "default"), ("b", "prod"), ("c", "prod"), ("d", "dev")]:
+            cp.create_object({"kind": "Pod", "metadata": {"name": name, "namespace": ns, "labels": {"app": "web"}}})
+        # selects the pods of prod only, accepts its own namespace and namespaces labeled env=dev
+        cp.create_object({
+            "kind": "NetworkPolicy",
+            "metadata": {"name": "web", "namespace": "prod"},
+            "spec": {
+                "podSelector": {"matchLabels": {"app": "web"}},
+                "ingress": [{"from": [
+                    {"podSelector": {}},
+                    {"namespaceSelector": {"matchLabels": {"env": "dev"}}},
+                ]}],
+            },
+        })
+        containers, policies = cp.containers, cp.policies
+        self.assertEqual(containers[1].namespace, "prod")
+        self.assertEqual(policies[0].namespace, "prod")
+
+        index = NamespaceIndex(containers, cp.namespaces)
+        self.assertEqual(index.mask("prod").tolist(), [0, 1, 1, 0])
+        self.assertEqual(index.select(LabelSelector({"env": "prod"})).tolist(), [0, 1, 1, 0])
+
+        matrix = ReachabilityMatrix.build_matrix(containers, policies, namespaces=cp.namespaces)
+        # only prod pods are isolated
+        self.assertEqual([list(c.allow_policies) for c in containers], [[], [0], [0], []])
+        # dev is not labeled env=dev and isolated prod pods can not send, so nobody reaches prod
+        self.assertEqual(matrix.getcol(1).tolist(), [0, 0, 0, 0])
+        self.assertEqual(matrix.getcol(0).tolist(), [1, 0, 0, 1])
+
+        cp.namespaces.append(Namespace("dev", {"env": "dev"}))
+        matrix = ReachabilityMatrix.build_matrix(containers, policies, namespaces=cp.namespaces)
+        self.assertEqual(matrix.getcol(1).tolist(), [0, 0, 0, 1])
+
+    def test_load_snapshot(self):
+        # duck-typed cluster snapshot, as compiled by kubesv.snapshot
+        selector = lambda *requirements: Obj(requirements=requirements)
+        peer = lambda pod=None, ns=None: Obj(pod_selector=pod, namespace_selector=ns)
+        snapshot = Obj(
+            pods=[Obj(name=name, namespace="default", labels=labels) for name, labels in [
+                ("db", {"role": "db"}), ("web", {"role": "web", "env": "prod"}),
+                ("dev", {"role": "web", "env": "dev"}), ("job", {"tier": "batch"})]],
+            namespaces=[Obj(name="default", labels={})],
+            policies=[
+                Obj(name="db", namespace="default", pod_selector=selector((LabelExpression.IN, "role", ("db",))),
+                    is_ingress=True, is_egress=False, egress=None, ingress=[Obj(ports=((5432, "TCP", None),), peers=[
+                        peer(selector((LabelExpression.NOT_IN, "env", ("dev",)), (LabelExpression.EXISTS, "role", ()))),
+                        peer(selector((LabelExpression.IN, "tier", ("batch",)))),
+                        peer(ns=selector((LabelExpression.IN, "project", ("other",)))),
+                    ])]),
+                Obj(name="deny-job", namespace="default", pod_selector=selector((LabelExpression.IN, "tier", ("batch",))),
+                    is_ingress=False, is_egress=True, ingress=None, egress=None),
+            ])
+
+        cp = ConfigParser()
+        containers, policies = cp.load_snapshot(snapshot)
+        self.assertEqual([c.name for c in containers], ["db", "web", "dev", "job"])
+        self.assertEqual([p.name for p in policies], ["db-ingress", "deny-job-egress"])
+        self.assertTrue(policies[1].allow.is_deny_all)
+        self.assertEqual(policies[0].protocol.ports, (PolicyPort("TCP", 5432),))
+
+        # same reachability as the parsed policies of test_policy_semantics
+        matrix = ReachabilityMatrix.build_matrix(containers, policies, check_self_ingress_traffic=False,
+            namespaces=cp.namespaces)
+        self.assertEqual(matrix.getcol(0).tolist(), [0, 1, 0, 0])
+        self.assertEqual(matrix.getrow(3).count(), 0)
+
+    def test_cluster_generator(self):
+        from kano_py.tests.generate import ClusterGenerator
+        params = dict(pods=300, namespaces=6, policies=120, match_expressions=0.5)
+        generator = ClusterGenerator(seed=7, **params)
+        self.assertEqual(generator.manifests(), ClusterGenerator(seed=7, **params).manifests())
+        self.assertNotEqual(generator.manifests(), ClusterGenerator(seed=8, **params).manifests())
+
+        # pod names are unique per namespace, replicas have equal but separate labels
+        for seed in range(50):
+            pods = ClusterGenerator(seed=seed, **params).pods
+            self.assertEqual(len(pods), 300)
+            names = {(pod["metadata"]["namespace"], pod["metadata"]["name"]) for pod in pods}
+            self.assertEqual(len(names), 300, "seed {}".format(seed))
+            labels = [id(pod["metadata"]["labels"]) for pod in pods]
+            self.assertEqual(len(set(labels)), 300)
+        types = {tuple(policy["spec"]["policyTypes"]) for policy in generator.policies}
+        self.assertEqual(types, {("Ingress",), ("Egress",), ("Ingress", "Egress")})
+
+        cp = ConfigParser()
+        containers, policies = cp.load_snapshot(generator.snapshot())
+        self.assertEqual(len(containers), 300)
+        self.assertGreaterEqual(len(policies), 120)
+        matrix = ReachabilityMatrix.build_matrix(containers, policies, namespaces=cp.namespaces)
+        self.assertEqual(matrix.container_size, 300)
+
+    def test_differential(self):
+        from bench.differential import VARIANTS, Variant, compare, differential, minimize
+        from kubesv.kubesv.snapshot import ClusterSnapshot
+        kano = VARIANTS[0]
+
+        def flat(snapshot, checks):
+            # ignores namespaces: app=b of other reaches db
+            pods = [pod._replace(namespace="default") for pod in snapshot.pods]
+            return kano.run(ClusterSnapshot(pods, snapshot.policies), checks)
+        variants = [kano, Variant("kano.flat", "flat", flat)]
+
+        pod = lambda name, namespace, app, user: {"kind": "Pod", "metadata": {
+            "name": name, "namespace": namespace, "labels": {"app": app, "User": user}}}
+        manifests = [
+            {"kind": "Namespace", "metadata": {"name": "default"}},
+            {"kind": "Namespace", "metadata": {"name": "other"}},
+            pod("db", "default", "db", "a"), pod("web", "default", "web", "a"),
+            pod("b", "other", "b", "b"), pod("c", "other", "c", "b"),
+            {"kind": "NetworkPolicy", "metadata": {"name": "web", "namespace": "default"}, "spec": {
+                "podSelector": {"matchLabels": {"app": "web"}}, "ingress": [{}]}},
+            {"kind": "NetworkPolicy", "metadata": {"name": "db", "namespace": "default"}, "spec": {
+                "podSelector": {"matchLabels": {"app": "db"}},
+                "ingress": [{"from": [{"podSelector": {"matchLabels": {"app": "b"}}}]}]}},
+        ]
+        divergent = [manifests[2], manifests[4], manifests[7]]
+
+        # ddmin keeps db, the pod it wrongly accepts and the policy, without namespaces
+        reproduces = lambda candidate: compare(
+            ClusterSnapshot.from_objects(candidate), variants[1], kano, "all_isolated") is not None
+        self.assertEqual(minimize(manifests, reproduces), divergent)
+        self.assertEqual(minimize(divergent, reproduces), divergent)
+        self.assertEqual(compare(ClusterSnapshot.from_objects(divergent), variants[1], kano, "all_isolated"),
+            (frozenset({0}), frozenset()))
+        # at most max_tests calls
+        calls = []
+        minimize(manifests, lambda candidate: calls.append(candidate) or True, max_tests=3)
+        self.assertEqual(len(calls), 3)
+
+        # one mismatch per check, each with its own minimized cluster and timing
+        mismatches, timings = differential(manifests, {"pods": 4}, variants)
+        self.assertEqual(set(timings), {"kano", "kano.flat"})
+        self.assertEqual([(m.check, m.variant, m.reference) for m in mismatches],
+            [("all_isolated", "kano.flat", "kano"), ("user_crosscheck", "kano.flat", "kano")])
+        self.assertEqual([(m.missing, m.extra) for m in mismatches],
+            [(frozenset({0}), frozenset()), (frozenset(), frozenset({0}))])
+        for mismatch in mismatches:
+            self.assertEqual(mismatch.manifests, divergent)
+            self.assertEqual(set(mismatch.timings), {mismatch.check})
+        # the reference variant agrees with itself
+        self.assertEqual(differential(manifests, {"pods": 4}, [kano, Variant("kano.copy", "kano", kano.run)])[0], [])
+
 
 if __name__ == '__main__':
     unittest.main()
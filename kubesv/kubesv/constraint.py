@@ -1,8 +1,12 @@
+import ctypes
 from math import log2, floor
 from os import name
 from z3 import *
+from z3.z3core import Z3_fixedpoint_add_fact
 from .model import *
-from .utils import parse_z3_result
+from .utils import parse_z3_result, iter_z3_answer
+from .datalog import DatalogEngine
+from . import metrics
 
 
 class GlobalInfo:
@@ -12,7 +16,9 @@ class GlobalInfo:
             namespaces: List[NamespaceAdapter],
             check_self_ingress_traffic=True,
             check_select_by_no_policy=False,
-            ground_default_pod=False):
+            ground_default_pod=False,
+            bulk_facts=True,
+            finite_domain=False):
 
         self.check_self_traffic = check_self_ingress_traffic
         self.check_select_by_any = check_select_by_no_policy
@@ -22,6 +28,20 @@ class GlobalInfo:
         self.ns_rels: Dict[str, FuncDeclRef] = {}
         self.core_rels: Dict[str, FuncDeclRef] = {}
         self.lit_map: Dict[str, IntNumRef] = {}
+        self.lit_ids: Dict[str, int] = {}
+        # compiled selectors and In/NotIn helpers shared by policies, see SelectorIR.define_relation
+        self.selector_rels: Dict[Tuple, Any] = {}
+        # ast ids of the vars declared to fp
+        self.declared_vars: Set[int] = set()
+        # rules emitted through add_rule
+        self.n_rules = 0
+
+        # ground facts as value tuples, rendered and loaded in one call by load_facts
+        self.bulk_facts = bulk_facts
+        # NOTE: keyed by id(func), hashing a z3 decl goes through the C API
+        self.fact_buffer: Dict[int, Tuple[FuncDeclRef, List[Tuple[int, ...]]]] = {}
+        # facts already added to fp, fp.sexpr() leaves them out (see ProgramImage)
+        self.loaded_facts: List[Tuple[FuncDeclRef, List[Tuple[int, ...]]]] = []
         
         self.fp = fp
         
@@ -33,12 +53,25 @@ class GlobalInfo:
         for i, ns in enumerate(namespaces):
             self.nam_map[ns.name] = i
         
-        self.nam_sort = BitVecSort(1 + floor(log2(1 + len(namespaces))))
-        self.pod_sort = BitVecSort(1 + floor(log2(1 + len(pods))))
-        self.pol_sort = BitVecSort(1 + floor(log2(1 + len(policies))))
-        # XXX: this is a hack... assume less than 2^31 - 1 unique label valuess
-        self.lv_sort = BitVecSort(32)
         self.lv_counter = 0
+        self.lv_sort = None
+        self.finite_domain = finite_domain
+        if finite_domain:
+            # sorts sized to the actual entities, label values are interned up front:
+            # a literal only used by selectors gets the spare value no fact carries, i.e. it matches nothing
+            for obj in pods + namespaces:
+                for v in obj.labels.values():
+                    self.get_or_create_literal_id(v)
+            self.nam_sort = FiniteDomainSort('nam', max(1, len(namespaces)))
+            self.pod_sort = FiniteDomainSort('pod', max(1, len(pods)))
+            self.pol_sort = FiniteDomainSort('pol', max(1, len(policies)))
+            self.lv_sort = FiniteDomainSort('lv', self.lv_counter + 1)
+        else:
+            self.nam_sort = BitVecSort(1 + floor(log2(1 + len(namespaces))))
+            self.pod_sort = BitVecSort(1 + floor(log2(1 + len(pods))))
+            self.pol_sort = BitVecSort(1 + floor(log2(1 + len(policies))))
+            # XXX: this is a hack... assume less than 2^31 - 1 unique label valuess
+            self.lv_sort = BitVecSort(32)
 
     def register_relation(self, name, func, is_core=False):
         self.fp.register_relation(func)
@@ -51,10 +84,18 @@ class GlobalInfo:
         self.fp.register_relation(func)
         self.ns_rels[name] = func
 
+    def get_or_create_literal_id(self, s: str) -> int:
+        if s not in self.lit_ids:
+            if self.finite_domain and self.lv_sort is not None:
+                # the domain is closed: unseen literal
+                return self.lv_counter
+            self.lit_ids[s] = self.lv_counter
+            self.lv_counter += 1
+        return self.lit_ids[s]
+
     def get_or_create_literal(self, s: str) -> Any:
         if s not in self.lit_map:
-            self.lit_map[s] = BitVecVal(self.lv_counter, self.lv_sort)
-            self.lv_counter += 1
+            self.lit_map[s] = self.value(self.get_or_create_literal_id(s), self.lv_sort)
         return self.lit_map[s]
 
     def get_relation(self, name) -> Optional[FuncDeclRef]:
@@ -75,12 +116,31 @@ class GlobalInfo:
         else:
             return None
 
+    def define_relation_core(self, name, *sorts) -> Tuple[FuncDeclRef, bool]:
+        """
+        Register a core relation only once
+        Return the relation and whether it is new, i.e. its rules still have to be added
+        """
+        if name in self.core_rels:
+            return self.core_rels[name], False
+        func = Function(name, *sorts, BoolSort())
+        self.register_relation(name, func, is_core=True)
+        return func, True
+
     def add_fact(self, fact, name=None):
         self.fp.fact(fact)
 
     def add_rule(self, lhs, rhs, name=None):
+        self.n_rules += 1
         self.fp.rule(lhs, rhs, name)
 
+    def count_facts(self) -> int:
+        return sum(len(facts) for _, facts in self.loaded_facts) + \
+            sum(len(facts) for _, facts in self.fact_buffer.values())
+
+    def count_relations(self) -> int:
+        return len(self.rels) + len(self.ns_rels) + len(self.core_rels)
+
     def add_fact_call(self, name: str, *args, cname=None):
         func = self.rels[name]
         self.fp.fact(func(*args), name=cname)
@@ -93,37 +153,117 @@ class GlobalInfo:
         func = self.core_rels[name]
         self.fp.fact(func(*args), name=cname)
 
-    def pod_value(self, v: int) -> BitVecVal:
-        return BitVecVal(v, self.pod_sort)
+    def add_fact_values(self, func: FuncDeclRef, *values: int):
+        """
+        Ground fact func(values...) over bit-vector arguments given as plain ints
+        Buffered until load_facts in bulk mode, added through the API otherwise
+        """
+        self.add_facts_values(func, [values])
+
+    def add_facts_values(self, func: FuncDeclRef, facts: Iterable[Tuple[int, ...]]):
+        if self.bulk_facts:
+            if id(func) not in self.fact_buffer:
+                self.fact_buffer[id(func)] = (func, [])
+            self.fact_buffer[id(func)][1].extend(facts)
+        else:
+            facts = list(facts)
+            self.loaded_facts.append((func, facts))
+            for values in facts:
+                self.fp.fact(func(*[self.value(v, func.domain(i)) for i, v in enumerate(values)]))
+
+    def get_fact_program(self) -> str:
+        # SMT-LIB/Datalog text of the buffered facts, relations are shared by name and sorts
+        lines = []
+        for func, facts in self.fact_buffer.values():
+            name = "|{}|".format(func.name())
+            sorts = [func.domain(i) for i in range(func.arity())]
+            lines.append("(declare-rel {} ({}))".format(name, " ".join(s.sexpr() for s in sorts)))
+            fmt = "(rule ({} {}))".format(name, " ".join("(_ bv{{}} {})".format(s.size()) for s in sorts))
+            lines.extend(fmt.format(*values) for values in facts)
+        return "\n".join(lines)
+
+    def load_facts(self):
+        """
+        Load all buffered facts with a single parse call instead of one binding call per fact
+        Must be called before querying, build does it
+        """
+        if not self.fact_buffer:
+            return
+        if isinstance(self.fp, DatalogEngine):
+            for func, facts in self.fact_buffer.values():
+                self.fp.add_facts(func, facts)
+        elif self.finite_domain:
+            # finite domain values have no textual syntax, add the raw values instead
+            ctx = self.fp.ctx.ref()
+            for func, facts in self.fact_buffer.values():
+                args = (ctypes.c_uint * func.arity())()
+                for values in facts:
+                    args[:] = values
+                    Z3_fixedpoint_add_fact(ctx, self.fp.fixedpoint, func.ast, func.arity(), args)
+        else:
+            self.fp.parse_string(self.get_fact_program())
+        self.loaded_facts.extend(self.fact_buffer.values())
+        self.fact_buffer = {}
+
+    def value(self, v: int, sort: SortRef) -> ExprRef:
+        if self.finite_domain:
+            return FiniteDomainVal(v, sort)
+        return BitVecVal(v, sort)
+
+    def pod_value(self, v: int) -> ExprRef:
+        return self.value(v, self.pod_sort)
 
-    def nam_value(self, v: int) -> BitVecVal:
-        return BitVecVal(v, self.nam_sort)
+    def nam_value(self, v: int) -> ExprRef:
+        return self.value(v, self.nam_sort)
 
-    def pol_value(self, v: int) -> BitVecVal:
-        return BitVecVal(v, self.pol_sort)
+    def pol_value(self, v: int) -> ExprRef:
+        return self.value(v, self.pol_sort)
 
-    def get_namespace_idx(self, ns: str) -> BitVecVal:
-        return BitVecVal(self.nam_map[ns], self.nam_sort)
+    def get_namespace_idx(self, ns: str) -> ExprRef:
+        return self.value(self.nam_map[ns], self.nam_sort)
 
     def declare_var(self, name, sort, is_Var=False):
         if is_Var:
             var = Var(name, sort)
         else:
             var = Const(name, sort)
-        self.fp.declare_var(var)
+        # fp.rule abstracts over every declared var, declare each one once
+        if var.get_id() not in self.declared_vars:
+            self.declared_vars.add(var.get_id())
+            self.fp.declare_var(var)
         return var
 
 
-def get_fixpoint_engine(**kwargs) -> Fixedpoint:
+# relation backends of the datalog engine (exact ones only, abstract domains over-approximate)
+# NOTE: z3 silently falls back to the default for unknown relation names, hence the fixed table
+RELATION_BACKENDS: Dict[str, Dict[str, str]] = {
+    # z3 default
+    "sparse": {"datalog.default_table": "sparse"},
+    "hashtable": {"datalog.default_table": "hashtable"},
+    "bitvector": {"datalog.default_table": "bitvector"},
+    "interval": {"datalog.default_table": "interval"},
+    # difference-of-cubes relations (the NoD plugin), z3 has no "udoc" relation
+    "doc": {"datalog.default_relation": "doc"},
+}
+
+
+def get_fixpoint_engine(backend: Optional[str] = None, **kwargs) -> Fixedpoint:
+    # engine="python": built-in semi-naive evaluator, no z3 fixedpoint (relation backends do not apply)
+    if kwargs.get("engine") == "python":
+        return DatalogEngine()
+
     fp = Fixedpoint()
     fp_options = {
         "ctrl_c": True,
         "engine": "datalog",
-        # NOTE: this enables NoD plugin (with DoC relations)
-        # "datalog.default_relation": "udoc",
         # NOTE: this must be set false to allow negation to be correctly dealt (verified by Nikolaj Bjorner)
         "datalog.generate_explanations": False,
     }
+    if backend is not None:
+        if backend not in RELATION_BACKENDS:
+            raise ValueError("unknown relation backend {}, expected one of {}".format(
+                backend, ", ".join(RELATION_BACKENDS)))
+        fp_options.update(RELATION_BACKENDS[backend])
     fp_options.update(kwargs)
     fp.set(**fp_options)
     return fp
@@ -133,8 +273,112 @@ def get_smtlib(fp: Fixedpoint, queries: List[Any]) -> str:
     return fp.to_string(queries)
 
 
+class ProgramImage(NamedTuple):
+    """
+    A built program as plain picklable data: rule text, fact tuples and relation signatures
+    restore() rebuilds an equivalent GlobalInfo on a fresh engine (e.g. in another process)
+    without redoing the encoding. Relations are rebound by name, sorts by bit-vector size.
+    Only the default bit-vector encoding on z3: finite domain sorts have no textual syntax
+    """
+    pods: List[PodAdapter]
+    policies: List[PolicyAdapter]
+    namespaces: List[NamespaceAdapter]
+    options: Dict[str, bool]
+    rules: str
+    # (table: rels, ns_rels or core_rels, name, argument sizes)
+    relations: Tuple[Tuple[str, str, Tuple[int, ...]], ...]
+    # (relation name, argument sizes, facts)
+    facts: Tuple[Tuple[str, Tuple[int, ...], List[Tuple[int, ...]]], ...]
+    lit_ids: Dict[str, int]
+    # selector_rels with relations by name, False/None kept
+    selector_rels: Tuple[Tuple[Tuple, Union[str, bool, None]], ...]
+
+    @staticmethod
+    def from_global_info(gi: "GlobalInfo") -> "ProgramImage":
+        if isinstance(gi.fp, DatalogEngine) or gi.finite_domain:
+            raise ValueError("program images need the z3 engine and the bit-vector encoding")
+        gi.load_facts()
+
+        def sizes(func: FuncDeclRef) -> Tuple[int, ...]:
+            return tuple(func.domain(i).size() for i in range(func.arity()))
+
+        relations = tuple(
+            (table, name, sizes(func))
+            for table in ("rels", "ns_rels", "core_rels")
+            for name, func in getattr(gi, table).items())
+        return ProgramImage(
+            gi.pods, gi.policies, gi.namespaces,
+            {
+                "check_self_ingress_traffic": gi.check_self_traffic,
+                "check_select_by_no_policy": gi.check_select_by_any,
+                "ground_default_pod": gi.ground_default_pod,
+            },
+            gi.fp.sexpr(),
+            relations,
+            tuple((func.name(), sizes(func), facts) for func, facts in gi.loaded_facts),
+            dict(gi.lit_ids),
+            tuple(
+                (key, rel.name() if isinstance(rel, FuncDeclRef) else rel)
+                for key, rel in gi.selector_rels.items()))
+
+    def restore(self, **kwargs) -> "GlobalInfo":
+        """
+        kwargs: get_fixpoint_engine options, as given to build
+        """
+        gi = GlobalInfo(get_fixpoint_engine(**kwargs), self.pods, self.policies, self.namespaces, **self.options)
+        gi.fp.parse_string(self.rules)
+
+        # one object per relation: fact_buffer groups facts by id(func)
+        funcs: Dict[str, FuncDeclRef] = {}
+
+        def relation(name: str, sizes: Tuple[int, ...]) -> FuncDeclRef:
+            if name not in funcs:
+                funcs[name] = Function(name, *[BitVecSort(size) for size in sizes], BoolSort())
+            return funcs[name]
+
+        for table, name, sizes in self.relations:
+            getattr(gi, table)[name] = relation(name, sizes)
+        for key, rel in self.selector_rels:
+            gi.selector_rels[key] = funcs[rel] if isinstance(rel, str) else rel
+
+        gi.lit_ids = dict(self.lit_ids)
+        gi.lv_counter = len(gi.lit_ids)
+        for name, sizes, facts in self.facts:
+            gi.add_facts_values(relation(name, sizes), facts)
+        gi.load_facts()
+        return gi
+
+
+def query_name(queries: Union[Any, List[Any]]) -> str:
+    queries = queries if isinstance(queries, list) else [queries]
+    return ",".join(q.decl().name() if is_app(q) else str(q) for q in queries)
+
+
 def get_answer(fp: Fixedpoint, queries: List[Any]) -> Tuple[CheckSatResult, Any]:
-    return (fp.query(queries), fp.get_answer())
+    with metrics.phase("kubesv.solve") as measure:
+        result = (fp.query(queries), fp.get_answer())
+        if metrics.enabled():
+            measure.tags.update(query=query_name(queries), result=str(result[0]))
+            measure.stats.update(metrics.engine_statistics(fp))
+    return result
+
+
+def get_answer_tuples(fp: Fixedpoint, queries: List[Any]) -> Tuple[CheckSatResult, Iterable[Tuple[int, ...]]]:
+    """
+    Like get_answer, with a stream of answer tuples (values of the query vars) instead of the formula
+    The python engine hands over its tuples, z3 answers are decoded by iter_z3_answer
+    """
+    with metrics.phase("kubesv.solve") as measure:
+        result = fp.query(queries)
+        if metrics.enabled():
+            measure.tags.update(query=query_name(queries), result=str(result))
+            measure.stats.update(metrics.engine_statistics(fp))
+    # decoding is streamed, the caller consumes the tuples
+    if isinstance(fp, DatalogEngine):
+        return result, fp.get_answer_tuples()
+    if result != sat:
+        return result, iter(())
+    return result, iter_z3_answer(fp.get_answer())
 
 
 def define_model(gi: GlobalInfo):
@@ -147,11 +391,11 @@ def define_model(gi: GlobalInfo):
     gi.register_relation('is_nam', is_nam, is_core=True)
 
     for i in range(len(gi.policies)):
-        gi.add_fact(is_pol(gi.pol_value(i)))
+        gi.add_fact_values(is_pol, i)
     for i in range(len(gi.pods)):
-        gi.add_fact(is_pod(gi.pod_value(i)))
+        gi.add_fact_values(is_pod, i)
     for i in range(len(gi.namespaces)):
-        gi.add_fact(is_nam(gi.nam_value(i)))
+        gi.add_fact_values(is_nam, i)
 
     # define namespace(pod, value) relation
     namespace = Function('namespace', gi.pod_sort, gi.nam_sort, BoolSort())
@@ -247,8 +491,9 @@ def define_model(gi: GlobalInfo):
     path = Function("path", gi.pod_sort, gi.pod_sort, BoolSort())
     gi.register_relation("path", path, is_core=True)
 
+    # transitive closure of edge (linear recursion, evaluated semi-naively)
     gi.add_rule(path(src, dst), edge(src, dst))
-    gi.add_rule(path(src, dst), [edge(src, sel), edge(sel, dst)])            
+    gi.add_rule(path(src, dst), [path(src, sel), edge(sel, dst)])
 
 
 def define_pod_facts(gi: GlobalInfo):
@@ -259,19 +504,20 @@ def define_pod_facts(gi: GlobalInfo):
     For namespace in pod -> add namespace fact
         namespace: default -> namespace(pod_index, ns_idx)
     """
+    namespace = gi.get_relation_core("namespace")
     for i, pod in enumerate(gi.pods):
-        gi.add_fact_call_core("namespace", gi.pod_value(i), gi.get_namespace_idx(pod.namespace))
+        gi.add_fact_values(namespace, i, gi.nam_map[pod.namespace])
 
         for k, v in pod.labels.items():
             k_exists = "{}__exists".format(k)
 
             if gi.get_relation(k) is None:
                 gi.register_relation(k, Function(k, gi.pod_sort, gi.lv_sort, BoolSort()))
-            gi.add_fact_call(k, gi.pod_value(i), gi.get_or_create_literal(v))
+            gi.add_fact_values(gi.rels[k], i, gi.get_or_create_literal_id(v))
 
             if gi.get_relation(k_exists) is None:
                 gi.register_relation(k_exists, Function(k_exists, gi.pod_sort, BoolSort()))
-            gi.add_fact_call(k_exists, gi.pod_value(i))
+            gi.add_fact_values(gi.rels[k_exists], i)
 
     for i, ns in enumerate(gi.namespaces):
         for k, v in ns.labels.items():
@@ -280,11 +526,11 @@ def define_pod_facts(gi: GlobalInfo):
 
             if gi.get_relation_ns(k_ns) is None:
                 gi.register_relation_ns(k_ns, Function(k, gi.nam_sort, gi.lv_sort, BoolSort()))
-            gi.add_fact_call_ns(k_ns, gi.nam_value(i), gi.get_or_create_literal(v))
+            gi.add_fact_values(gi.ns_rels[k_ns], i, gi.get_or_create_literal_id(v))
 
             if gi.get_relation_ns(k_exists) is None:
                 gi.register_relation_ns(k_exists, Function(k_exists, gi.nam_sort, BoolSort()))
-            gi.add_fact_call_ns(k_exists, gi.nam_value(i))
+            gi.add_fact_values(gi.ns_rels[k_exists], i)
 
 
 def define_pol_facts(gi: GlobalInfo):
@@ -294,6 +540,24 @@ def define_pol_facts(gi: GlobalInfo):
         pol.define_ingress_rules(i, gi)
 
 
+def define_pol_facts_precomputed(gi: GlobalInfo):
+    """
+    Hybrid encoding: selected_by_pol, ingress/egress_allow_by_pol are evaluated with bitsets
+    over the label index and loaded as ground facts, z3 only derives traffic/edges from them
+    """
+    index = SelectionIndex(gi.pods, gi.namespaces, gi.nam_map)
+    selected_by_pol = gi.get_relation_core("selected_by_pol")
+    ingress_allow_by_pol = gi.get_relation_core("ingress_allow_by_pol")
+    egress_allow_by_pol = gi.get_relation_core("egress_allow_by_pol")
+
+    for i, pol in enumerate(gi.policies):
+        for rel, pods in [
+                (selected_by_pol, pol.evaluate_pod_selector(index)),
+                (ingress_allow_by_pol, pol.evaluate_ingress_rules(index)),
+                (egress_allow_by_pol, pol.evaluate_egress_rules(index))]:
+            gi.add_facts_values(rel, ((pod, i) for pod in pods.search(1)))
+
+
 def ground_default_pods(gi: GlobalInfo):
     is_pod = gi.get_relation_core("is_pod")
     ingress_traffic = gi.get_relation_core("ingress_traffic")
@@ -322,16 +586,33 @@ def build(pods: List[PodAdapter],
         nams: List[NamespaceAdapter], 
         check_self_ingress_traffic=True, 
         check_select_by_no_policy=False, 
-        ground_default_pod=False, **kwargs):
+        ground_default_pod=False,
+        bulk_facts=True,
+        finite_domain=False,
+        precompute_selection=False, **kwargs):
     fp = get_fixpoint_engine(**kwargs)
     gi = GlobalInfo(fp, pods, pols, nams, 
         check_self_ingress_traffic=check_self_ingress_traffic, 
         check_select_by_no_policy=check_select_by_no_policy,
-        ground_default_pod=ground_default_pod)
-
-    define_model(gi)
-    define_pod_facts(gi)
-    define_pol_facts(gi)
+        ground_default_pod=ground_default_pod,
+        bulk_facts=bulk_facts,
+        finite_domain=finite_domain)
+
+    with metrics.phase("kubesv.encode") as measure:
+        define_model(gi)
+        define_pod_facts(gi)
+        if precompute_selection:
+            define_pol_facts_precomputed(gi)
+        else:
+            define_pol_facts(gi)
+        if metrics.enabled():
+            measure.counts.update(
+                pods=len(pods), policies=len(pols), namespaces=len(nams),
+                rules=gi.n_rules, facts=gi.count_facts(), relations=gi.count_relations())
+    with metrics.phase("kubesv.load_facts") as measure:
+        if metrics.enabled():
+            measure.counts["facts"] = sum(len(facts) for _, facts in gi.fact_buffer.values())
+        gi.load_facts()
 
     if check_select_by_no_policy and ground_default_pod:
         ground_default_pods(gi)
@@ -0,0 +1,595 @@
+"""
+Pure python Datalog evaluator with bitset relations.
+Drop-in for the parts of z3.Fixedpoint used by kubesv (register_relation/declare_var/fact/rule/query/get_answer).
+Rules are z3 expressions, evaluated bottom-up: stratified negation, semi-naive iteration for recursive strata.
+Relations have arity <= 2 over small integer domains:
+    arity 0/1: an int bitmask
+    arity 2:   rows, first argument -> int bitmask of second arguments
+"""
+import z3
+
+from typing import *
+from typing_extensions import *
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class Relation:
+
+    def __init__(self, arity: int):
+        if arity > 2:
+            raise NotImplementedError("relations of arity > 2 are not supported")
+        self.arity = arity
+        # arity 0/1
+        self.mask = 0
+        # arity 2
+        self.rows: Dict[int, int] = {}
+        self._cols: Optional[Dict[int, int]] = None
+        self._first: Optional[int] = None
+        self._second: Optional[int] = None
+
+    def copy(self) -> "Relation":
+        rel = Relation(self.arity)
+        rel.mask = self.mask
+        rel.rows = dict(self.rows)
+        return rel
+
+    def changed(self):
+        self._cols = None
+        self._first = None
+        self._second = None
+
+    def __len__(self) -> int:
+        if self.arity < 2:
+            return bin(self.mask).count("1")
+        return sum(bin(row).count("1") for row in self.rows.values())
+
+    def __bool__(self) -> bool:
+        return self.mask != 0 or any(self.rows.values())
+
+    def add_mask(self, mask: int) -> int:
+        # arity 0/1, return the new bits
+        new = mask & ~self.mask
+        self.mask |= new
+        return new
+
+    def add_row(self, a: int, mask: int) -> int:
+        # arity 2: (a, b) for every b in mask, return the new bits
+        old = self.rows.get(a, 0)
+        new = mask & ~old
+        if new:
+            self.rows[a] = old | new
+            self.changed()
+        return new
+
+    def add(self, values: Tuple[int, ...]) -> bool:
+        if self.arity == 2:
+            return self.add_row(values[0], 1 << values[1]) != 0
+        if self.arity == 1:
+            return self.add_mask(1 << values[0]) != 0
+        return self.add_mask(1) != 0
+
+    def contains(self, values: Tuple[int, ...]) -> bool:
+        if self.arity == 2:
+            return (self.rows.get(values[0], 0) >> values[1]) & 1 == 1
+        if self.arity == 1:
+            return (self.mask >> values[0]) & 1 == 1
+        return self.mask == 1
+
+    def row(self, a: int) -> int:
+        return self.rows.get(a, 0)
+
+    def col(self, b: int) -> int:
+        if self._cols is None:
+            cols = {}
+            for a, row in self.rows.items():
+                bit = 1 << a
+                for b_ in iter_bits(row):
+                    cols[b_] = cols.get(b_, 0) | bit
+            self._cols = cols
+        return self._cols.get(b, 0)
+
+    def first(self) -> int:
+        # projection on the first argument
+        if self._first is None:
+            self._first = 0
+            for a, row in self.rows.items():
+                if row:
+                    self._first |= 1 << a
+        return self._first
+
+    def second(self) -> int:
+        # projection on the second argument
+        if self._second is None:
+            self._second = 0
+            for row in self.rows.values():
+                self._second |= row
+        return self._second
+
+    def diagonal(self) -> int:
+        mask = 0
+        for a, row in self.rows.items():
+            if (row >> a) & 1:
+                mask |= 1 << a
+        return mask
+
+    def tuples(self) -> Iterator[Tuple[int, ...]]:
+        if self.arity == 2:
+            for a in sorted(self.rows):
+                for b in iter_bits(self.rows[a]):
+                    yield (a, b)
+        elif self.arity == 1:
+            for a in iter_bits(self.mask):
+                yield (a,)
+        elif self.mask:
+            yield ()
+
+
+class Var:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+# an argument is either a Var or an int value
+Term = Union[Var, int]
+
+
+class Atom:
+    __slots__ = ("rel", "args", "negated")
+
+    def __init__(self, rel: int, args: Tuple[Term, ...], negated=False):
+        self.rel = rel
+        self.args = args
+        self.negated = negated
+
+    @property
+    def vars(self) -> Set[Var]:
+        return {a for a in self.args if isinstance(a, Var)}
+
+
+class Compare:
+    __slots__ = ("lhs", "rhs", "equal")
+
+    def __init__(self, lhs: Term, rhs: Term, equal: bool):
+        self.lhs = lhs
+        self.rhs = rhs
+        self.equal = equal
+
+    @property
+    def vars(self) -> Set[Var]:
+        return {a for a in (self.lhs, self.rhs) if isinstance(a, Var)}
+
+
+class Rule:
+    """
+    head :- body, compiled to a binding order: every variable but the last one is enumerated,
+    the candidates of the last variable are computed as one bitmask
+    """
+
+    def __init__(self, head: Atom, body: List[Union[Atom, Compare]]):
+        self.head = head
+        self.atoms = [lit for lit in body if isinstance(lit, Atom) and not lit.negated]
+        self.filters = [lit for lit in body if not (isinstance(lit, Atom) and not lit.negated)]
+
+        variables = set()
+        for atom in self.atoms:
+            variables |= atom.vars
+        for lit in self.filters + [head]:
+            if not lit.vars <= variables:
+                raise ValueError("unsafe rule, variables {} are not bound by a positive atom".format(
+                    lit.vars - variables))
+
+        self.order = self.binding_order(variables)
+        # literals are checked when their last variable gets bound, ground ones up front
+        self.steps: List[Tuple[List[Atom], List[Atom], List[Union[Atom, Compare]]]] = []
+        bound = set()
+        for v in self.order:
+            bound.add(v)
+            # positive atoms constraining v given the bound variables, projections otherwise
+            complete = [a for a in self.atoms if v in a.vars and a.vars <= bound]
+            partial = [a for a in self.atoms if v in a.vars and not a.vars <= bound]
+            checks = [lit for lit in self.filters if v in lit.vars and lit.vars <= bound]
+            self.steps.append((complete, partial, checks))
+        self.ground_atoms = [a for a in self.atoms if not a.vars]
+        self.ground_filters = [lit for lit in self.filters if not lit.vars]
+
+    def binding_order(self, variables: Set[Var]) -> List[Var]:
+        # prefer the last head variable as the vectorized one, so that a head row is or-ed at once
+        last = None
+        for arg in reversed(self.head.args):
+            if isinstance(arg, Var):
+                last = arg
+                break
+        if last is None and variables:
+            last = max(variables, key=lambda v: sum(v in a.vars for a in self.atoms))
+
+        order = []
+        bound = set()
+        rest = variables - {last}
+        while rest:
+            def score(v):
+                complete = sum(v in a.vars and a.vars - {v} <= bound for a in self.atoms)
+                occurs = sum(v in a.vars for a in self.atoms)
+                return (complete, occurs, v.name)
+            v = max(rest, key=score)
+            order.append(v)
+            bound.add(v)
+            rest.remove(v)
+        if last is not None:
+            order.append(last)
+        return order
+
+
+class DatalogEngine:
+    """
+    Pure python fixedpoint engine, z3.Fixedpoint compatible for kubesv
+    """
+
+    def __init__(self):
+        self.options: Dict[str, Any] = {}
+        self.decls: Dict[int, z3.FuncDeclRef] = {}
+        self.base: Dict[int, Relation] = {}
+        self.rules: List[Rule] = []
+        self.vars: Dict[int, Var] = {}
+        # derived relations and the ones already evaluated, valid until facts change
+        # or a rule is added to an evaluated relation
+        self.relations: Optional[Dict[int, Relation]] = None
+        self.complete: Set[int] = set()
+        self.answer: Optional[Tuple[z3.FuncDeclRef, List[Tuple[int, ...]], List[int]]] = None
+
+    # Fixedpoint API
+
+    def set(self, *args, **kwargs):
+        self.options.update(kwargs)
+
+    def register_relation(self, *funcs: z3.FuncDeclRef):
+        for func in funcs:
+            key = func.get_id()
+            if key not in self.decls:
+                self.decls[key] = func
+                self.base[key] = Relation(func.arity())
+
+    def declare_var(self, *vars: z3.ExprRef):
+        for var in vars:
+            self.term(var)
+
+    def fact(self, head: z3.BoolRef, name=None):
+        self.rule(head, None, name)
+
+    def rule(self, head: z3.BoolRef, body=None, name=None):
+        head = self.atom(head)
+        if body is None and not head.vars:
+            self.base[head.rel].add(head.args)
+            self.relations = None
+        else:
+            self.rules.append(Rule(head, self.body(body)))
+            if head.rel in self.complete:
+                self.relations = None
+
+    def add_facts(self, func: z3.FuncDeclRef, facts: Iterable[Tuple[int, ...]]):
+        # ground facts as plain ints, see GlobalInfo.load_facts
+        self.register_relation(func)
+        rel = self.base[func.get_id()]
+        for values in facts:
+            rel.add(values)
+        self.relations = None
+
+    def query(self, *query) -> z3.CheckSatResult:
+        if len(query) == 1 and isinstance(query[0], (list, tuple)):
+            query = query[0]
+        if len(query) != 1:
+            raise NotImplementedError("only single atom queries are supported")
+        atom = self.atom(query[0])
+        rel = self.evaluate([atom.rel])[atom.rel]
+
+        # answer positions are the (distinct) query variables in argument order
+        positions = []
+        seen = {}
+        for i, arg in enumerate(atom.args):
+            if isinstance(arg, Var) and arg not in seen:
+                seen[arg] = i
+                positions.append(i)
+        answers = []
+        for values in rel.tuples():
+            if all(values[i] == arg if not isinstance(arg, Var) else values[i] == values[seen[arg]]
+                    for i, arg in enumerate(atom.args)):
+                answers.append(tuple(values[i] for i in positions))
+        self.answer = (self.decls[atom.rel], answers, positions)
+        return z3.sat if answers else z3.unsat
+
+    def get_answer_tuples(self) -> List[Tuple[int, ...]]:
+        return self.answer[1]
+
+    def get_answer(self) -> z3.BoolRef:
+        """
+        Same shape as z3: Or(And(Var(0) == v0, Var(1) == v1, ...), ...)
+        """
+        func, answers, positions = self.answer
+        if not answers:
+            return z3.BoolVal(False)
+        sorts = [func.domain(i) for i in positions]
+        variables = [z3.Var(i, s) for i, s in enumerate(sorts)]
+
+        def value(v, s):
+            if s.kind() == z3.Z3_FINITE_DOMAIN_SORT:
+                return z3.FiniteDomainVal(v, s)
+            return z3.BitVecVal(v, s)
+
+        def eq(var, val):
+            # NOTE: not var == val, z3py would put the value first
+            return z3.BoolRef(z3.Z3_mk_eq(var.ctx_ref(), var.as_ast(), val.as_ast()), var.ctx)
+
+        disjuncts = []
+        for values in answers:
+            eqs = [eq(var, value(v, s)) for var, v, s in zip(variables, values, sorts)]
+            disjuncts.append(eqs[0] if len(eqs) == 1 else z3.And(*eqs))
+        if len(disjuncts) == 1:
+            return disjuncts[0]
+        return z3.Or(*disjuncts)
+
+    # translation from z3 expressions
+
+    def term(self, e: z3.ExprRef) -> Term:
+        if z3.is_bv_value(e) or z3.is_finite_domain_value(e):
+            return e.as_long()
+        if z3.is_const(e) and e.decl().kind() == z3.Z3_OP_UNINTERPRETED:
+            key = e.get_id()
+            if key not in self.vars:
+                self.vars[key] = Var(str(e))
+            return self.vars[key]
+        raise NotImplementedError("unsupported term {}".format(e))
+
+    def atom(self, e: z3.BoolRef, negated=False) -> Atom:
+        key = e.decl().get_id()
+        if key not in self.decls:
+            raise ValueError("unregistered relation {}".format(e.decl()))
+        return Atom(key, tuple(self.term(e.arg(i)) for i in range(e.num_args())), negated)
+
+    def body(self, body) -> List[Union[Atom, Compare]]:
+        if body is None:
+            return []
+        if not isinstance(body, (list, tuple)):
+            body = [body]
+        literals = []
+        for e in body:
+            if z3.is_and(e):
+                literals.extend(self.body(e.children()))
+            elif z3.is_true(e):
+                continue
+            elif z3.is_not(e):
+                inner = e.arg(0)
+                if z3.is_eq(inner):
+                    literals.append(Compare(self.term(inner.arg(0)), self.term(inner.arg(1)), False))
+                else:
+                    literals.append(self.atom(inner, negated=True))
+            elif z3.is_eq(e):
+                literals.append(Compare(self.term(e.arg(0)), self.term(e.arg(1)), True))
+            elif z3.is_distinct(e) and e.num_args() == 2:
+                literals.append(Compare(self.term(e.arg(0)), self.term(e.arg(1)), False))
+            else:
+                literals.append(self.atom(e))
+        return literals
+
+    # evaluation
+
+    def strata(self, roots: Optional[Iterable[int]] = None) -> List[Tuple[Set[int], List[Rule], bool]]:
+        """
+        Strongly connected components of the dependency graph in evaluation order,
+        each with its rules and whether it is recursive; negation inside a component is rejected
+        Only the components roots depend on if given
+        """
+        deps: Dict[int, Set[int]] = {key: set() for key in self.decls}
+        for rule in self.rules:
+            for lit in rule.atoms + rule.filters:
+                if isinstance(lit, Atom):
+                    deps[rule.head.rel].add(lit.rel)
+
+        # Tarjan, components come out dependencies first
+        index: Dict[int, int] = {}
+        low: Dict[int, int] = {}
+        stack: List[int] = []
+        on_stack: Set[int] = set()
+        components: List[Set[int]] = []
+
+        def connect(v):
+            index[v] = low[v] = len(index)
+            stack.append(v)
+            on_stack.add(v)
+            for w in deps[v]:
+                if w not in index:
+                    connect(w)
+                    low[v] = min(low[v], low[w])
+                elif w in on_stack:
+                    low[v] = min(low[v], index[w])
+            if low[v] == index[v]:
+                component = set()
+                while True:
+                    w = stack.pop()
+                    on_stack.remove(w)
+                    component.add(w)
+                    if w == v:
+                        break
+                components.append(component)
+
+        for v in (deps if roots is None else roots):
+            if v not in index:
+                connect(v)
+
+        strata = []
+        for component in components:
+            rules = [r for r in self.rules if r.head.rel in component]
+            recursive = False
+            for rule in rules:
+                for lit in rule.atoms + rule.filters:
+                    if isinstance(lit, Atom) and lit.rel in component:
+                        if lit.negated:
+                            raise ValueError("negation of {} is not stratified".format(self.decls[lit.rel]))
+                        recursive = True
+            strata.append((component, rules, recursive))
+        return strata
+
+    def evaluate(self, roots: Optional[Iterable[int]] = None) -> Dict[int, Relation]:
+        """
+        Derive the relations roots depend on (all relations if not given)
+        """
+        if self.relations is None:
+            self.relations = {}
+            self.complete = set()
+        relations = self.relations
+        for key, rel in self.base.items():
+            if key not in relations:
+                relations[key] = rel.copy()
+
+        for component, rules, recursive in self.strata(roots):
+            # queries add rules for new relations only, earlier strata stay valid
+            if component <= self.complete:
+                continue
+            self.complete |= component
+            if not recursive:
+                for rule in rules:
+                    self.apply(rule, relations, relations)
+                continue
+
+            # semi-naive: every round joins at least one atom with the tuples of the previous round
+            delta = {key: Relation(relations[key].arity) for key in component}
+            for rule in rules:
+                self.apply(rule, relations, delta)
+            while any(delta.values()):
+                new_delta = {key: Relation(relations[key].arity) for key in component}
+                for rule in rules:
+                    for i, atom in enumerate(rule.atoms):
+                        if atom.rel in component and delta[atom.rel]:
+                            self.apply(rule, relations, new_delta, {i: delta[atom.rel]})
+                delta = new_delta
+        return relations
+
+    def apply(self, rule: Rule,
+            relations: Dict[int, Relation],
+            delta: Dict[int, Relation],
+            override: Optional[Dict[int, Relation]] = None):
+        """
+        Derive the head of rule into relations, new tuples are also added to delta
+        override replaces the relation of the i-th positive atom (semi-naive delta)
+        """
+        overridden: Dict[int, Relation] = {}
+        if override is not None:
+            for i, rel in override.items():
+                overridden[id(rule.atoms[i])] = rel
+
+        def relation(atom: Atom) -> Relation:
+            rel = overridden.get(id(atom))
+            if rel is None:
+                return relations[atom.rel]
+            return rel
+
+        env: Dict[Var, int] = {}
+
+        def value(t: Term) -> int:
+            return env[t] if isinstance(t, Var) else t
+
+        def holds(lit) -> bool:
+            if isinstance(lit, Compare):
+                return (value(lit.lhs) == value(lit.rhs)) == lit.equal
+            return relation(lit).contains(tuple(map(value, lit.args))) != lit.negated
+
+        if not all(holds(a) for a in rule.ground_atoms) or not all(holds(f) for f in rule.ground_filters):
+            return
+
+        def candidates(atom: Atom, v: Var, complete: bool) -> int:
+            rel = relation(atom)
+            args = atom.args
+            if rel.arity == 1:
+                return rel.mask
+            if args[0] is v and args[1] is v:
+                return rel.diagonal() if complete else rel.first() & rel.second()
+            if args[0] is v:
+                if complete:
+                    return rel.col(value(args[1]))
+                return rel.first()
+            if complete:
+                return rel.row(value(args[0]))
+            return rel.second()
+
+        head = rule.head
+        head_rel = relations[head.rel]
+        new_rel = delta.get(head.rel)
+        order = rule.order
+        last = len(order) - 1
+
+        def derive(mask: int):
+            # all variables but the last one are bound, mask holds the values of the last one
+            v = order[last] if order else None
+            args = head.args
+            if head_rel.arity == 0:
+                if head_rel.add_mask(1) and new_rel is not None and new_rel is not head_rel:
+                    new_rel.add_mask(1)
+                return
+            if v is None or v not in args:
+                values = tuple(map(value, args))
+                if head_rel.add(values) and new_rel is not None and new_rel is not head_rel:
+                    new_rel.add(values)
+                return
+            if head_rel.arity == 1:
+                new = head_rel.add_mask(mask)
+                if new and new_rel is not None and new_rel is not head_rel:
+                    new_rel.add_mask(new)
+            elif args[1] is v and args[0] is not v:
+                a = value(args[0])
+                new = head_rel.add_row(a, mask)
+                if new and new_rel is not None and new_rel is not head_rel:
+                    new_rel.add_row(a, new)
+            else:
+                for x in iter_bits(mask):
+                    env[v] = x
+                    values = tuple(map(value, args))
+                    if head_rel.add(values) and new_rel is not None and new_rel is not head_rel:
+                        new_rel.add(values)
+                del env[v]
+
+        def bind(step: int):
+            if step > last:
+                derive(0)
+                return
+            v = order[step]
+            complete, partial, checks = rule.steps[step]
+            mask = -1
+            for atom in complete:
+                mask &= candidates(atom, v, True)
+                if not mask:
+                    return
+            for atom in partial:
+                mask &= candidates(atom, v, False)
+                if not mask:
+                    return
+            for lit in checks:
+                if isinstance(lit, Compare):
+                    other = lit.rhs if lit.lhs is v else lit.lhs
+                    if other is v:
+                        if not lit.equal:
+                            return
+                        continue
+                    bit = 1 << value(other)
+                    mask = mask & bit if lit.equal else mask & ~bit
+                else:
+                    mask &= ~candidates(lit, v, True)
+                if not mask:
+                    return
+            if step == last:
+                derive(mask)
+                return
+            for x in iter_bits(mask):
+                env[v] = x
+                bind(step + 1)
+            del env[v]
+
+        bind(0)
@@ -0,0 +1,284 @@
+"""
+Phase instrumentation: parsing, encoding, solving and decoding (kubesv), matrix building and
+the algorithms (kano) report structured events to the registered sinks.
+Nothing is measured or collected while no sink is registered.
+
+Memory is opt-in (tracemalloc slows python down): inside profile_memory(), events also carry the
+peak and retained memory of the phase, python objects (tracemalloc) and process RSS (native z3 memory)
+
+    with metrics.profile_memory(), metrics.collect() as events:
+        gi = build(pods, pols, nams)
+    for event in events:
+        print(event.name, event.memory["python_peak"], event.memory["rss_peak"])
+
+    with metrics.collect() as events:
+        gi = build(pods, pols, nams)
+        all_isolated_native(gi)
+    for event in events:
+        print(event.name, event.elapsed, event.counts)
+"""
+import json
+import os
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter, time
+from typing import *
+from typing_extensions import *
+
+
+class Event(NamedTuple):
+    """
+    name: "<engine>.<phase>", e.g. kubesv.encode, kubesv.solve, kano.build, kano.policy_shadow
+    counts: sizes of the inputs/outputs (pods, rules, facts, tuples, ...)
+    stats: engine statistics (z3 fp.statistics() for kubesv.solve, cumulative over the fixedpoint)
+    tags: what was measured, e.g. the queried relation
+    memory: bytes, see measure_memory (empty unless profiling memory)
+    """
+    name: str
+    timestamp: float
+    elapsed: float
+    counts: Dict[str, int]
+    stats: Dict[str, Any]
+    tags: Dict[str, str]
+    memory: Dict[str, int]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+Sink = Callable[[Event], None]
+
+SINKS: List[Sink] = []
+
+
+def enabled() -> bool:
+    return bool(SINKS)
+
+
+def add_sink(sink: Sink) -> Sink:
+    SINKS.append(sink)
+    return sink
+
+
+def remove_sink(sink: Sink):
+    SINKS.remove(sink)
+
+
+def emit(event: Event):
+    for sink in SINKS:
+        sink(event)
+
+
+class ListSink:
+    def __init__(self):
+        self.events: List[Event] = []
+
+    def __call__(self, event: Event):
+        self.events.append(event)
+
+
+class JsonLinesSink:
+    """
+    One JSON object per event, e.g. to a file or sys.stderr
+    """
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    def __call__(self, event: Event):
+        self.stream.write(json.dumps(event.to_dict(), default=str))
+        self.stream.write("\n")
+
+
+@contextmanager
+def collect() -> Iterator[List[Event]]:
+    """
+    Events emitted inside the block, in order
+    """
+    sink = add_sink(ListSink())
+    try:
+        yield sink.events
+    finally:
+        remove_sink(sink)
+
+
+class Phase:
+    """
+    Filled in by the measured code: counts, stats and tags of the event
+    """
+    __slots__ = ("counts", "stats", "tags")
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self.stats: Dict[str, Any] = {}
+        self.tags: Dict[str, str] = {}
+
+
+@contextmanager
+def phase(name: str) -> Iterator[Phase]:
+    """
+    Emit one event for the block (also when it raises), check enabled() before computing costly counts
+    """
+    if not SINKS:
+        yield Phase()
+        return
+    measure, memory = Phase(), {}
+    timestamp, start = time(), perf_counter()
+    try:
+        with measure_memory(memory):
+            yield measure
+    finally:
+        emit(Event(name, timestamp, perf_counter() - start, measure.counts, measure.stats, measure.tags, memory))
+
+
+def count_result(result: Any) -> Dict[str, int]:
+    # (sat, answers) of the kubesv checks, collections of the kano algorithms
+    if isinstance(result, tuple) and len(result) == 2 and not hasattr(result[0], "__len__"):
+        result = result[1]
+    try:
+        return {"results": len(result)}
+    except TypeError:
+        return {}
+
+
+def instrument(name: str, count: Callable[[Any], Dict[str, int]] = count_result):
+    """
+    Decorator, one event per call with the counts of the result
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not SINKS:
+                return func(*args, **kwargs)
+            with phase(name) as measure:
+                result = func(*args, **kwargs)
+                measure.counts.update(count(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def engine_statistics(fp) -> Dict[str, Any]:
+    """
+    z3 fp.statistics() as a dict, empty for engines without statistics
+    """
+    statistics = getattr(fp, "statistics", None)
+    if statistics is None:
+        return {}
+    stats = statistics()
+    return {key: stats.get_key_value(key) for key in stats.keys()}
+
+
+# memory profiling, phases nest: a frame per open phase, [start, peak] of tracemalloc and RSS
+MEMORY_FRAMES: List[List[int]] = []
+memory_profiling = False
+
+
+def rss() -> Optional[int]:
+    """
+    Resident set size of the process in bytes, None where unknown
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def peak_rss() -> Optional[int]:
+    """
+    RSS high-water mark in bytes (since the last reset_peak_rss on linux, the process lifetime elsewhere)
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def reset_peak_rss():
+    # linux only: the high-water mark restarts from the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+@contextmanager
+def profile_memory(nframes=1) -> Iterator[None]:
+    """
+    Phases measure their memory inside the block, tracemalloc is started for it unless it already runs
+    """
+    global memory_profiling
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(nframes)
+    previous, memory_profiling = memory_profiling, True
+    try:
+        yield
+    finally:
+        memory_profiling = previous
+        if started:
+            tracemalloc.stop()
+
+
+def memory_enabled() -> bool:
+    return memory_profiling
+
+
+def memory_checkpoint() -> Tuple[int, Optional[int]]:
+    """
+    Fold the peaks so far into the open frames and restart the peaks, (python, rss) currently in use
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    rss_now, rss_peak = rss(), peak_rss()
+    for frame in MEMORY_FRAMES:
+        frame[1] = max(frame[1], peak)
+        if rss_peak is not None:
+            frame[3] = max(frame[3], rss_peak)
+    tracemalloc.reset_peak()
+    reset_peak_rss()
+    return current, rss_now
+
+
+@contextmanager
+def measure_memory(out: Dict[str, int]) -> Iterator[Dict[str, int]]:
+    """
+    Fills out (when profiling memory) with the bytes allocated by the block:
+        python_peak / python_retained: tracemalloc peak and still allocated, over the usage at entry
+        rss_peak / rss_retained: the same for the process RSS, includes z3 and bitarray buffers
+    Peaks of nested blocks are included in the enclosing ones
+    """
+    if not memory_profiling or not tracemalloc.is_tracing():
+        yield out
+        return
+    current, rss_now = memory_checkpoint()
+    rss_start = rss_now or 0
+    frame = [current, current, rss_start, rss_start]
+    MEMORY_FRAMES.append(frame)
+    try:
+        yield out
+    finally:
+        current, rss_now = memory_checkpoint()
+        MEMORY_FRAMES.remove(frame)
+        out["python_peak"] = frame[1] - frame[0]
+        out["python_retained"] = current - frame[0]
+        if rss_now is not None:
+            out["rss_peak"] = max(frame[3], rss_now) - frame[2]
+            out["rss_retained"] = rss_now - frame[2]
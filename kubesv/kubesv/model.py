@@ -3,8 +3,11 @@ k8s configuration models
 use kubernetes.client.models + adapter
 """
 import ipaddress
+import sys
 import z3
 
+from bitarray import bitarray
+from bitarray.util import zeros, ones
 from pprint import pprint
 from dataclasses import dataclass
 from typing import *
@@ -124,6 +127,505 @@ class InRelation:
         }
 
 
+class LabelIndex:
+    """
+    Bitsets over a list of labeled objects (pods or namespaces), bit i is the i-th object
+    """
+
+    def __init__(self, labels: List[Dict[str, str]]):
+        self.size = len(labels)
+        self.keys: Dict[str, bitarray] = {}
+        self.values: Dict[str, Dict[str, bitarray]] = {}
+        for i, ls in enumerate(labels):
+            for k, v in ls.items():
+                if k not in self.keys:
+                    self.keys[k] = zeros(self.size)
+                    self.values[k] = {}
+                self.keys[k][i] = 1
+                if v not in self.values[k]:
+                    self.values[k][v] = zeros(self.size)
+                self.values[k][v][i] = 1
+        # evaluated selectors by canonical form
+        self.selectors: Dict[Tuple, bitarray] = {}
+
+    def all(self) -> bitarray:
+        return ones(self.size)
+
+    def none(self) -> bitarray:
+        return zeros(self.size)
+
+    def has_key(self, k: str) -> bool:
+        return k in self.keys
+
+    def key(self, k: str) -> bitarray:
+        return self.keys[k]
+
+    def value(self, k: str, v: str) -> bitarray:
+        if v not in self.values[k]:
+            return self.none()
+        return self.values[k][v]
+
+
+class SelectionIndex:
+    """
+    Pod and namespace label indexes, used to evaluate selectors in python instead of z3 rules
+    """
+
+    def __init__(self, pods: List["PodAdapter"], namespaces: List[NamespaceAdapter], nam_map: Dict[str, int]):
+        self.pods = LabelIndex([pod.labels for pod in pods])
+        self.namespaces = LabelIndex([ns.labels for ns in namespaces])
+        self.nam_map = nam_map
+        # pods of each namespace
+        self.members = [zeros(len(pods)) for _ in namespaces]
+        for i, pod in enumerate(pods):
+            self.members[nam_map[pod.namespace]][i] = 1
+
+    def in_namespaces(self, nams: bitarray) -> bitarray:
+        pods = self.pods.none()
+        for n in nams.search(1):
+            pods |= self.members[n]
+        return pods
+
+
+IPAddress = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+# (operator, key, sorted values), values are empty for Exists/DoesNotExist
+Requirement = Tuple[int, str, Tuple[str, ...]]
+# (port number or name, protocol, end port), port None matches all ports
+Port = Tuple[Optional[Union[int, str]], str, Optional[int]]
+
+def intern_all(strs: Iterable[Any]) -> List[str]:
+    # label keys/values repeat across objects, share one string each
+    return [sys.intern(str(v)) for v in strs]
+
+
+def intern_labels(labels: Optional[Dict[str, Any]]) -> Dict[str, str]:
+    return {sys.intern(k): sys.intern(str(v)) for k, v in (labels or {}).items()}
+
+
+OPERATORS = {
+    "in": InRelation.IN,
+    "notin": InRelation.NOT_IN,
+    "exists": ExistRelation.EXISTS,
+    "doesnotexist": ExistRelation.DOES_NOT_EXISTS,
+    # spelling used by the samples
+    "doesnotexists": ExistRelation.DOES_NOT_EXISTS,
+}
+
+
+class SelectorIR(NamedTuple):
+    """
+    Compiled label selector, requirements in canonical (sorted, deduplicated) order
+    A matchLabels k: v is In(k, (v,)), an empty selector has no requirement
+    Selectors with the same IR select the same objects
+    """
+    requirements: Tuple[Requirement, ...]
+
+    @staticmethod
+    def from_model(selector: V1LabelSelector) -> "SelectorIR":
+        return SelectorIR.from_requirements(
+            ((expr.operator, expr.key, expr.values) for expr in selector.match_expressions or []),
+            selector.match_labels)
+
+    @staticmethod
+    def from_dict(selector: Dict[str, Any]) -> "SelectorIR":
+        return SelectorIR.from_requirements(
+            ((expr["operator"], expr["key"], expr.get("values")) for expr in selector.get("matchExpressions") or []),
+            selector.get("matchLabels"))
+
+    @staticmethod
+    def from_requirements(expressions: Iterable[Tuple[str, str, Optional[List[str]]]],
+            match_labels: Optional[Dict[str, str]]) -> "SelectorIR":
+        requirements = set()
+        for operator_name, key, values in expressions:
+            operator = OPERATORS.get(operator_name.lower())
+            if operator is None:
+                raise ValueError("unknown label selector operator: {}".format(operator_name))
+            if operator in (InRelation.IN, InRelation.NOT_IN):
+                values = tuple(sorted(set(intern_all(values or []))))
+            else:
+                values = ()
+            requirements.add((operator, sys.intern(key), values))
+        for k, v in (match_labels or {}).items():
+            requirements.add((InRelation.IN, sys.intern(k), (sys.intern(str(v)),)))
+        return SelectorIR(tuple(sorted(requirements)))
+
+    def define(self, gi, var, rhs: List[Any], is_namespace=False) -> bool:
+        """
+        Return a boolean value indicating quick fail -> no possible key
+        Identical selectors share one relation, compiled on first use (see define_relation)
+        """
+        key = (is_namespace, self)
+        if key not in gi.selector_rels:
+            gi.selector_rels[key] = self.define_relation(gi, is_namespace)
+        compiled = gi.selector_rels[key]
+
+        # quick fail, no possible match
+        if compiled is False:
+            return True
+        # empty selector, no constraint
+        if compiled is not None:
+            rhs.append(compiled(var))
+        return False
+
+    def define_relation(self, gi, is_namespace=False) -> Union[bool, Optional[z3.FuncDeclRef]]:
+        """
+        selector_<n>_<pod|namespace>(var) :- requirements
+        Return False on quick fail (a key no object has), None if there is no requirement
+        """
+        kind = "namespace" if is_namespace else "pod"
+        sort = gi.nam_sort if is_namespace else gi.pod_sort
+        var = gi.declare_var("selector_{}_var".format(kind), sort)
+
+        body = []
+        for operator, key, values in self.requirements:
+            if is_namespace:
+                key_label = gi.get_relation_ns("{}__namespace".format(key))
+                key_label_exists = gi.get_relation_ns("{}__namespace__exists".format(key))
+            else:
+                key_label = gi.get_relation(key)
+                key_label_exists = gi.get_relation("{}__exists".format(key))
+            # quick fail, no possible match
+            if key_label is None or key_label_exists is None:
+                return False
+
+            if operator == ExistRelation.EXISTS:
+                body.append(key_label_exists(var))
+            elif operator == ExistRelation.DOES_NOT_EXISTS:
+                body.append(z3.Not(key_label_exists(var)))
+            elif operator == InRelation.IN and len(values) == 1:
+                body.append(key_label(var, gi.get_or_create_literal(values[0])))
+            else:
+                in_key = ("in", is_namespace, key, values)
+                if in_key not in gi.selector_rels:
+                    in_func_name = "{}_in_{}_{}".format(key, len(gi.selector_rels), kind)
+                    in_func = z3.Function(in_func_name, sort, z3.BoolSort())
+                    gi.register_relation(in_func_name, in_func, is_core=True)
+                    for v in values:
+                        gi.add_rule(in_func(var), key_label(var, gi.get_or_create_literal(v)))
+                    gi.selector_rels[in_key] = in_func
+                in_func = gi.selector_rels[in_key]
+
+                if operator == InRelation.IN:
+                    body.append(in_func(var))
+                else:
+                    body.append(z3.Not(in_func(var)))
+
+        if not body:
+            return None
+        # negations only: bind var to the domain
+        if all(z3.is_not(literal) for literal in body):
+            body.insert(0, gi.get_relation_core("is_nam" if is_namespace else "is_pod")(var))
+
+        name = "selector_{}_{}".format(len(gi.selector_rels), kind)
+        selector = z3.Function(name, sort, z3.BoolSort())
+        gi.register_relation(name, selector, is_core=True)
+        gi.add_rule(selector(var), body)
+        return selector
+
+    def evaluate(self, index: LabelIndex) -> bitarray:
+        """
+        Same semantics as define, evaluated on the label index
+        A key no object has is a quick fail -> matches nothing
+        NOTE: the result is cached per selector, do not modify it
+        """
+        if self in index.selectors:
+            return index.selectors[self]
+
+        result = index.all()
+        for operator, k, values in self.requirements:
+            if not index.has_key(k):
+                result = index.none()
+                break
+
+            if operator == ExistRelation.EXISTS:
+                result &= index.key(k)
+            elif operator == ExistRelation.DOES_NOT_EXISTS:
+                result &= ~index.key(k)
+            else:
+                in_values = index.none()
+                for v in values:
+                    in_values |= index.value(k, v)
+                if operator == InRelation.IN:
+                    result &= in_values
+                else:
+                    result &= ~in_values
+
+        index.selectors[self] = result
+        return result
+
+
+class PeerIR(NamedTuple):
+    """
+    Compiled policy peer, a None selector is an absent field
+    """
+    pod_selector: Optional[SelectorIR]
+    namespace_selector: Optional[SelectorIR]
+    ip_block: Optional[Tuple[IPAddress, Tuple[IPAddress, ...]]]
+
+    @staticmethod
+    def from_model(peer: V1NetworkPolicyPeer) -> "PeerIR":
+        ip_block = None
+        if peer.ip_block is not None:
+            ip_block = (
+                ipaddress.ip_network(peer.ip_block.cidr),
+                tuple(map(ipaddress.ip_network, peer.ip_block._except or [])))
+        return PeerIR(
+            SelectorIR.from_model(peer.pod_selector) if peer.pod_selector is not None else None,
+            SelectorIR.from_model(peer.namespace_selector) if peer.namespace_selector is not None else None,
+            ip_block)
+
+    @staticmethod
+    def from_dict(peer: Dict[str, Any]) -> "PeerIR":
+        ip_block = None
+        if peer.get("ipBlock") is not None:
+            ip_block = (
+                ipaddress.ip_network(peer["ipBlock"]["cidr"]),
+                tuple(map(ipaddress.ip_network, peer["ipBlock"].get("except") or [])))
+        return PeerIR(
+            SelectorIR.from_dict(peer["podSelector"]) if peer.get("podSelector") is not None else None,
+            SelectorIR.from_dict(peer["namespaceSelector"]) if peer.get("namespaceSelector") is not None else None,
+            ip_block)
+
+    def define(self, gi, pod_var, ns_var, rhs: List[Any], namespace: str) -> bool:
+        """
+        namespace: the policy's namespace, a podSelector without namespaceSelector only selects its pods
+        """
+        if self.namespace_selector is not None:
+            # quick fail
+            if self.namespace_selector.define(gi, ns_var, rhs, is_namespace=True):
+                return True
+        elif self.pod_selector is not None:
+            # quick fail -> no pod in the policy's namespace
+            if namespace not in gi.nam_map:
+                return True
+            rhs.append(gi.get_relation_core("namespace")(pod_var, gi.get_namespace_idx(namespace)))
+        if self.pod_selector is not None:
+            # quick fail
+            if self.pod_selector.define(gi, pod_var, rhs):
+                return True
+        return False
+
+    def evaluate(self, index: SelectionIndex, namespace: str) -> bitarray:
+        result = index.pods.all()
+        if self.namespace_selector is not None:
+            result &= index.in_namespaces(self.namespace_selector.evaluate(index.namespaces))
+        elif self.pod_selector is not None:
+            if namespace not in index.nam_map:
+                return index.pods.none()
+            result &= index.members[index.nam_map[namespace]]
+        if self.pod_selector is not None:
+            result &= self.pod_selector.evaluate(index.pods)
+        return result
+
+
+class RuleIR(NamedTuple):
+    """
+    Compiled ingress/egress rule, peers/ports None -> all peers/ports
+    """
+    direction: int
+    peers: Optional[Tuple[PeerIR, ...]]
+    ports: Optional[Tuple[Port, ...]]
+
+    @staticmethod
+    def from_model(rule: Union[V1NetworkPolicyEgressRule, V1NetworkPolicyIngressRule]) -> "RuleIR":
+        if isinstance(rule, V1NetworkPolicyEgressRule):
+            direction, peers = PolicyRuleAdatper.EGRESS, rule.to
+        else:
+            direction, peers = PolicyRuleAdatper.INGRESS, rule._from
+        ports = None
+        if rule.ports is not None:
+            ports = tuple((p.port, (p.protocol or "TCP").upper(), p.end_port) for p in rule.ports)
+        return RuleIR(
+            direction,
+            tuple(map(PeerIR.from_model, peers)) if peers is not None else None,
+            ports)
+
+    @staticmethod
+    def from_dict(rule: Optional[Dict[str, Any]], direction: int) -> "RuleIR":
+        rule = rule or {}
+        peers = rule.get("to" if direction == PolicyRuleAdatper.EGRESS else "from")
+        ports = None
+        if rule.get("ports") is not None:
+            ports = tuple((p.get("port"), (p.get("protocol") or "TCP").upper(), p.get("endPort")) for p in rule["ports"])
+        return RuleIR(
+            direction,
+            tuple(map(PeerIR.from_dict, peers)) if peers is not None else None,
+            ports)
+
+    def define(self, gi, pod_var, ns_var, namespace: str) -> List[List[Any]]:
+        # return many OR branches
+
+        # If this field is empty or missing, this rule matches all destinations -> no rhs added
+        if self.peers is None:
+            return [[]]
+
+        all_rhs = []
+        for peer in self.peers:
+            rhs = []
+            if not peer.define(gi, pod_var, ns_var, rhs, namespace):
+                all_rhs.append(rhs)
+        return all_rhs
+
+    def evaluate(self, index: SelectionIndex, namespace: str) -> bitarray:
+        if self.peers is None:
+            return index.pods.all()
+        result = index.pods.none()
+        for peer in self.peers:
+            result |= peer.evaluate(index, namespace)
+        return result
+
+
+class PolicyIR(NamedTuple):
+    """
+    Compiled network policy, read by both the z3 encoding and the bitset evaluation
+    ingress/egress None -> the policy allows no traffic in that direction
+    policy_types follows the k8s default: Ingress, plus Egress if egress rules are given
+    """
+    name: Optional[str]
+    namespace: str
+    pod_selector: Optional[SelectorIR]
+    ingress: Optional[Tuple[RuleIR, ...]]
+    egress: Optional[Tuple[RuleIR, ...]]
+    policy_types: Tuple[int, ...]
+
+    @staticmethod
+    def from_model(policy: V1NetworkPolicy) -> "PolicyIR":
+        spec = policy.spec
+        return PolicyIR(
+            policy.metadata.name,
+            sys.intern(policy.metadata.namespace or "default"),
+            SelectorIR.from_model(spec.pod_selector) if spec.pod_selector is not None else None,
+            tuple(map(RuleIR.from_model, spec.ingress)) if spec.ingress is not None else None,
+            tuple(map(RuleIR.from_model, spec.egress)) if spec.egress is not None else None,
+            PolicyIR.types_of(spec.policy_types, spec.egress is not None))
+
+    @staticmethod
+    def from_dict(policy: Dict[str, Any]) -> "PolicyIR":
+        metadata = policy["metadata"]
+        spec = policy.get("spec") or {}
+        ingress, egress = spec.get("ingress"), spec.get("egress")
+        return PolicyIR(
+            metadata.get("name"),
+            sys.intern(metadata.get("namespace") or "default"),
+            SelectorIR.from_dict(spec["podSelector"]) if spec.get("podSelector") is not None else None,
+            tuple(RuleIR.from_dict(r, PolicyRuleAdatper.INGRESS) for r in ingress) if ingress is not None else None,
+            tuple(RuleIR.from_dict(r, PolicyRuleAdatper.EGRESS) for r in egress) if egress is not None else None,
+            PolicyIR.types_of(spec.get("policyTypes"), egress is not None))
+
+    @staticmethod
+    def types_of(policy_types: Optional[List[str]], has_egress: bool) -> Tuple[int, ...]:
+        if policy_types is None:
+            return (PolicyAdapter.INGRESS, PolicyAdapter.EGRESS) if has_egress else (PolicyAdapter.INGRESS,)
+        names = set(map(str.lower, policy_types))
+        return tuple(ty for ty, name in [(PolicyAdapter.INGRESS, "ingress"), (PolicyAdapter.EGRESS, "egress")] if name in names)
+
+    @property
+    def is_ingress(self) -> bool:
+        return PolicyAdapter.INGRESS in self.policy_types
+
+    @property
+    def is_egress(self) -> bool:
+        return PolicyAdapter.EGRESS in self.policy_types
+
+    def define_rules(self, idx: int, gi, rules: Optional[Tuple[RuleIR, ...]], allow_by_pol: str):
+        allow_by_pol = gi.get_relation_core(allow_by_pol)
+        namespace = gi.get_relation_core("namespace")
+        pod_var = gi.declare_var('pod', gi.pod_sort)
+        ns_var = gi.declare_var('ns', gi.nam_sort)
+
+        # no rules, no <direction>_allow_by_pol(Pod, idx) defined
+        if rules is None:
+            return
+
+        # each rule is independent (OR-chained)
+        for rule in rules:
+            # each peer in each rule is OR-chained
+            for rhs in rule.define(gi, pod_var, ns_var, self.namespace):
+                rhs.insert(0, namespace(pod_var, ns_var))
+                gi.add_rule(allow_by_pol(pod_var, gi.pol_value(idx)), rhs)
+
+    def define_egress_rules(self, idx: int, gi):
+        # if egress is empty, this NetworkPolicy limits all outgoing traffic
+        self.define_rules(idx, gi, self.egress, "egress_allow_by_pol")
+
+    def define_ingress_rules(self, idx: int, gi):
+        # if ingress is empty, this NetworkPolicy does not allow any traffic
+        self.define_rules(idx, gi, self.ingress, "ingress_allow_by_pol")
+
+    def define_pod_selector(self, idx: int, gi):
+        selected_by_pol = gi.get_relation_core("selected_by_pol")
+        namespace = gi.get_relation_core("namespace")
+        pod_var = gi.declare_var('pod', gi.pod_sort)
+
+        # quick fail -> no possible namespace, omit this rule
+        if self.namespace not in gi.nam_map:
+            return
+
+        rhs = [namespace(pod_var, gi.get_namespace_idx(self.namespace))]
+        # An empty podSelector matches all pods in this namespace.
+        if self.pod_selector is not None:
+            # quick fail, no possible selection
+            if self.pod_selector.define(gi, pod_var, rhs):
+                return
+
+        gi.add_rule(selected_by_pol(pod_var, gi.pol_value(idx)), rhs)
+
+    def evaluate_rules(self, index: SelectionIndex, rules: Optional[Tuple[RuleIR, ...]]) -> bitarray:
+        result = index.pods.none()
+        for rule in rules or ():
+            result |= rule.evaluate(index, self.namespace)
+        return result
+
+    def evaluate_egress_rules(self, index: SelectionIndex) -> bitarray:
+        return self.evaluate_rules(index, self.egress)
+
+    def evaluate_ingress_rules(self, index: SelectionIndex) -> bitarray:
+        return self.evaluate_rules(index, self.ingress)
+
+    def evaluate_pod_selector(self, index: SelectionIndex) -> bitarray:
+        if self.namespace not in index.nam_map:
+            return index.pods.none()
+        result = index.members[index.nam_map[self.namespace]].copy()
+        if self.pod_selector is not None:
+            result &= self.pod_selector.evaluate(index.pods)
+        return result
+
+
+class PodIR(NamedTuple):
+    """
+    Compact pod, the only fields the encodings read
+    """
+    name: Optional[str]
+    namespace: str
+    labels: Dict[str, str]
+
+    @staticmethod
+    def from_model(pod: V1Pod) -> "PodIR":
+        return PodIR(pod.metadata.name, sys.intern(pod.metadata.namespace or "default"), intern_labels(pod.metadata.labels))
+
+    @staticmethod
+    def from_dict(pod: Dict[str, Any]) -> "PodIR":
+        metadata = pod["metadata"]
+        return PodIR(metadata.get("name"), sys.intern(metadata.get("namespace") or "default"), intern_labels(metadata.get("labels")))
+
+
+class NamespaceIR(NamedTuple):
+    """
+    Compact namespace
+    """
+    name: str
+    labels: Dict[str, str]
+
+    @staticmethod
+    def from_model(namespace: V1Namespace) -> "NamespaceIR":
+        return NamespaceIR(sys.intern(namespace.metadata.name), intern_labels(namespace.metadata.labels))
+
+    @staticmethod
+    def from_dict(namespace: Dict[str, Any]) -> "NamespaceIR":
+        metadata = namespace["metadata"]
+        return NamespaceIR(sys.intern(metadata["name"]), intern_labels(metadata.get("labels")))
+
+
 class LabelSelectorAdapter:
     """
     A label selector is a label query over a set of resources. 
@@ -134,6 +636,7 @@ class LabelSelectorAdapter:
 
     def __init__(self, selector: V1LabelSelector):
         self.selector = selector
+        self._ir = None
 
     @property
     def match_expressions(self) -> Optional[List[Union[ExistRelation, InRelation]]]:
@@ -146,14 +649,11 @@ class LabelSelectorAdapter:
             return None
         exprs = []
         for expr in self.selector.match_expressions:
-            if expr.operator.lower() == "in":
-                exprs.append(InRelation(InRelation.IN, expr.key, expr.values))
-            if expr.operator.lower() == "notin":
-                exprs.append(InRelation(InRelation.NOT_IN, expr.key, expr.values))
-            if expr.operator.lower() == "exists":
-                exprs.append(ExistRelation(ExistRelation.EXISTS, expr.key))
-            if expr.operator.lower() == "doesnotexists":
-                exprs.append(ExistRelation(ExistRelation.DOES_NOT_EXISTS, expr.key))        
+            operator = OPERATORS.get(expr.operator.lower())
+            if operator in (InRelation.IN, InRelation.NOT_IN):
+                exprs.append(InRelation(operator, expr.key, expr.values))
+            elif operator is not None:
+                exprs.append(ExistRelation(operator, expr.key))
         return exprs
 
     @property
@@ -175,80 +675,37 @@ class LabelSelectorAdapter:
             "match_expressions": self.selector.match_expressions if self.selector.match_expressions else None
         }
 
+    @property
+    def ir(self) -> SelectorIR:
+        if self._ir is None:
+            self._ir = SelectorIR.from_model(self.selector)
+        return self._ir
+
+    def canonical(self) -> Tuple[Requirement, ...]:
+        """
+        Order independent form of the requirements, a matchLabels k: v is In(k, [v])
+        Selectors with the same canonical form select the same objects
+        """
+        return self.ir.requirements
+
     def define_label_selector(self, idx: int, gi, var, rhs: List[Any], prefix: str, is_namespace=False) -> bool:
         """
         Return a boolean value indicating quick fail -> no possible key
         An empty label selector matches all objects. (matchExpressions == matchLabels == null)
         A null label selector matchs no objects (e.g. if namespace_selectors == null)
         """
-        match_expr = self.match_expressions
-        match_label = self.match_labels
-
-        if match_expr is not None:
-            for expr in match_expr:
-                key_label = None
-                key_label_exists = None
-                if is_namespace:
-                    key_label = "{}__namespace".format(expr.key)
-                    key_label_exists = "{}__exists".format(key_label)
-                    key_label = gi.get_relation_ns(key_label)
-                    key_label_exists = gi.get_relation_ns(key_label_exists)
-                else:
-                    key_label = expr.key
-                    key_label_exists = "{}__exists".format(key_label)
-                    key_label = gi.get_relation(key_label)
-                    key_label_exists = gi.get_relation(key_label_exists)
-                # quick fail, no possible match
-                if key_label is None or key_label_exists is None:
-                    return True
-
-                if expr.operator == ExistRelation.EXISTS:
-                    rhs.append(key_label_exists(var))
-                elif expr.operator == ExistRelation.DOES_NOT_EXISTS:
-                    rhs.append(z3.Not(key_label_exists(var)))
-                else:
-                    values = expr.values
-                    in_func_name = "{}_{}_{}_in_{}".format(prefix, idx, expr.key, "namespace" if is_namespace else "pod")
-                    in_func = z3.Function(in_func_name, gi.pod_sort, z3.BoolSort())
-                    in_var = None
-                    if is_namespace:
-                        in_var = gi.declare_var("in_nam_var", gi.nam_sort)
-                    else:
-                        in_var = gi.declare_var("in_pod_var", gi.pod_sort)
-                    gi.register_relation(in_func_name, in_func, is_core=True)
+        return self.ir.define(gi, var, rhs, is_namespace)
 
-                    for v in values:
-                        gi.add_rule(in_func(in_var), key_label(in_var, gi.get_or_create_literal(v)))
-                    
-                    if expr.operator == InRelation.IN:
-                        rhs.append(in_func(var))
-                    else:
-                        rhs.append(z3.Not(in_func(var)))
-
-        if match_label is not None:
-            for k, v in match_label.items():
-                k_entity = k
-                if is_namespace:
-                    k_entity = k_entity + "__namespace"
-                    k_entity = gi.get_relation_ns(k_entity)
-                else:
-                    k_entity = gi.get_relation(k_entity)
-
-                # quick fail
-                if k_entity is None:
-                    return True
-
-                rhs.append(k_entity(var, gi.get_or_create_literal(v)))
-
-        return False
+    def evaluate_label_selector(self, index: LabelIndex) -> bitarray:
+        return self.ir.evaluate(index)
 
 
-IPAddress = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
 class PolicyPeerAdapter:
 
     def __init__(self, peer: V1NetworkPolicyPeer, direction):
         self.peer = peer
         self.direction = direction
+        self._ir = None
 
     @property
     def ip_block(self) -> Optional[Tuple[IPAddress, List[IPAddress]]]:
@@ -301,18 +758,17 @@ class PolicyPeerAdapter:
             "ip_block": self.ip_block
         }
 
-    def define_peer_selector(self, idx: int, gi, pod_var, ns_var, rhs: List[Any], is_namespace=False) -> bool:
-        if self.namespace_selector is not None:
-            fail = self.namespace_selector.define_label_selector(idx, gi, ns_var, rhs, self.direction, is_namespace=True)
-            # quick fail
-            if fail:
-                return True
-        if self.pod_selector is not None:
-            fail = self.pod_selector.define_label_selector(idx, gi, pod_var, rhs, self.direction)
-            # quick fail
-            if fail:
-                return True
-        return False
+    @property
+    def ir(self) -> PeerIR:
+        if self._ir is None:
+            self._ir = PeerIR.from_model(self.peer)
+        return self._ir
+
+    def define_peer_selector(self, idx: int, gi, pod_var, ns_var, rhs: List[Any], namespace: str, is_namespace=False) -> bool:
+        return self.ir.define(gi, pod_var, ns_var, rhs, namespace)
+
+    def evaluate_peer_selector(self, index: SelectionIndex, namespace: str) -> bitarray:
+        return self.ir.evaluate(index, namespace)
 
 
 class PolicyRuleAdatper:
@@ -328,6 +784,7 @@ class PolicyRuleAdatper:
         else:
             self.direction = PolicyRuleAdatper.INGRESS
         self.rule = rule
+        self._ir = None
 
     @property
     def peer(self) -> Optional[List[PolicyPeerAdapter]]:
@@ -347,20 +804,18 @@ class PolicyRuleAdatper:
             return None
         return list(map(lambda x: PolicyPeerAdapter(x, "ingress_allow"), self.rule._from))
 
-    def define_peer_rule(self, idx: int, gi, pod_var, ns_var) -> List[List[Any]]:
-        # return many OR branches
+    @property
+    def ir(self) -> RuleIR:
+        if self._ir is None:
+            self._ir = RuleIR.from_model(self.rule)
+        return self._ir
 
-        # If this field is empty or missing, this rule matches all destinations -> no rhs added
-        if self.peer is None:
-            return
+    def define_peer_rule(self, idx: int, gi, pod_var, ns_var, namespace: str) -> List[List[Any]]:
+        # return many OR branches
+        return self.ir.define(gi, pod_var, ns_var, namespace)
 
-        all_rhs = []
-        for p in self.peer:
-            rhs = []
-            fail = p.define_peer_selector(idx, gi, pod_var, ns_var, rhs)
-            if not fail:
-               all_rhs.append(rhs)
-        return all_rhs
+    def evaluate_peer_rule(self, index: SelectionIndex, namespace: str) -> bitarray:
+        return self.ir.evaluate(index, namespace)
 
     @property
     def ports(self) -> Optional[List[Tuple[Optional[Union[int, str]], str]]]:
@@ -370,19 +825,11 @@ class PolicyRuleAdatper:
         If this field is empty or missing, this rule matches all ports (traffic not restricted by port). 
         If this field is present and contains at least one item, then this rule allows traffic only if the traffic matches at least one port in the list.
         """
-        if self.rule.ports is None:
+        # port could be numerical or named port on a pod
+        # If this field is not provided, this matches all port names and numbers
+        if self.ir.ports is None:
             return None
-
-        ports: List[V1NetworkPolicyPort] = self.rule.ports
-        results = []
-
-        for p in ports:
-            # port could be numerical or named port on a pod
-            # If this field is not provided, this matches all port names and numbers
-            if p.protocol is not None:
-                results.append((p.port, p.protocol))
-            else:
-                results.append((p.port, "TCP"))
+        return [(port, protocol) for port, protocol, _ in self.ir.ports]
 
     def to_dict(self):
         return {
@@ -400,6 +847,16 @@ class PolicyAdapter:
 
     def __init__(self, v1policy: V1NetworkPolicy):
         self.policy = v1policy
+        self._ir = None
+
+    @property
+    def ir(self) -> PolicyIR:
+        """
+        Compiled once, the define_*/evaluate_* methods read this instead of the k8s models
+        """
+        if self._ir is None:
+            self._ir = PolicyIR.from_model(self.policy)
+        return self._ir
 
     @property
     def metadata(self) -> V1ObjectMeta:
@@ -430,23 +887,10 @@ class PolicyAdapter:
         return list(map(PolicyRuleAdatper, self.spec.egress))
 
     def define_egress_rules(self, idx: int, gi):
-        egress_allow_by_pol = gi.get_relation_core("egress_allow_by_pol")
-        namespace = gi.get_relation_core("namespace")
-        pod_var = gi.declare_var('pod', gi.pod_sort)
-        ns_var = gi.declare_var('ns', gi.nam_sort)
-
-        # if egress is empty, this NetworkPolicy limits all outgoing traffic
-        # no egress_allow_by_pol(Pod, idx) defined
-        if self.egress_rules is None:
-            return
+        self.ir.define_egress_rules(idx, gi)
 
-        # each egress rule is independent (OR-chained)
-        for egress in self.egress_rules:
-            rhses = egress.define_peer_rule(idx, gi, pod_var, ns_var)
-            # each peer in each rule is OR-chained
-            for rhs in rhses:
-                rhs.insert(0, namespace(pod_var, ns_var))
-                gi.add_rule(egress_allow_by_pol(pod_var, gi.pol_value(idx)), rhs)
+    def evaluate_egress_rules(self, index: SelectionIndex) -> bitarray:
+        return self.ir.evaluate_egress_rules(index)
 
     @property
     def ingress_rules(self) -> Optional[List[PolicyRuleAdatper]]:
@@ -464,23 +908,10 @@ class PolicyAdapter:
         return list(map(PolicyRuleAdatper, self.spec.ingress))
 
     def define_ingress_rules(self, idx: int, gi):
-        ingress_allow_by_pol = gi.get_relation_core("ingress_allow_by_pol")
-        namespace = gi.get_relation_core("namespace")
-        pod_var = gi.declare_var('pod', gi.pod_sort)
-        ns_var = gi.declare_var('ns', gi.nam_sort)
+        self.ir.define_ingress_rules(idx, gi)
 
-        # if ingress is empty, this NetworkPolicy does not allow any traffic
-        # no ingress_allow_by_pol(Pod, idx) defined
-        if self.ingress_rules is None:
-            return
-
-        # each ingress rule is independent (OR-chained)
-        for ingress in self.ingress_rules:
-            rhses = ingress.define_peer_rule(idx, gi, pod_var, ns_var)
-            # each peer in each rule is OR-chained
-            for rhs in rhses:
-                rhs.insert(0, namespace(pod_var, ns_var))
-                gi.add_rule(ingress_allow_by_pol(pod_var, gi.pol_value(idx)), rhs)
+    def evaluate_ingress_rules(self, index: SelectionIndex) -> bitarray:
+        return self.ir.evaluate_ingress_rules(index)
 
     @property
     def pod_selector(self) -> Optional[LabelSelectorAdapter]:
@@ -497,52 +928,21 @@ class PolicyAdapter:
         return LabelSelectorAdapter(self.spec.pod_selector)
 
     def define_pod_selector(self, idx: int, gi):
-        selected_by_pol = gi.get_relation_core("selected_by_pol")
-        namespace = gi.get_relation_core("namespace")
-        pod_var = gi.declare_var('pod', gi.pod_sort)
-        
-        # quick fail -> no possible namespace, omit this rule
-        if self.namespace not in gi.nam_map:
-            return
-        
-        rhs = []
-        rhs.append(namespace(pod_var, gi.get_namespace_idx(self.namespace)))
-
-        # An empty podSelector matches all pods in this namespace.
-        if self.pod_selector is None:
-            pass
-        else:
-            fail = self.pod_selector.define_label_selector(idx, gi, pod_var, rhs, "select_by_pol")
-            # quick fail, no possible selection
-            if fail:
-                return
+        self.ir.define_pod_selector(idx, gi)
 
-        gi.add_rule(selected_by_pol(pod_var, gi.pol_value(idx)), rhs)
+    def evaluate_pod_selector(self, index: SelectionIndex) -> bitarray:
+        return self.ir.evaluate_pod_selector(index)
 
     @property
     def policy_types(self) -> List[int]:
         """
         List of rule types that the NetworkPolicy relates to. 
         Valid options are "Ingress", "Egress", or "Ingress,Egress"
+        If not given: Ingress, plus Egress if egress rules are given (k8s default)
         """
         if self.spec is None:
             return []
-
-        tys = []
-        if self.spec.policy_types is not None:
-            tystrs = list(map(str.lower, self.spec.policy_types))
-            if 'ingress' in tystrs:
-                tys.append(PolicyAdapter.INGRESS)                        
-            if 'egress' in tystrs:
-                tys.append(PolicyAdapter.EGRESS)
-            return tys
-
-        if self.spec.ingress is not None:
-            tys.append(PolicyAdapter.INGRESS)
-        if self.spec.egress is not None:
-            tys.append(PolicyAdapter.EGRESS)
-
-        return tys
+        return list(self.ir.policy_types)
 
     def to_dict(self):
         return {
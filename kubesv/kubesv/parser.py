@@ -2,21 +2,176 @@
 k8s yaml file -> model
 XXX: could just generate models instead
 """
+import datetime
 import yaml
-from kubernetes import client, config
+import kubernetes.client.models
+from dateutil.parser import parse as parse_datetime
+from kubernetes import client
+from typing import *
+
+from .model import PodAdapter, PolicyAdapter, NamespaceAdapter
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+NATIVE_TYPES = {
+    "int": int,
+    "float": float,
+    "str": str,
+    "bool": bool,
+    "date": datetime.date,
+    "datetime": datetime.datetime,
+    "object": object,
+}
+
+# kind -> (model, adapter)
+ADAPTERS = {
+    "Pod": ("V1Pod", PodAdapter),
+    "NetworkPolicy": ("V1NetworkPolicy", PolicyAdapter),
+    "Namespace": ("V1Namespace", NamespaceAdapter),
+}
+
+
+class Deserializer:
+    """
+    Offline replacement of ApiClient.deserialize, dict -> kubernetes.client.models
+    No kubeconfig, no json round trip, one Configuration shared by all models
+    and the field plan of each model class is computed once
+    """
+    def __init__(self):
+        self.configuration = client.Configuration()
+        self.plans: Dict[str, Any] = {}
+
+    def plan(self, klass: str):
+        """
+        list[T] -> ("list", T), dict(str, T) -> ("dict", T), native -> type, model -> (cls, fields)
+        """
+        if klass in self.plans:
+            return self.plans[klass]
+
+        if klass.startswith("list["):
+            plan = ("list", klass[5:-1])
+        elif klass.startswith("dict("):
+            plan = ("dict", klass[5:-1].split(", ", 1)[1])
+        elif klass in NATIVE_TYPES:
+            plan = NATIVE_TYPES[klass]
+        else:
+            model = getattr(kubernetes.client.models, klass)
+            fields = [
+                (attr, model.attribute_map[attr], t)
+                for attr, t in model.openapi_types.items()
+            ]
+            plan = (model, fields)
+
+        self.plans[klass] = plan
+        return plan
+
+    def deserialize(self, data, klass: str):
+        if data is None:
+            return None
+
+        plan = self.plan(klass)
+        if isinstance(plan, type):
+            return self.deserialize_native(data, plan)
+
+        if plan[0] == "list":
+            return [self.deserialize(v, plan[1]) for v in data]
+        if plan[0] == "dict":
+            return {k: self.deserialize(v, plan[1]) for k, v in data.items()}
+
+        model, fields = plan
+        kwargs = {
+            attr: self.deserialize(data[key], t)
+            for attr, key, t in fields
+            if key in data
+        }
+        return model(local_vars_configuration=self.configuration, **kwargs)
+
+    @staticmethod
+    def deserialize_native(data, klass: type):
+        # same conversions as ApiClient
+        if klass is object:
+            return data
+        if klass is datetime.date or klass is datetime.datetime:
+            # yaml already parses unquoted timestamps
+            if isinstance(data, datetime.date):
+                value = data
+            else:
+                try:
+                    value = datetime.datetime.fromisoformat(data)
+                except ValueError:
+                    value = parse_datetime(data)
+            if klass is datetime.date and isinstance(value, datetime.datetime):
+                return value.date()
+            return value
+        try:
+            return klass(data)
+        except UnicodeEncodeError:
+            return str(data)
+        except TypeError:
+            return data
+
+
+_deserializer = None
+
+
+def get_deserializer() -> Deserializer:
+    global _deserializer
+    if _deserializer is None:
+        _deserializer = Deserializer()
+    return _deserializer
 
 
 def from_dict(kind: str, data: dict):
-    config.load_kube_config()
-    api = client.ApiClient()
-    
-    class FakeResposne:
-        def __init__(self, obj):
-            import json
-            self.data = json.dumps(obj)
+    return get_deserializer().deserialize(data, kind)
+
 
-    return api.deserialize(FakeResposne(data), kind)
+def from_dicts(kind: str, datas: Iterable[dict]) -> list:
+    deserializer = get_deserializer()
+    return [deserializer.deserialize(data, kind) for data in datas]
 
 
 def from_yaml(kind: str, yml: str):
-    return from_dict(kind, yaml.safe_load(yml))        
+    return from_dict(kind, yaml.load(yml, Loader=SafeLoader))
+
+
+def load_objects(datas: Iterable[dict]) -> Tuple[List[PodAdapter], List[PolicyAdapter], List[NamespaceAdapter]]:
+    """
+    Parsed manifests (any order, List kinds are flattened) -> pods, policies, namespaces adapters
+    Other kinds are ignored
+    """
+    deserializer = get_deserializer()
+    results = {kind: [] for kind in ADAPTERS}
+    for kind, data in iter_objects(datas):
+        if kind in ADAPTERS:
+            model, adapter = ADAPTERS[kind]
+            results[kind].append(adapter(deserializer.deserialize(data, model)))
+
+    return results["Pod"], results["NetworkPolicy"], results["Namespace"]
+
+
+def iter_objects(datas: Iterable[dict]) -> Iterator[Tuple[str, dict]]:
+    """
+    (kind, object) of parsed manifests in order, the items of *List kinds are flattened
+    """
+    stack = [d for d in datas if d is not None][::-1]
+    while stack:
+        data = stack.pop()
+        kind = data.get("kind")
+        if kind is not None and kind.endswith("List"):
+            stack.extend([
+                item if "kind" in item else dict(item, kind=kind[:-4])
+                for item in data.get("items") or []
+            ][::-1])
+        else:
+            yield kind, data
+
+
+def load_yaml(yml) -> Tuple[List[PodAdapter], List[PolicyAdapter], List[NamespaceAdapter]]:
+    """
+    Multi document yaml (string or stream) -> pods, policies, namespaces adapters
+    """
+    return load_objects(yaml.load_all(yml, Loader=SafeLoader))
@@ -5,51 +5,60 @@ from z3 import *
 from typing import *
 from typing_extensions import *
 from bitarray import bitarray
+from bitarray.util import ones, zeros
 from .constraint import GlobalInfo, get_answer
 from .utils import *
+from . import metrics
 from time import perf_counter
 
 
 def get_z3_bitarray(answer: BoolRef, n_container: int, is_ingress=True) -> List[bitarray]:
     # assume the answer is Or(And(Var0, Var1, ...), ...)
-    all_answer = [bitarray('0' * n_container) for _ in range(n_container)]
-    pairs = parse_z3_result(answer)
-    if pairs is None:
-        return all_answer
-    for src, dst in pairs:
-        if is_ingress:
-            all_answer[src][dst] = True
-        else:
-            all_answer[dst][src] = True
-    return all_answer
+    # all bits are set at once on a flat n x n matrix, then split into rows
+    with metrics.phase("kubesv.decode") as measure:
+        flat = z3_answer_bitarray(answer, n_container, transpose=not is_ingress)
+        if metrics.enabled():
+            measure.counts["tuples"] = flat.count()
+    return split_rows(flat, n_container)
+
+
+def split_rows(flat: bitarray, n: int) -> List[bitarray]:
+    return [flat[i * n:(i + 1) * n] for i in range(n)]
+
+
+def column_and(matrix: List[bitarray]) -> bitarray:
+    """
+    Bit i is set iff column i is all True, rows are AND-ed word by word
+    """
+    result = ones(len(matrix))
+    for row in matrix:
+        result &= row
+        if not result.any():
+            break
+    return result
+
+
+def column_or(matrix: List[bitarray]) -> bitarray:
+    """
+    Bit i is set iff column i has a True, rows are OR-ed word by word
+    """
+    result = zeros(len(matrix))
+    for row in matrix:
+        result |= row
+        if result.all():
+            break
+    return result
 
 
 def all_reachable(matrix: List[bitarray]) -> List[int]:
-    all_reachables = []
-    for i in range(len(matrix)):
-        is_all_reachable = True
-        for j in range(len(matrix)):
-            if matrix[j][i] != True:
-                is_all_reachable = False
-                break
-        if is_all_reachable:
-            all_reachables.append(i)
-    return all_reachables
+    return list(column_and(matrix).search(1))
 
 
 def all_isolated(matrix: List[bitarray]) -> List[int]:
-    all_isolated = []
-    for i in range(len(matrix)):
-        is_all_isolated = True
-        for j in range(len(matrix)):
-            if matrix[j][i] != False:
-                is_all_isolated = False
-                break
-        if is_all_isolated:
-            all_isolated.append(i)
-    return all_isolated
+    return list(column_or(matrix).search(0))
 
 
+@metrics.instrument("kubesv.pairs")
 def get_all_pairs(gi: GlobalInfo, rel: str):
     rel = gi.get_relation_core(rel)
 
@@ -68,6 +77,7 @@ def get_all_edges(gi: GlobalInfo):
     return get_all_pairs(gi, "edge") 
 
 
+@metrics.instrument("kubesv.all_reach_isolate", lambda result: {"reachable": len(result[0]), "isolated": len(result[1])})
 def all_reach_isolate(gi: GlobalInfo):
     rel = gi.get_relation_core("edge")
 
@@ -80,18 +90,18 @@ def all_reach_isolate(gi: GlobalInfo):
     return all_reachable(matrix), all_isolated(matrix)
 
 
-def all_reachable_native(gi: GlobalInfo):
+def define_all_reachable(gi: GlobalInfo) -> FuncDeclRef:
     is_pod = gi.get_relation_core("is_pod")
     disconnect = gi.get_relation_core("disconnect")
 
+    has_unreachable, is_new = gi.define_relation_core('has_unreachable', gi.pod_sort)
+    all_reachable, _ = gi.define_relation_core('all_reachable', gi.pod_sort)
+    if not is_new:
+        return all_reachable
+
     src = gi.declare_var('src_edge', gi.pod_sort)
     dst = gi.declare_var('dst_edge', gi.pod_sort)
 
-    has_unreachable = Function('has_unreachable', gi.pod_sort, BoolSort())
-    gi.register_relation("has_unreachable", has_unreachable, is_core=True)
-    all_reachable = Function('all_reachable', gi.pod_sort, BoolSort())
-    gi.register_relation("all_reachable", all_reachable, is_core=True)
-
     gi.add_rule(has_unreachable(dst), [
         is_pod(src),
         disconnect(src, dst)
@@ -101,6 +111,13 @@ def all_reachable_native(gi: GlobalInfo):
         is_pod(dst),
         Not(has_unreachable(dst))
     ])
+    return all_reachable
+
+
+@metrics.instrument("kubesv.all_reachable")
+def all_reachable_native(gi: GlobalInfo):
+    all_reachable = define_all_reachable(gi)
+    dst = gi.declare_var('dst_edge', gi.pod_sort)
 
     fact = [all_reachable(dst)]
     sat, answer = get_answer(gi.fp, fact)
@@ -110,18 +127,18 @@ def all_reachable_native(gi: GlobalInfo):
     return sat, parse_z3_result(answer)
 
 
-def all_isolated_native(gi: GlobalInfo):
+def define_all_isolated(gi: GlobalInfo) -> FuncDeclRef:
     edge = gi.get_relation_core("edge")
     is_pod = gi.get_relation_core("is_pod")
 
+    has_reachable, is_new = gi.define_relation_core('has_reachable', gi.pod_sort)
+    all_isolated, _ = gi.define_relation_core('all_isolated', gi.pod_sort)
+    if not is_new:
+        return all_isolated
+
     src = gi.declare_var('src_edge', gi.pod_sort)
     dst = gi.declare_var('dst_edge', gi.pod_sort)
 
-    has_reachable = Function('has_reachable', gi.pod_sort, BoolSort())
-    gi.register_relation("has_reachable", has_reachable, is_core=True)
-    all_isolated = Function('all_isolated', gi.pod_sort, BoolSort())
-    gi.register_relation("all_isolated", all_isolated, is_core=True)
-
     gi.add_rule(has_reachable(dst), [
         is_pod(src),
         edge(src, dst)
@@ -131,6 +148,13 @@ def all_isolated_native(gi: GlobalInfo):
         is_pod(dst),
         Not(has_reachable(dst))
     ])
+    return all_isolated
+
+
+@metrics.instrument("kubesv.all_isolated")
+def all_isolated_native(gi: GlobalInfo):
+    all_isolated = define_all_isolated(gi)
+    dst = gi.declare_var('dst_edge', gi.pod_sort)
 
     fact = [all_isolated(dst)]
     sat, answer = get_answer(gi.fp, fact)
@@ -140,18 +164,14 @@ def all_isolated_native(gi: GlobalInfo):
     return sat, parse_z3_result(answer)
 
 
-def user_crosscheck(gi: GlobalInfo, l: str):
-    """
-    A container can be reached from other user’s container in the container network
-    User is specified by the label. 
-    Kano: All constainers should have that label.
-    """
+def define_user_crosscheck(gi: GlobalInfo, l: str) -> FuncDeclRef:
     label = gi.get_relation(l)
     is_pod = gi.get_relation_core("is_pod")
     edge = gi.get_relation_core("edge")
 
-    user_violation = Function('user_violation_{}'.format(label), gi.pod_sort, BoolSort())
-    gi.register_relation("user_violation_{}".format(label), user_violation, is_core=True)
+    user_violation, is_new = gi.define_relation_core('user_violation_{}'.format(label), gi.pod_sort)
+    if not is_new:
+        return user_violation
 
     sel = gi.declare_var('sel_{}'.format(label), gi.pod_sort)
     random = gi.declare_var('random_{}'.format(label), gi.pod_sort)
@@ -166,6 +186,18 @@ def user_crosscheck(gi: GlobalInfo, l: str):
         label(sel, lv1),
         lv0 != lv1
     ])
+    return user_violation
+
+
+@metrics.instrument("kubesv.user_crosscheck")
+def user_crosscheck(gi: GlobalInfo, l: str):
+    """
+    A container can be reached from other user’s container in the container network
+    User is specified by the label. 
+    Kano: All constainers should have that label.
+    """
+    user_violation = define_user_crosscheck(gi, l)
+    sel = gi.declare_var('sel_{}'.format(l), gi.pod_sort)
 
     fact = [user_violation(sel)]
     sat, answer = get_answer(gi.fp, fact)
@@ -175,25 +207,32 @@ def user_crosscheck(gi: GlobalInfo, l: str):
     return sat, parse_z3_result(answer)
 
 
-def system_isolation(gi: GlobalInfo, idx: int):
-    """
-    A container is isolated with certain container, usually the kube-system container
-    System pod is specified by idx
-    Kano: only consider egress edge, not path
-    """
+def define_system_isolation(gi: GlobalInfo, idx: int) -> FuncDeclRef:
     is_pod = gi.get_relation_core("is_pod")
     edge = gi.get_relation_core("edge")
-    pod_idx = gi.pod_value(idx)
 
-    system_isolation = Function('system_isolation_{}'.format(idx), gi.pod_sort, BoolSort())
-    gi.register_relation("system_isolation_{}".format(idx), system_isolation, is_core=True)
+    system_isolation, is_new = gi.define_relation_core('system_isolation_{}'.format(idx), gi.pod_sort)
+    if not is_new:
+        return system_isolation
 
     sel = gi.declare_var('system_iso_sel_{}'.format(idx), gi.pod_sort)
 
     gi.add_rule(system_isolation(sel), [
         is_pod(sel),
-        Not(edge(pod_idx, sel))
+        Not(edge(gi.pod_value(idx), sel))
     ])
+    return system_isolation
+
+
+@metrics.instrument("kubesv.system_isolation")
+def system_isolation(gi: GlobalInfo, idx: int):
+    """
+    A container is isolated with certain container, usually the kube-system container
+    System pod is specified by idx
+    Kano: only consider egress edge, not path
+    """
+    system_isolation = define_system_isolation(gi, idx)
+    sel = gi.declare_var('system_iso_sel_{}'.format(idx), gi.pod_sort)
 
     fact = [system_isolation(sel)]
     sat, answer = get_answer(gi.fp, fact)
@@ -203,56 +242,120 @@ def system_isolation(gi: GlobalInfo, idx: int):
     return sat, parse_z3_result(answer)
 
 
-def policy_shadow(gi: GlobalInfo):
+def define_closure(gi: GlobalInfo, idxs: Iterable[int], reverse=False) -> FuncDeclRef:
     """
-    The connections built by a policy are completely covered by another policy, then this policy may be redundant
-    NOTE: this is a general version, not Kano's per pod version
+    reachable_from_<idxs>(dst): some pod of idxs has a path to dst
+    can_reach_<idxs>(src): src has a path to some pod of idxs
+    Recursion is seeded by the pods and follows edge, i.e. linear in the edges instead of deriving all paths
+    NOTE: the pods are constants in the rule bodies (no facts), earlier results stay valid
+    """
+    edge = gi.get_relation_core("edge")
+    idxs = sorted(set(idxs))
+    name = "{}_{}".format("can_reach" if reverse else "reachable_from", "_".join(map(str, idxs)))
+
+    closure, is_new = gi.define_relation_core(name, gi.pod_sort)
+    if not is_new:
+        return closure
+
+    var = gi.declare_var('closure_pod', gi.pod_sort)
+    hop = gi.declare_var('closure_hop', gi.pod_sort)
+    for idx in idxs:
+        if reverse:
+            gi.add_rule(closure(var), edge(var, gi.pod_value(idx)))
+        else:
+            gi.add_rule(closure(var), edge(gi.pod_value(idx), var))
+    if reverse:
+        gi.add_rule(closure(var), [edge(var, hop), closure(hop)])
+    else:
+        gi.add_rule(closure(var), [closure(hop), edge(hop, var)])
+    return closure
+
+
+@metrics.instrument("kubesv.reachable_from")
+def reachable_from(gi: GlobalInfo, idxs: Iterable[int]):
+    """
+    All pods reachable (through any number of hops) from a set of pods
+    """
+    closure = define_closure(gi, idxs)
+    var = gi.declare_var('closure_pod', gi.pod_sort)
+
+    fact = [closure(var)]
+    sat, answer = get_answer(gi.fp, fact)
+    if sat == z3.unsat:
+        return sat, set()
+
+    return sat, parse_z3_result(answer)
+
+
+@metrics.instrument("kubesv.can_reach")
+def can_reach(gi: GlobalInfo, idxs: Iterable[int]):
+    """
+    All pods with a path (any number of hops) to a set of pods, e.g. who can reach the database
+    """
+    closure = define_closure(gi, idxs, reverse=True)
+    var = gi.declare_var('closure_pod', gi.pod_sort)
+
+    fact = [closure(var)]
+    sat, answer = get_answer(gi.fp, fact)
+    if sat == z3.unsat:
+        return sat, set()
+
+    return sat, parse_z3_result(answer)
+
+
+@metrics.instrument("kubesv.blast_radius")
+def blast_radius(gi: GlobalInfo, idx: int):
+    """
+    Pods an attacker can move to from a compromised pod, following allowed connections hop by hop
+    """
+    return reachable_from(gi, [idx])
+
+
+def define_policy_pair_check(gi: GlobalInfo, name: str, inverse_name: str, is_shadow: bool) -> FuncDeclRef:
+    """
+    shadow: p0 never selects/allows a pod that p1 does not, conflict: p0 and p1 never share a pod
     """
     is_pod = gi.get_relation_core("is_pod")
     is_pol = gi.get_relation_core("is_pol")
-    selected_by_pol = gi.get_relation_core("selected_by_pol")
-    ingress_allow_by_pol = gi.get_relation_core("ingress_allow_by_pol")
-    egress_allow_by_pol = gi.get_relation_core("egress_allow_by_pol")
 
-    policy_shadow = Function('policy_shadow', gi.pol_sort, gi.pol_sort, BoolSort())
-    gi.register_relation("policy_shadow", policy_shadow, is_core=True)
-    policy_unshadow = Function('policy_unshadow', gi.pol_sort, gi.pol_sort, BoolSort())
-    gi.register_relation("policy_unshadow", policy_unshadow, is_core=True)
+    check, is_new = gi.define_relation_core(name, gi.pol_sort, gi.pol_sort)
+    inverse, _ = gi.define_relation_core(inverse_name, gi.pol_sort, gi.pol_sort)
+    if not is_new:
+        return check
 
+    p0 = gi.declare_var('{}_inner'.format(name), gi.pol_sort)
+    p1 = gi.declare_var('{}_outer'.format(name), gi.pol_sort)
 
-    p0 = gi.declare_var('policy_shadow_inner', gi.pol_sort)
-    p1 = gi.declare_var('policy_shadow_outer', gi.pol_sort)
+    select = gi.declare_var('{}_select'.format(name), gi.pod_sort)
 
-    select = gi.declare_var('policy_shadow_select', gi.pod_sort)
+    for rel in ["selected_by_pol", "ingress_allow_by_pol", "egress_allow_by_pol"]:
+        rel = gi.get_relation_core(rel)
+        gi.add_rule(inverse(p0, p1), [
+            is_pol(p0),
+            is_pol(p1),
+            is_pod(select),
+            rel(select, p0),
+            Not(rel(select, p1)) if is_shadow else rel(select, p1)
+        ])
 
-    gi.add_rule(policy_unshadow(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        selected_by_pol(select, p0),
-        Not(selected_by_pol(select, p1))
-    ])
-    gi.add_rule(policy_unshadow(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        ingress_allow_by_pol(select, p0),
-        Not(ingress_allow_by_pol(select, p1))
-    ])
-    gi.add_rule(policy_unshadow(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        egress_allow_by_pol(select, p0),
-        Not(egress_allow_by_pol(select, p1))
-    ])
-
-    gi.add_rule(policy_shadow(p0, p1), [
+    gi.add_rule(check(p0, p1), [
         is_pol(p0),
         is_pol(p1),
         p0 != p1,
-        Not(policy_unshadow(p0, p1))        
+        Not(inverse(p0, p1))
     ])
+    return check
+
+
+@metrics.instrument("kubesv.policy_shadow")
+def policy_shadow(gi: GlobalInfo):
+    """
+    The connections built by a policy are completely covered by another policy, then this policy may be redundant
+    NOTE: this is a general version, not Kano's per pod version
+    """
+    policy_shadow = define_policy_pair_check(gi, 'policy_shadow', 'policy_unshadow', True)
+    p0 = gi.declare_var('policy_shadow_inner', gi.pol_sort)
+    p1 = gi.declare_var('policy_shadow_outer', gi.pol_sort)
 
     fact = [policy_shadow(p0, p1)]
     sat, answer = get_answer(gi.fp, fact)
@@ -262,60 +365,123 @@ def policy_shadow(gi: GlobalInfo):
     return sat, parse_z3_result(answer)
 
 
+@metrics.instrument("kubesv.policy_conflict")
 def policy_conflict(gi: GlobalInfo):
     """
     The connections built by a policy are totally contradict the connections built by another    
     NOTE: this is a general version, not Kano's per pod version
     """
-    is_pod = gi.get_relation_core("is_pod")
-    is_pol = gi.get_relation_core("is_pol")
-    selected_by_pol = gi.get_relation_core("selected_by_pol")
-    ingress_allow_by_pol = gi.get_relation_core("ingress_allow_by_pol")
-    egress_allow_by_pol = gi.get_relation_core("egress_allow_by_pol")
-
-    policy_conflict = Function('policy_conflict', gi.pol_sort, gi.pol_sort, BoolSort())
-    gi.register_relation("policy_conflict", policy_conflict, is_core=True)
-    policy_inconflict = Function('policy_inconflict', gi.pol_sort, gi.pol_sort, BoolSort())
-    gi.register_relation("policy_inconflict", policy_inconflict, is_core=True)
-
-
+    policy_conflict = define_policy_pair_check(gi, 'policy_conflict', 'policy_inconflict', False)
     p0 = gi.declare_var('policy_conflict_inner', gi.pol_sort)
     p1 = gi.declare_var('policy_conflict_outer', gi.pol_sort)
 
-    select = gi.declare_var('policy_conflict_select', gi.pod_sort)
-
-    gi.add_rule(policy_inconflict(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        selected_by_pol(select, p0),
-        selected_by_pol(select, p1)
-    ])
-    gi.add_rule(policy_inconflict(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        ingress_allow_by_pol(select, p0),
-        ingress_allow_by_pol(select, p1)
-    ])
-    gi.add_rule(policy_inconflict(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        egress_allow_by_pol(select, p0),
-        egress_allow_by_pol(select, p1)
-    ])
-
-    gi.add_rule(policy_conflict(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        p0 != p1,
-        Not(policy_inconflict(p0, p1))        
-    ])
-
     fact = [policy_conflict(p0, p1)]
     sat, answer = get_answer(gi.fp, fact)
     if sat == z3.unsat:
         return sat, []
     
     return sat, parse_z3_result(answer)
+
+
+class QuerySession:
+    """
+    Prepared queries over a built GlobalInfo
+    Derived relations are registered once (on first use), answers are cached per (query, parameters).
+    Parameterized reachability queries (system_isolation, user_crosscheck) are answered from
+    the cached edge relation instead of adding rules and running a new fixpoint per parameter.
+    """
+
+    def __init__(self, gi: GlobalInfo):
+        self.gi = gi
+        self.answers: Dict[Tuple[Any, ...], Any] = {}
+
+    def cached(self, key: Tuple[Any, ...], query: Callable[[], Any]) -> Any:
+        if key not in self.answers:
+            self.answers[key] = query()
+        return self.answers[key]
+
+    def is_saturated(self, name: str, *params) -> bool:
+        return (name, *params) in self.answers
+
+    def invalidate(self):
+        # facts/rules were added to gi.fp after the answers were computed
+        self.answers.clear()
+
+    def edges(self) -> Tuple[CheckSatResult, Set[Tuple[int, int]]]:
+        return self.cached(("edge",), lambda: get_all_edges(self.gi))
+
+    def reached_by(self) -> List[Set[int]]:
+        # row per source pod: all destinations with an edge
+        def query():
+            rows = [set() for _ in range(len(self.gi.pods))]
+            for src, dst in self.edges()[1]:
+                rows[src].add(dst)
+            return rows
+        return self.cached(("reached_by",), query)
+
+    def matrix(self) -> List[bitarray]:
+        def query():
+            n = len(self.gi.pods)
+            flat = zeros(n * n)
+            indices = [src * n + dst for src, dst in self.edges()[1]]
+            if indices:
+                flat[indices] = 1
+            return split_rows(flat, n)
+        return self.cached(("matrix",), query)
+
+    def all_reach_isolate(self) -> Tuple[List[int], List[int]]:
+        return self.cached(("all_reach_isolate",),
+            lambda: (all_reachable(self.matrix()), all_isolated(self.matrix())))
+
+    def all_reachable(self):
+        return self.cached(("all_reachable",), lambda: all_reachable_native(self.gi))
+
+    def all_isolated(self):
+        return self.cached(("all_isolated",), lambda: all_isolated_native(self.gi))
+
+    def paths(self) -> Tuple[CheckSatResult, Set[Tuple[int, int]]]:
+        return self.cached(("path",), lambda: get_all_pairs(self.gi, "path"))
+
+    def reachable_from(self, idxs: Iterable[int]) -> Tuple[CheckSatResult, Set[int]]:
+        idxs = tuple(sorted(set(idxs)))
+
+        def query():
+            # the full path relation has O(n^2) pairs, only use it once it was fetched anyway
+            if not self.is_saturated("path"):
+                return reachable_from(self.gi, idxs)
+            reached = {dst for src, dst in self.paths()[1] if src in idxs}
+            return (z3.sat if reached else z3.unsat), reached
+        return self.cached(("reachable_from", idxs), query)
+
+    def blast_radius(self, idx: int) -> Tuple[CheckSatResult, Set[int]]:
+        return self.reachable_from([idx])
+
+    def system_isolation(self, idx: int):
+        def query():
+            reached = self.reached_by()[idx]
+            isolated = {sel for sel in range(len(self.gi.pods)) if sel not in reached}
+            if not isolated:
+                return z3.unsat, []
+            return z3.sat, isolated
+        return self.cached(("system_isolation", idx), query)
+
+    def user_crosscheck(self, l: str):
+        def query():
+            values = [pod.labels.get(l) for pod in self.gi.pods]
+            violation = set()
+            for src, dsts in enumerate(self.reached_by()):
+                if values[src] is None:
+                    continue
+                for dst in dsts:
+                    if values[dst] is not None and values[dst] != values[src]:
+                        violation.add(dst)
+            if not violation:
+                return z3.unsat, []
+            return z3.sat, violation
+        return self.cached(("user_crosscheck", l), query)
+
+    def policy_shadow(self):
+        return self.cached(("policy_shadow",), lambda: policy_shadow(self.gi))
+
+    def policy_conflict(self):
+        return self.cached(("policy_conflict",), lambda: policy_conflict(self.gi))
@@ -0,0 +1,321 @@
+"""
+Run kubesv queries off the event loop: each query is answered by a worker process
+that builds the fixedpoint from a ClusterSnapshot, so a query can be bounded by a timeout
+and cancelled (the worker is terminated, z3 cannot be interrupted from python otherwise).
+A query that times out can be answered by the kano bit matrix instead.
+
+run_checks answers independent checks in parallel from one built program (ProgramImage).
+"""
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from time import perf_counter
+from typing import *
+from typing_extensions import *
+
+from .snapshot import ClusterSnapshot
+from .constraint import GlobalInfo, ProgramImage
+from .postprocess import (
+    get_all_edges,
+    all_reachable_native,
+    all_isolated_native,
+    user_crosscheck,
+    system_isolation,
+    policy_shadow,
+    policy_conflict,
+)
+
+try:
+    from kano import algorithm as kano_algorithm
+    from kano.model import ReachabilityMatrix
+    from kano.parser import ConfigParser
+except ImportError:
+    try:
+        from kano_py.kano import algorithm as kano_algorithm
+        from kano_py.kano.model import ReachabilityMatrix
+        from kano_py.kano.parser import ConfigParser
+    except ImportError:
+        kano_algorithm = None
+
+
+QUERIES: Dict[str, Callable[..., Tuple[Any, Any]]] = {
+    "edges": get_all_edges,
+    "all_reachable": all_reachable_native,
+    "all_isolated": all_isolated_native,
+    "user_crosscheck": user_crosscheck,
+    "system_isolation": system_isolation,
+    "policy_shadow": policy_shadow,
+    "policy_conflict": policy_conflict,
+}
+
+
+class QueryResult(NamedTuple):
+    """
+    status: "ok", "timeout" or "error"
+    engine: "kubesv", "kano" or "fallback" (timeout fallback), None (no answer)
+    sat is None when kubesv did not answer
+    """
+    query: str
+    args: Tuple[Any, ...]
+    status: str
+    engine: Optional[str]
+    sat: Any
+    result: Any
+    elapsed: float
+    error: Optional[BaseException] = None
+
+
+def serve(conn, snapshot: ClusterSnapshot, build_kwargs: Dict[str, Any]):
+    """
+    Worker process loop: build on the first query, answer (query, args) until None or EOF
+    Queries run on the same fixedpoint, as in a sequential session
+    """
+    gi = None
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+
+        query, args = message
+        try:
+            if gi is None:
+                gi = snapshot.build(**build_kwargs)
+            conn.send(("ok", QUERIES[query](gi, *args)))
+        except Exception as e:
+            conn.send(("error", e))
+
+
+class Worker:
+    def __init__(self, context, snapshot: ClusterSnapshot, build_kwargs: Dict[str, Any]):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=serve, args=(child, snapshot, build_kwargs), daemon=True)
+        self.process.start()
+        # the worker holds the only write end: recv raises EOFError once it is gone
+        child.close()
+
+    def call(self, query: str, args: Tuple[Any, ...]) -> Tuple[str, Any]:
+        # blocking, run in a thread
+        self.conn.send((query, args))
+        return self.conn.recv()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+class KanoFallback:
+    """
+    Answers the pod queries with the kano reachability matrix of the same snapshot
+    Policy queries have no fallback: kano splits each policy into ingress/egress policies,
+    its policy indices are not kubesv's
+    """
+    def __init__(self, snapshot: ClusterSnapshot, build_kwargs: Dict[str, Any]):
+        if kano_algorithm is None:
+            raise ImportError("the kano fallback needs the kano package")
+        parser = ConfigParser()
+        self.containers, self.policies = parser.load_snapshot(snapshot)
+        self.matrix = ReachabilityMatrix.build_matrix(self.containers, self.policies,
+            check_self_ingress_traffic=build_kwargs.get("check_self_ingress_traffic", True),
+            check_select_by_no_policy=build_kwargs.get("check_select_by_no_policy", False),
+            build_transpose_matrix=True,
+            namespaces=parser.namespaces)
+
+    @staticmethod
+    def supports(query: str) -> bool:
+        return query in ("edges", "all_reachable", "all_isolated", "user_crosscheck", "system_isolation")
+
+    def __call__(self, query: str, *args) -> Any:
+        matrix = self.matrix
+        if query == "edges":
+            return {(i, j) for i in range(matrix.container_size) for j in matrix.getrow(i).search(1)}
+        if query == "all_reachable":
+            return kano_algorithm.all_reachable(matrix)
+        if query == "all_isolated":
+            return kano_algorithm.all_isolated(matrix)
+        if query == "user_crosscheck":
+            return kano_algorithm.user_crosscheck(matrix, self.containers, *args)
+        if query == "system_isolation":
+            return kano_algorithm.system_isolation(matrix, *args)
+        raise ValueError("no kano fallback for {}".format(query))
+
+
+class QueryRunner:
+    """
+    async with QueryRunner(snapshot, timeout=30) as runner:
+        results = await runner.run_all(["all_isolated", ("system_isolation", 0)])
+
+    At most max_workers queries run at once, each in its own worker process.
+    Idle workers are reused (their fixedpoint is already built),
+    a worker whose query times out or is cancelled is terminated.
+    fallback: "kano", None or a callable (query, *args) -> result, used on timeouts
+    """
+    def __init__(self, snapshot: ClusterSnapshot,
+            max_workers: Optional[int] = None,
+            timeout: Optional[float] = None,
+            fallback: Union[str, Callable[..., Any], None] = "kano",
+            mp_context: str = "spawn",
+            **build_kwargs):
+        self.snapshot = snapshot
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.build_kwargs = build_kwargs
+        self.context = multiprocessing.get_context(mp_context)
+        self.fallback = fallback
+        self.idle: List[Worker] = []
+        self.busy: Set[Worker] = set()
+        self.semaphore = asyncio.Semaphore(self.max_workers)
+        self.threads = ThreadPoolExecutor(self.max_workers)
+        self._kano: Optional[KanoFallback] = None
+        self._kano_lock = threading.Lock()
+
+    async def __aenter__(self) -> "QueryRunner":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for worker in self.idle:
+            worker.stop()
+        for worker in self.busy:
+            worker.kill()
+        self.idle, self.busy = [], set()
+        self.threads.shutdown(wait=False)
+
+    async def run(self, query: str, *args, timeout: Optional[float] = None) -> QueryResult:
+        """
+        timeout defaults to the runner timeout, it includes building the fixedpoint on a fresh worker
+        """
+        if query not in QUERIES:
+            raise ValueError("unknown query: {}".format(query))
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+
+        async with self.semaphore:
+            start = perf_counter()
+            worker = self.idle.pop() if self.idle else Worker(self.context, self.snapshot, self.build_kwargs)
+            self.busy.add(worker)
+            try:
+                status, value = await asyncio.wait_for(
+                    loop.run_in_executor(self.threads, worker.call, query, args), timeout)
+            except asyncio.TimeoutError:
+                self.discard(worker)
+                return await self.fall_back(query, args, start)
+            except asyncio.CancelledError:
+                self.discard(worker)
+                raise
+            except (EOFError, OSError) as e:
+                # the worker died (crash, out of memory)
+                self.discard(worker)
+                return QueryResult(query, args, "error", None, None, None, perf_counter() - start, e)
+
+            self.busy.discard(worker)
+            self.idle.append(worker)
+            if status == "error":
+                return QueryResult(query, args, "error", None, None, None, perf_counter() - start, value)
+            sat, result = value
+            return QueryResult(query, args, "ok", "kubesv", sat, result, perf_counter() - start)
+
+    async def run_all(self, queries: Iterable[Union[str, Tuple[Any, ...]]], timeout: Optional[float] = None) -> List[QueryResult]:
+        """
+        Queries are names or (name, *args) tuples, results are in the same order
+        """
+        queries = [(query,) if isinstance(query, str) else tuple(query) for query in queries]
+        return list(await asyncio.gather(*(self.run(*query, timeout=timeout) for query in queries)))
+
+    def discard(self, worker: Worker):
+        self.busy.discard(worker)
+        worker.kill()
+
+    def kano(self) -> KanoFallback:
+        # the matrix is built once, on the first timeout
+        with self._kano_lock:
+            if self._kano is None:
+                self._kano = KanoFallback(self.snapshot, self.build_kwargs)
+            return self._kano
+
+    async def fall_back(self, query: str, args: Tuple[Any, ...], start: float) -> QueryResult:
+        if self.fallback == "kano":
+            if kano_algorithm is None or not KanoFallback.supports(query):
+                return QueryResult(query, args, "timeout", None, None, None, perf_counter() - start)
+            fallback, engine = lambda: self.kano()(query, *args), "kano"
+        elif self.fallback is not None:
+            fallback, engine = lambda: self.fallback(query, *args), "fallback"
+        else:
+            return QueryResult(query, args, "timeout", None, None, None, perf_counter() - start)
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.threads, fallback)
+        return QueryResult(query, args, "timeout", engine, None, result, perf_counter() - start)
+
+
+def run_queries(snapshot: ClusterSnapshot, queries: Iterable[Union[str, Tuple[Any, ...]]], **kwargs) -> List[QueryResult]:
+    """
+    Blocking helper: QueryRunner(snapshot, **kwargs).run_all(queries) on a new event loop
+    """
+    async def run():
+        async with QueryRunner(snapshot, **kwargs) as runner:
+            return await runner.run_all(queries)
+    return asyncio.run(run())
+
+
+DEFAULT_CHECKS: List[Union[str, Tuple[Any, ...]]] = [
+    "policy_shadow",
+    "policy_conflict",
+    "all_reachable",
+    "all_isolated",
+    ("system_isolation", 0),
+]
+
+# worker process state of run_checks
+worker_image: Optional[ProgramImage] = None
+worker_options: Dict[str, Any] = {}
+
+
+def load_image(image: ProgramImage, options: Dict[str, Any]):
+    global worker_image, worker_options
+    worker_image, worker_options = image, options
+
+
+def run_check(query: str, *args) -> Tuple[Any, Any]:
+    # a fresh engine per check: checks add relations, they must not see each other
+    return QUERIES[query](worker_image.restore(**worker_options), *args)
+
+
+def run_checks(gi: Union[GlobalInfo, ProgramImage],
+        checks: Iterable[Union[str, Tuple[Any, ...]]] = DEFAULT_CHECKS,
+        max_workers: Optional[int] = None,
+        mp_context: str = "spawn",
+        **kwargs) -> Dict[Union[str, Tuple[Any, ...]], Tuple[Any, Any]]:
+    """
+    Answer independent checks (QUERIES names or (name, *args) tuples) in a process pool
+    The program is serialized once and loaded by each worker, instead of building it per check.
+    Results are keyed by check, gi itself is not modified.
+    kwargs: get_fixpoint_engine options, as given to build
+    """
+    image = gi if isinstance(gi, ProgramImage) else ProgramImage.from_global_info(gi)
+    checks = list(checks)
+    calls = [(check,) if isinstance(check, str) else tuple(check) for check in checks]
+    for call in calls:
+        if call[0] not in QUERIES:
+            raise ValueError("unknown query: {}".format(call[0]))
+
+    max_workers = max_workers or min(len(calls), multiprocessing.cpu_count())
+    with ProcessPoolExecutor(max(1, max_workers),
+            mp_context=multiprocessing.get_context(mp_context),
+            initializer=load_image, initargs=(image, kwargs)) as pool:
+        futures = [pool.submit(run_check, *call) for call in calls]
+        return {check: future.result() for check, future in zip(checks, futures)}
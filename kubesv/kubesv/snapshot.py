@@ -0,0 +1,92 @@
+"""
+cluster snapshot: pods, policies and namespaces compiled once into the compact IR
+fed to kubesv (ClusterSnapshot.build) and to kano (kano.parser.ConfigParser.load_snapshot)
+without re-parsing and without keeping the k8s client models
+"""
+import os
+import yaml
+from typing import *
+
+from .model import PodIR, PolicyIR, NamespaceIR, PodAdapter, PolicyAdapter, NamespaceAdapter
+from .parser import SafeLoader, iter_objects
+from .constraint import build
+from . import metrics
+
+
+class ClusterSnapshot:
+    """
+    Namespaces of pods that are not declared are added without labels
+    """
+    __slots__ = ("pods", "policies", "namespaces")
+
+    def __init__(self, pods: Iterable[PodIR], policies: Iterable[PolicyIR], namespaces: Iterable[NamespaceIR] = ()):
+        self.pods: Tuple[PodIR, ...] = tuple(pods)
+        self.policies: Tuple[PolicyIR, ...] = tuple(policies)
+
+        namespaces = list(namespaces)
+        declared = {ns.name for ns in namespaces}
+        for pod in self.pods:
+            if pod.namespace not in declared:
+                declared.add(pod.namespace)
+                namespaces.append(NamespaceIR(pod.namespace, {}))
+        self.namespaces: Tuple[NamespaceIR, ...] = tuple(namespaces)
+
+    def __repr__(self) -> str:
+        return "ClusterSnapshot(pods={}, policies={}, namespaces={})".format(
+            len(self.pods), len(self.policies), len(self.namespaces))
+
+    @staticmethod
+    def from_objects(datas: Iterable[dict]) -> "ClusterSnapshot":
+        """
+        Parsed manifests (any order, List kinds are flattened), other kinds are ignored
+        Lazy inputs (from_yaml, from_files) are read inside, the kubesv.parse event includes yaml loading
+        """
+        with metrics.phase("kubesv.parse") as measure:
+            pods, policies, namespaces = [], [], []
+            for kind, data in iter_objects(datas):
+                if kind == "Pod":
+                    pods.append(PodIR.from_dict(data))
+                elif kind == "NetworkPolicy":
+                    policies.append(PolicyIR.from_dict(data))
+                elif kind == "Namespace":
+                    namespaces.append(NamespaceIR.from_dict(data))
+            snapshot = ClusterSnapshot(pods, policies, namespaces)
+            measure.counts.update(
+                pods=len(snapshot.pods), policies=len(snapshot.policies), namespaces=len(snapshot.namespaces))
+        return snapshot
+
+    @staticmethod
+    def from_yaml(yml) -> "ClusterSnapshot":
+        """
+        Multi document yaml, string or stream
+        """
+        return ClusterSnapshot.from_objects(yaml.load_all(yml, Loader=SafeLoader))
+
+    @staticmethod
+    def from_files(filenames: Iterable[str]) -> "ClusterSnapshot":
+        def load():
+            for filename in filenames:
+                with open(filename) as f:
+                    yield from yaml.load_all(f, Loader=SafeLoader)
+        return ClusterSnapshot.from_objects(load())
+
+    @staticmethod
+    def from_directory(path: str) -> "ClusterSnapshot":
+        """
+        All files under path, in os.walk order (as kano.parser.ConfigParser.parse)
+        """
+        return ClusterSnapshot.from_files(
+            os.path.join(subdir, file) for subdir, _, files in os.walk(path) for file in files)
+
+    @staticmethod
+    def from_adapters(pods: List[PodAdapter], policies: List[PolicyAdapter], namespaces: List[NamespaceAdapter]) -> "ClusterSnapshot":
+        return ClusterSnapshot(
+            [PodIR(pod.name, pod.namespace, dict(pod.labels)) for pod in pods],
+            [policy.ir for policy in policies],
+            [NamespaceIR(ns.name, dict(ns.labels)) for ns in namespaces])
+
+    def build(self, **kwargs):
+        """
+        kubesv.constraint.build over the snapshot
+        """
+        return build(list(self.pods), list(self.policies), list(self.namespaces), **kwargs)
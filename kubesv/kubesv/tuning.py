@@ -0,0 +1,64 @@
+"""
+Pick the fastest relation backend of the datalog engine for a cluster and a query mix.
+The backend choice can swing runtime several-fold, and the winner depends on the cluster shape.
+"""
+from typing import *
+from typing_extensions import *
+from time import perf_counter
+from .constraint import GlobalInfo, RELATION_BACKENDS, build
+from .model import PodAdapter, PolicyAdapter, NamespaceAdapter
+from .postprocess import get_all_edges, all_reachable_native, all_isolated_native
+
+
+DEFAULT_QUERIES: List[Callable[[GlobalInfo], Any]] = [
+    get_all_edges,
+    all_reachable_native,
+    all_isolated_native,
+]
+
+
+def sample_pods(pods: List[PodAdapter], sample_size: Optional[int]) -> List[PodAdapter]:
+    # evenly spaced pods keep the label distribution of generated/ordered clusters
+    if sample_size is None or sample_size >= len(pods):
+        return pods
+    step = len(pods) / sample_size
+    return [pods[int(i * step)] for i in range(sample_size)]
+
+
+def time_backend(backend: str,
+        pods: List[PodAdapter],
+        pols: List[PolicyAdapter],
+        nams: List[NamespaceAdapter],
+        queries: List[Callable[[GlobalInfo], Any]],
+        **kwargs) -> float:
+    start = perf_counter()
+    gi = build(pods, pols, nams, backend=backend, **kwargs)
+    for query in queries:
+        query(gi)
+    return perf_counter() - start
+
+
+def tune_backend(pods: List[PodAdapter],
+        pols: List[PolicyAdapter],
+        nams: List[NamespaceAdapter],
+        queries: Optional[List[Callable[[GlobalInfo], Any]]] = None,
+        backends: Optional[List[str]] = None,
+        sample_size: Optional[int] = 200,
+        trials: int = 1,
+        **kwargs) -> Tuple[str, Dict[str, float]]:
+    """
+    Build the (sampled) cluster once per backend, run the query mix and keep the best of `trials` runs
+    kwargs are passed to build (check_self_ingress_traffic, ...)
+    Return the fastest backend and the timing (seconds) of every backend
+    """
+    if queries is None:
+        queries = DEFAULT_QUERIES
+    if backends is None:
+        backends = list(RELATION_BACKENDS)
+    sample = sample_pods(pods, sample_size)
+
+    timings = {}
+    for backend in backends:
+        timings[backend] = min(
+            time_backend(backend, sample, pols, nams, queries, **kwargs) for _ in range(trials))
+    return min(timings, key=timings.get), timings
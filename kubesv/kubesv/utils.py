@@ -1,6 +1,15 @@
 from z3 import *
 from typing import *
 from typing_extensions import *
+from array import array
+from bitarray import bitarray
+from bitarray.util import zeros
+from . import metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def parse_z3_var_assignment(assign):
@@ -44,9 +53,127 @@ def parse_z3_or_and(answer: BoolRef) -> Set[Tuple[int, ...]]:
 
 
 def parse_z3_result(answer: BoolRef):
-    result = parse_z3_or_and(answer)
-    if isinstance(result, list):
-        return {tuple(result)}
-    elif isinstance(result, tuple):
-        return {result[1]}
+    """
+    Set of answers, plain ints for unary queries, None if answer is not Or/And/Eq (e.g. false)
+    Same result as parse_z3_or_and, decoded with iter_z3_answer
+    """
+    if z3_answer_kind(answer) is None:
+        return None
+    with metrics.phase("kubesv.decode") as measure:
+        result = set(iter_z3_answer(answer, unary_int=True))
+        measure.counts["tuples"] = len(result)
+    return result
+
+
+def unchecked(api):
+    """
+    The raw ctypes function of a z3core API wrapper, skips the per call error check
+    Only for accessors that can not fail on well formed input, falls back to the wrapper
+    """
+    elems = api.__defaults__[-1] if api.__defaults__ else None
+    return getattr(elems, "f", api)
+
+
+def z3_answer_kind(answer: BoolRef) -> Optional[int]:
+    if not is_app(answer):
+        return None
+    kind = answer.decl().kind()
+    return kind if kind in (Z3_OP_OR, Z3_OP_AND, Z3_OP_EQ) else None
+
+
+def iter_z3_answer(answer: BoolRef, unary_int=False) -> Iterator[Union[int, Tuple[int, ...]]]:
+    """
+    Stream the tuples of a fixedpoint answer Or(And(Var(i) == v, ...), ...), values ordered by var index
+    Walks the raw asts with the C API instead of z3py wrappers,
+    z3 hash-conses the Var(i) == v leaves, each distinct leaf is decoded once
+    unary_int: a lone Var(0) == v gives v instead of (v,) (parse_z3_result convention)
+    """
+    kind = z3_answer_kind(answer)
+    if kind is None:
+        return
+
+    ctx = answer.ctx_ref()
+    num_args, get_arg = unchecked(Z3_get_app_num_args), unchecked(Z3_get_app_arg)
+    get_decl, decl_kind = unchecked(Z3_get_app_decl), unchecked(Z3_get_decl_kind)
+    leaves: Dict[int, Tuple[int, int]] = {}
+
+    def leaf(ast) -> Tuple[int, int]:
+        # (var index, value) of Var(i) == v, either side
+        key = ast.value
+        if key not in leaves:
+            lhs, rhs = get_arg(ctx, ast, 0), get_arg(ctx, ast, 1)
+            if Z3_get_ast_kind(ctx, lhs) != Z3_VAR_AST:
+                lhs, rhs = rhs, lhs
+            if Z3_get_ast_kind(ctx, lhs) != Z3_VAR_AST or Z3_get_ast_kind(ctx, rhs) != Z3_NUMERAL_AST:
+                raise ValueError("unexpected answer term: {}".format(Z3_ast_to_string(ctx, ast)))
+            leaves[key] = (Z3_get_index_value(ctx, lhs), int(Z3_get_numeral_string(ctx, rhs)))
+        return leaves[key]
+
+    def conjunction(ast) -> Tuple[int, ...]:
+        n = num_args(ctx, ast)
+        values = [-1] * n
+        for i in range(n):
+            idx, value = leaf(get_arg(ctx, ast, i))
+            values[idx] = value
+        return tuple(values)
+
+    ast = answer.as_ast()
+    if kind == Z3_OP_OR:
+        disjuncts = (get_arg(ctx, ast, i) for i in range(num_args(ctx, ast)))
+    else:
+        disjuncts = (ast,)
+
+    and_kind = Z3_OP_AND
+    for disjunct in disjuncts:
+        if decl_kind(ctx, get_decl(ctx, disjunct)) == and_kind:
+            yield conjunction(disjunct)
+        else:
+            value = leaf(disjunct)[1]
+            yield value if unary_int else (value,)
+
+
+def z3_answer_columns(answer: BoolRef, arity: int) -> List[array]:
+    """
+    Decoded answer as one int64 array per variable
+    """
+    columns = [array("q") for _ in range(arity)]
+    appends = [c.append for c in columns]
+    if arity == 2:
+        first, second = appends
+        for a, b in iter_z3_answer(answer):
+            first(a)
+            second(b)
+    else:
+        for values in iter_z3_answer(answer):
+            for append, v in zip(appends, values):
+                append(v)
+    return columns
+
+
+def z3_answer_bitarray(answer: BoolRef, n: int, out: Optional[bitarray] = None, transpose=False) -> bitarray:
+    """
+    Two-column answer as a row-major n x n bit matrix, bit (a * n + b) for the tuple (a, b)
+    transpose: bit (b * n + a) instead
+    """
+    if out is None:
+        out = zeros(n * n)
+    if transpose:
+        indices = [b * n + a for a, b in iter_z3_answer(answer)]
+    else:
+        indices = [a * n + b for a, b in iter_z3_answer(answer)]
+    if indices:
+        out[indices] = 1
+    return out
+
+
+def z3_answer_numpy(answer: BoolRef, arity: int):
+    """
+    Decoded answer as a (tuples, arity) int64 numpy array, needs numpy
+    """
+    if numpy is None:
+        raise ImportError("z3_answer_numpy needs numpy")
+    columns = z3_answer_columns(answer, arity)
+    result = numpy.empty((len(columns[0]), arity), dtype=numpy.int64)
+    for i, column in enumerate(columns):
+        result[:, i] = numpy.frombuffer(column, dtype=numpy.int64)
     return result
\ No newline at end of file
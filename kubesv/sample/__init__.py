@@ -1,5 +1,5 @@
 from z3 import BoolRef, BitVecRef
-from .example import paper_example
+from .example import paper_example, tier_example
 
 def setup_z3_printer():
     from z3 import z3printer
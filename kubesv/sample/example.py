@@ -1,6 +1,17 @@
 from pprint import pprint
 from kubesv.parser import from_yaml
 from kubesv.model import PodAdapter, NamespaceAdapter, PolicyAdapter
+from kubernetes.client.models import (
+    V1ObjectMeta,
+    V1Pod,
+    V1Namespace,
+    V1LabelSelector,
+    V1NetworkPolicy,
+    V1NetworkPolicySpec,
+    V1NetworkPolicyPeer,
+    V1NetworkPolicyIngressRule,
+    V1NetworkPolicyEgressRule,
+)
 
 
 def config_example():
@@ -255,3 +266,27 @@ spec:
     ]
     
     return pods, pols, nams    
+
+
+def tier_example(n_tiers, per_tier):
+    """
+    pods of tier i only talk to tier i + 1: paths are chains of n_tiers - 1 hops
+    """
+    nams = [NamespaceAdapter(V1Namespace(metadata=V1ObjectMeta(name="default")))]
+    pods = [
+        PodAdapter(V1Pod(metadata=V1ObjectMeta(name="pod_{}_{}".format(t, i), namespace="default",
+            labels={"tier": str(t)})))
+        for t in range(n_tiers) for i in range(per_tier)
+    ]
+
+    def peer(t):
+        return [V1NetworkPolicyPeer(pod_selector=V1LabelSelector(match_labels={"tier": str(t)}))]
+
+    pols = [PolicyAdapter(V1NetworkPolicy(
+        metadata=V1ObjectMeta(name="tier_{}".format(t), namespace="default"),
+        spec=V1NetworkPolicySpec(
+            pod_selector=V1LabelSelector(match_labels={"tier": str(t)}),
+            ingress=[V1NetworkPolicyIngressRule(_from=peer(t - 1))],
+            egress=[V1NetworkPolicyEgressRule(to=peer(t + 1))])))
+        for t in range(n_tiers)]
+    return pods, pols, nams
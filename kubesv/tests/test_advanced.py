@@ -1,8 +1,96 @@
 # -*- coding: utf-8 -*-
 
 from .context import sample
+from kubesv.constraint import *
+from kubesv.model import PodAdapter, PolicyAdapter, NamespaceAdapter, PolicyIR, SelectorIR
+from kubesv.postprocess import *
+from kubesv.tuning import tune_backend
+from kubesv.datalog import DatalogEngine
+from kubesv.parser import from_dicts, load_yaml
+from kubesv.snapshot import ClusterSnapshot
+from kubesv import metrics
+from kubesv.runner import QueryRunner, KanoFallback, kano_algorithm, run_queries, run_checks, DEFAULT_CHECKS
+from kubesv.utils import iter_z3_answer, z3_answer_bitarray, z3_answer_columns, parse_z3_or_and
+from kubernetes import client
+from kubernetes.client.models import (
+    V1ObjectMeta,
+    V1Pod,
+    V1Namespace,
+    V1LabelSelector,
+    V1LabelSelectorRequirement,
+    V1NetworkPolicy,
+    V1NetworkPolicySpec,
+    V1NetworkPolicyPeer,
+    V1NetworkPolicyIngressRule,
+    V1NetworkPolicyEgressRule,
+    V1NetworkPolicyPort,
+)
 
+import asyncio
+import io
+import json
+import z3
 import unittest
+from unittest import mock
+
+
+def small_cluster():
+    """
+    built from client models directly, no kubeconfig needed
+    db_0, db_1 only talk to web_2; web_2, web_3 (team b) are not selected by any policy
+    """
+    nams = [NamespaceAdapter(V1Namespace(metadata=V1ObjectMeta(name="default", labels={"env": "prod"})))]
+    pods = [
+        PodAdapter(V1Pod(metadata=V1ObjectMeta(name=name, namespace="default", labels=labels)))
+        for name, labels in [
+            ("db_0", {"role": "db", "team": "a"}),
+            ("db_1", {"role": "db", "team": "a"}),
+            ("web_2", {"role": "web", "team": "b", "app": "front"}),
+            ("web_3", {"role": "web", "team": "b"}),
+        ]
+    ]
+    peer = V1NetworkPolicyPeer(pod_selector=V1LabelSelector(match_labels={"app": "front"}))
+    pols = [PolicyAdapter(V1NetworkPolicy(
+        metadata=V1ObjectMeta(name="db", namespace="default"),
+        spec=V1NetworkPolicySpec(
+            pod_selector=V1LabelSelector(match_labels={"role": "db"}),
+            policy_types=["Ingress", "Egress"],
+            ingress=[V1NetworkPolicyIngressRule(_from=[peer])],
+            egress=[V1NetworkPolicyEgressRule(to=[peer])])))]
+    return pods, pols, nams
+
+
+def ring_cluster(n_pods, groups=4):
+    """
+    group i only accepts ingress from group i + 1, egress is open
+    """
+    group = lambda i: {"group": "g{}".format(i % groups)}
+    return ClusterSnapshot.from_objects(
+        [{"kind": "Namespace", "metadata": {"name": "default"}}] +
+        [{"kind": "Pod", "metadata": {"name": "pod{}".format(i), "namespace": "default", "labels": group(i)}}
+            for i in range(n_pods)] +
+        [{"kind": "NetworkPolicy", "metadata": {"name": "g{}".format(g), "namespace": "default"}, "spec": {
+            "podSelector": {"matchLabels": group(g)},
+            "policyTypes": ["Ingress", "Egress"],
+            "ingress": [{"from": [{"podSelector": {"matchLabels": group(g + 1)}}]}],
+            "egress": [{}]}} for g in range(groups)])
+
+
+def two_namespace_cluster():
+    """
+    the db policy of default accepts app: b, only pod b of namespace other has it
+    a podSelector peer selects pods of the policy's namespace: nothing reaches db
+    """
+    return ClusterSnapshot.from_objects([
+        {"kind": "Namespace", "metadata": {"name": "default"}},
+        {"kind": "Namespace", "metadata": {"name": "other"}},
+        {"kind": "Pod", "metadata": {"name": "db", "namespace": "default", "labels": {"app": "db"}}},
+        {"kind": "Pod", "metadata": {"name": "web", "namespace": "default", "labels": {"app": "web"}}},
+        {"kind": "Pod", "metadata": {"name": "b", "namespace": "other", "labels": {"app": "b"}}},
+        {"kind": "NetworkPolicy", "metadata": {"name": "db", "namespace": "default"}, "spec": {
+            "podSelector": {"matchLabels": {"app": "db"}},
+            "ingress": [{"from": [{"podSelector": {"matchLabels": {"app": "b"}}}]}]}},
+    ])
 
 
 class AdvancedTestSuite(unittest.TestCase):
@@ -11,6 +99,497 @@ class AdvancedTestSuite(unittest.TestCase):
     def test_thoughts(self):
         self.assertIsNone(None)
 
+    def test_query_session(self):
+        pods, pols, nams = small_cluster()
+        gi = build(pods, pols, nams, check_select_by_no_policy=True)
+        session = QuerySession(gi)
+
+        sat, edges = session.edges()
+        self.assertEqual(sat, z3.sat)
+        self.assertIn((2, 0), edges)
+        self.assertNotIn((3, 0), edges)
+        self.assertEqual(session.all_reach_isolate(), all_reach_isolate(gi))
+        reachable, isolated = all_reach_isolate(gi)
+        self.assertEqual(set(reachable), all_reachable_native(gi)[1] or set())
+        self.assertEqual(set(isolated), all_isolated_native(gi)[1] or set())
+
+        # parameterized queries are answered from the cached edge relation
+        for idx in range(len(pods)):
+            sat, isolated = session.system_isolation(idx)
+            native_sat, native = system_isolation(gi, idx)
+            self.assertEqual(sat, native_sat)
+            self.assertEqual(set(isolated), set(native))
+        self.assertTrue(session.is_saturated("system_isolation", 3))
+        self.assertEqual(session.user_crosscheck("team"), user_crosscheck(gi, "team"))
+
+        # native queries register their relations once and are cached
+        self.assertIs(session.policy_shadow(), session.policy_shadow())
+        self.assertEqual(all_isolated_native(gi), session.all_isolated())
+        n_rels = len(gi.core_rels)
+        all_isolated_native(gi)
+        self.assertEqual(len(gi.core_rels), n_rels)
+
+    def test_relation_backends(self):
+        pods, pols, nams = small_cluster()
+        expected = get_all_edges(build(pods, pols, nams))
+        for backend in RELATION_BACKENDS:
+            self.assertEqual(get_all_edges(build(pods, pols, nams, backend=backend)), expected)
+        with self.assertRaises(ValueError):
+            build(pods, pols, nams, backend="pentagon")
+
+        # the engine really gets the plugin option (z3 cannot read its params back)
+        snapshot = ring_cluster(32)
+        with mock.patch.object(z3.Fixedpoint, "set", autospec=True, side_effect=z3.Fixedpoint.set) as fp_set:
+            gi = snapshot.build(backend="doc")
+        self.assertEqual(fp_set.call_count, 1)
+        self.assertEqual(fp_set.call_args[1]["datalog.default_relation"], "doc")
+        self.assertEqual(len(get_all_edges(gi)[1]), 288)
+
+        # the fastest backend of the injected timings wins, best of the trials
+        pods, pols, nams = list(snapshot.pods), list(snapshot.policies), list(snapshot.namespaces)
+        fake = {"sparse": iter([3.0, 2.0]), "doc": iter([1.0, 4.0])}
+        with mock.patch("kubesv.tuning.time_backend", side_effect=lambda backend, *args, **kwargs: next(fake[backend])):
+            best, timings = tune_backend(pods, pols, nams, backends=["sparse", "doc"], trials=2)
+        self.assertEqual((best, timings), ("doc", {"sparse": 2.0, "doc": 1.0}))
+
+    def test_bulk_facts(self):
+        pods, pols, nams = small_cluster()
+        gi = build(pods, pols, nams, bulk_facts=False)
+        expected = (get_all_edges(gi), all_isolated_native(gi), policy_shadow(gi))
+
+        gi = build(pods, pols, nams)
+        self.assertEqual(gi.fact_buffer, {})
+        self.assertEqual((get_all_edges(gi), all_isolated_native(gi), policy_shadow(gi)), expected)
+
+        # facts are rendered per relation, label values by literal id
+        gi = GlobalInfo(get_fixpoint_engine(), pods, pols, nams)
+        define_model(gi)
+        define_pod_facts(gi)
+        program = gi.get_fact_program()
+        self.assertIn("(declare-rel |team| ((_ BitVec 3) (_ BitVec 32)))", program)
+        self.assertIn("(rule (|team| (_ bv2 3) (_ bv{} 32)))".format(gi.lit_ids["b"]), program)
+
+    def test_finite_domain(self):
+        pods, pols, nams = small_cluster()
+
+        def run(gi):
+            return (get_all_edges(gi), all_reachable_native(gi), policy_shadow(gi),
+                system_isolation(gi, 2), user_crosscheck(gi, "team"))
+
+        expected = run(build(pods, pols, nams, check_select_by_no_policy=True))
+        for bulk_facts in [True, False]:
+            gi = build(pods, pols, nams, check_select_by_no_policy=True, bulk_facts=bulk_facts, finite_domain=True)
+            self.assertEqual(gi.pod_sort.size(), len(pods))
+            self.assertEqual(gi.lv_sort.size(), len(gi.lit_ids) + 1)
+            self.assertEqual(run(gi), expected)
+        # literals only known by selectors share the spare value
+        self.assertEqual(gi.get_or_create_literal_id("unknown"), len(gi.lit_ids))
+
+    def test_precompute_selection(self):
+        pods, pols, nams = small_cluster()
+        # db pods outside team b/c accept web pods of prod namespaces, and may send anywhere
+        pols.append(PolicyAdapter(V1NetworkPolicy(
+            metadata=V1ObjectMeta(name="db-web", namespace="default"),
+            spec=V1NetworkPolicySpec(
+                pod_selector=V1LabelSelector(match_expressions=[
+                    V1LabelSelectorRequirement(key="role", operator="In", values=["db"]),
+                    V1LabelSelectorRequirement(key="team", operator="NotIn", values=["b", "c"])]),
+                ingress=[V1NetworkPolicyIngressRule(_from=[V1NetworkPolicyPeer(
+                    namespace_selector=V1LabelSelector(match_expressions=[
+                        V1LabelSelectorRequirement(key="env", operator="In", values=["prod"])]),
+                    pod_selector=V1LabelSelector(match_labels={"role": "web"}))])],
+                egress=[V1NetworkPolicyEgressRule()]))))
+
+        def pairs(gi, name):
+            pod = gi.declare_var("pair_pod", gi.pod_sort)
+            pol = gi.declare_var("pair_pol", gi.pol_sort)
+            sat, answer = get_answer(gi.fp, [gi.get_relation_core(name)(pod, pol)])
+            return parse_z3_result(answer) if sat == z3.sat else set()
+
+        names = ["selected_by_pol", "ingress_allow_by_pol", "egress_allow_by_pol"]
+        gi = build(pods, pols, nams)
+        expected = [pairs(gi, name) for name in names] + [get_all_edges(gi)]
+        self.assertEqual(expected[1], {(2, 0), (2, 1), (3, 1)})
+        self.assertEqual(expected[2], {(2, 0)} | {(i, 1) for i in range(len(pods))})
+
+        gi = build(pods, pols, nams, precompute_selection=True)
+        self.assertEqual([pairs(gi, name) for name in names] + [get_all_edges(gi)], expected)
+
+    def test_shared_selectors(self):
+        pods, pols, nams = small_cluster()
+        # same selector written in different orders/forms by many policies
+        for i in range(10):
+            pols.append(PolicyAdapter(V1NetworkPolicy(
+                metadata=V1ObjectMeta(name="team-{}".format(i), namespace="default"),
+                spec=V1NetworkPolicySpec(
+                    pod_selector=V1LabelSelector(match_labels={"role": "db"}),
+                    ingress=[V1NetworkPolicyIngressRule(_from=[V1NetworkPolicyPeer(
+                        pod_selector=V1LabelSelector(match_expressions=[V1LabelSelectorRequirement(
+                            key="team", operator="NotIn", values=["b", "c"][::1 - 2 * (i % 2)])]))])]))))
+
+        gi = build(pods, pols, nams, check_select_by_no_policy=True)
+        names = {str(f) for f in gi.selector_rels.values() if f is not None and f is not False}
+        self.assertEqual(len([n for n in names if "team" in n]), 1)
+        self.assertEqual(len([n for n in names if n.startswith("selector_")]), 3)
+
+        # db pods are still egress-bound to web_2
+        edges = get_all_edges(gi)[1]
+        self.assertEqual(edges, {(0, 2), (1, 2), (2, 0), (2, 1), (2, 2), (2, 3), (3, 2), (3, 3)})
+        gi = build(pods, pols, nams, check_select_by_no_policy=True, precompute_selection=True)
+        self.assertEqual(get_all_edges(gi)[1], edges)
+
+    def test_offline_parser(self):
+        manifests = """
+apiVersion: v1
+kind: Namespace
+metadata: {name: default, labels: {env: prod}}
+---
+apiVersion: v1
+kind: PodList
+items:
+- metadata: {name: db_0, namespace: default, labels: {role: db}, creationTimestamp: "2020-01-01T00:00:00Z"}
+  spec: {containers: [{name: db, image: postgres, ports: [{containerPort: 5432}]}]}
+- metadata: {name: web_1, namespace: default, labels: {role: web}}
+---
+apiVersion: networking.k8s.io/v1
+kind: NetworkPolicy
+metadata: {name: db, namespace: default}
+spec:
+  podSelector: {matchLabels: {role: db}}
+  ingress: [{from: [{podSelector: {matchLabels: {role: web}}}], ports: [{port: 5432}, {port: pg, protocol: TCP}]}]
+"""
+        pods, pols, nams = load_yaml(manifests)
+        self.assertEqual([p.name for p in pods], ["db_0", "web_1"])
+        self.assertEqual([p.policy.metadata.name for p in pols], ["db"])
+        self.assertEqual(nams[0].labels, {"env": "prod"})
+
+        # same models as the ApiClient path
+        class Response:
+            def __init__(self, obj):
+                self.data = json.dumps(obj)
+
+        api = client.ApiClient()
+        pod = {"metadata": {"name": "db_0", "creationTimestamp": "2020-01-01T00:00:00Z"},
+               "spec": {"containers": [{"name": "db", "ports": [{"containerPort": 5432}]}]}}
+        self.assertEqual(from_dicts("V1Pod", [pod]), [api.deserialize(Response(pod), "V1Pod")])
+        self.assertEqual(pols[0].policy, api.deserialize(Response(api.sanitize_for_serialization(pols[0].policy)), "V1NetworkPolicy"))
+
+    def test_policy_ir(self):
+        pods, pols, nams = small_cluster()
+        policy = PolicyAdapter(V1NetworkPolicy(
+            metadata=V1ObjectMeta(name="no-b", namespace="default"),
+            spec=V1NetworkPolicySpec(
+                pod_selector=V1LabelSelector(match_expressions=[
+                    V1LabelSelectorRequirement(key="app", operator="DoesNotExist"),
+                    V1LabelSelectorRequirement(key="role", operator="In", values=["web", "db", "web"])]),
+                ingress=[V1NetworkPolicyIngressRule(
+                    _from=[V1NetworkPolicyPeer(pod_selector=V1LabelSelector(match_labels={"team": "a"}))],
+                    ports=[V1NetworkPolicyPort(port=80), V1NetworkPolicyPort(port="dns", protocol="udp")])])))
+
+        # compiled once, normalized and immutable
+        ir = policy.ir
+        self.assertIs(policy.ir, ir)
+        self.assertIsInstance(ir, PolicyIR)
+        self.assertEqual(ir.pod_selector, SelectorIR(((0, "role", ("db", "web")), (3, "app", ()))))
+        self.assertEqual(ir.ingress[0].ports, ((80, "TCP", None), ("dns", "UDP", None)))
+        self.assertEqual(policy.ingress_rules[0].ports, [(80, "TCP"), ("dns", "UDP")])
+        self.assertIsNone(ir.egress)
+        with self.assertRaises(AttributeError):
+            ir.namespace = "other"
+
+        # DoesNotExist excludes web_2 (app: front)
+        gi = build(pods, pols + [policy], nams, check_select_by_no_policy=True)
+        pod = gi.declare_var("ir_pod", gi.pod_sort)
+        sat, answer = get_answer(gi.fp, [gi.get_relation_core("selected_by_pol")(pod, gi.pol_value(1))])
+        self.assertEqual(parse_z3_result(answer), {0, 1, 3})
+        # each var is declared once to fp
+        self.assertEqual(len(gi.fp.vars), len(set(v.get_id() for v in gi.fp.vars)))
+
+    def test_default_policy_types(self):
+        def policy(**spec):
+            return PolicyAdapter(V1NetworkPolicy(
+                metadata=V1ObjectMeta(name="web", namespace="default"),
+                spec=V1NetworkPolicySpec(pod_selector=V1LabelSelector(match_labels={"role": "web"}), **spec)))
+
+        egress = [V1NetworkPolicyEgressRule(to=[])]
+        # no policyTypes: always Ingress (a policy without ingress rules denies all ingress), Egress if egress rules are given
+        self.assertEqual(policy().policy_types, [PolicyAdapter.INGRESS])
+        self.assertEqual(policy(egress=egress).policy_types, [PolicyAdapter.INGRESS, PolicyAdapter.EGRESS])
+        self.assertEqual(policy(egress=egress, policy_types=["Egress"]).policy_types, [PolicyAdapter.EGRESS])
+        self.assertEqual(PolicyIR.from_dict({"metadata": {"name": "web"}, "spec": {"podSelector": {}}}).policy_types,
+            (PolicyAdapter.INGRESS,))
+
+        # web_3 loses its ingress
+        pods, pols, nams = small_cluster()
+        _, before = get_all_edges(build(pods, pols, nams, check_select_by_no_policy=True))
+        _, after = get_all_edges(build(pods, pols + [policy()], nams, check_select_by_no_policy=True))
+        self.assertEqual({src for src, dst in before if dst == 3}, {2, 3})
+        self.assertEqual({src for src, dst in after if dst == 3 and src != 3}, set())
+
+    def test_snapshot(self):
+        pods, pols, nams = small_cluster()
+        expected = get_all_edges(build(pods, pols, nams, check_select_by_no_policy=True))
+
+        snapshot = ClusterSnapshot.from_adapters(pods, pols, nams)
+        self.assertEqual(get_all_edges(snapshot.build(check_select_by_no_policy=True)), expected)
+
+        # the same cluster straight from yaml, no k8s models, undeclared namespaces are implicit
+        snapshot = ClusterSnapshot.from_yaml("""
+kind: List
+items:
+- {kind: Pod, metadata: {name: db_0, labels: {role: db, team: a}}}
+- {kind: Pod, metadata: {name: db_1, labels: {role: db, team: a}}}
+- {kind: Pod, metadata: {name: web_2, labels: {role: web, team: b, app: front}}}
+- {kind: Pod, metadata: {name: web_3, labels: {role: web, team: b}}}
+---
+kind: NetworkPolicy
+metadata: {name: db}
+spec:
+  podSelector: {matchLabels: {role: db}}
+  policyTypes: [Ingress, Egress]
+  ingress: [{from: [{podSelector: {matchLabels: {app: front}}}]}]
+  egress: [{to: [{podSelector: {matchLabels: {app: front}}}]}]
+""")
+        self.assertEqual(snapshot.policies[0], pols[0].ir)
+        self.assertEqual([ns.name for ns in snapshot.namespaces], ["default"])
+        self.assertEqual(get_all_edges(snapshot.build(check_select_by_no_policy=True)), expected)
+        with self.assertRaises(AttributeError):
+            snapshot.extra = None
+
+        # app: b only labels a pod of namespace other, db accepts no traffic
+        snapshot = two_namespace_cluster()
+        self.assertEqual([(pod.name, pod.namespace) for pod in snapshot.pods],
+            [("db", "default"), ("web", "default"), ("b", "other")])
+        for kwargs in [{}, {"precompute_selection": True}, {"engine": "python"}]:
+            gi = snapshot.build(check_select_by_no_policy=True, **kwargs)
+            self.assertEqual(all_isolated_native(gi)[1], {0}, kwargs)
+
+    @unittest.skipIf(kano_algorithm is None, "needs the kano package")
+    def test_snapshot_engines_agree(self):
+        # kano reads the same snapshot and gives the same answers
+        snapshot = two_namespace_cluster()
+        kano = KanoFallback(snapshot, {"check_select_by_no_policy": True})
+        gi = snapshot.build(check_select_by_no_policy=True)
+        self.assertEqual(kano_algorithm.all_isolated(kano.matrix), all_isolated_native(gi)[1])
+        self.assertEqual(kano("edges"), get_all_edges(gi)[1])
+
+    def test_python_engine(self):
+        pods, pols, nams = small_cluster()
+
+        def run(gi):
+            return (get_all_edges(gi), get_all_pairs(gi, "path"), all_reach_isolate(gi),
+                all_reachable_native(gi), all_isolated_native(gi), policy_shadow(gi),
+                policy_conflict(gi), system_isolation(gi, 0), user_crosscheck(gi, "team"))
+
+        for kwargs in [{}, {"check_select_by_no_policy": True, "ground_default_pod": True}, {"finite_domain": True}]:
+            gi = build(pods, pols, nams, engine="python", **kwargs)
+            self.assertIsInstance(gi.fp, DatalogEngine)
+            self.assertEqual(run(gi), run(build(pods, pols, nams, **kwargs)))
+
+    def test_python_engine_recursion(self):
+        s = z3.BitVecSort(4)
+        answers = []
+        for fp in [get_fixpoint_engine(), DatalogEngine()]:
+            e = z3.Function("e", s, s, z3.BoolSort())
+            p = z3.Function("p", s, s, z3.BoolSort())
+            q = z3.Function("q", s, s, z3.BoolSort())
+            fp.register_relation(e, p, q)
+            x, y, z = z3.Consts("x y z", s)
+            fp.declare_var(x, y, z)
+            for src, dst in [(0, 1), (1, 2), (2, 3), (3, 1), (5, 6)]:
+                fp.fact(e(z3.BitVecVal(src, s), z3.BitVecVal(dst, s)))
+            fp.rule(p(x, y), e(x, y))
+            fp.rule(p(x, z), [p(x, y), e(y, z)])
+            # stratified negation on top of the closure
+            fp.rule(q(x, y), [p(x, y), z3.Not(p(y, x)), x != y])
+            answers.append([(fp.query(rel(x, y)), parse_z3_result(fp.get_answer())) for rel in [p, q]])
+        self.assertEqual(answers[0], answers[1])
+        self.assertEqual(answers[1][1][1], {(0, 1), (0, 2), (0, 3), (5, 6)})
+
+    def test_closure(self):
+        n_tiers, per_tier = 5, 3
+        pods, pols, nams = sample.tier_example(n_tiers, per_tier)
+        tier = lambda t: set(range(t * per_tier, (t + 1) * per_tier))
+
+        for engine in ["datalog", "python"]:
+            gi = build(pods, pols, nams, check_self_ingress_traffic=False, engine=engine)
+            self.assertEqual(blast_radius(gi, 0), (z3.sat, set(range(per_tier, len(pods)))))
+            self.assertEqual(reachable_from(gi, [len(pods) - 1]), (z3.unsat, set()))
+            self.assertEqual(can_reach(gi, tier(2)), (z3.sat, tier(0) | tier(1)))
+
+            sat, paths = get_all_pairs(gi, "path")
+            self.assertEqual(len(paths), sum(per_tier * per_tier * t for t in range(n_tiers)))
+
+            session = QuerySession(gi)
+            self.assertEqual(session.blast_radius(per_tier), blast_radius(gi, per_tier))
+            session.paths()
+            self.assertEqual(session.reachable_from(tier(1)), reachable_from(gi, tier(1)))
+
+    def test_answer_decoder(self):
+        pods, pols, nams = sample.tier_example(3, 3)
+        n = len(pods)
+        for finite_domain in [False, True]:
+            gi = build(pods, pols, nams, check_self_ingress_traffic=False, finite_domain=finite_domain)
+            path = gi.get_relation_core("path")
+            src = gi.declare_var('src_pair', gi.pod_sort)
+            dst = gi.declare_var('dst_pair', gi.pod_sort)
+
+            sat, answer = get_answer(gi.fp, [path(src, dst)])
+            expected = parse_z3_or_and(answer)
+            self.assertEqual(parse_z3_result(answer), expected)
+            self.assertEqual(set(iter_z3_answer(answer)), expected)
+            sat, tuples = get_answer_tuples(gi.fp, [path(src, dst)])
+            self.assertEqual(set(tuples), expected)
+
+            first, second = z3_answer_columns(answer, 2)
+            self.assertEqual(set(zip(first, second)), expected)
+            matrix = z3_answer_bitarray(answer, n)
+            self.assertEqual(matrix.count(), len(expected))
+            self.assertEqual({(i // n, i % n) for i in matrix.search(1)}, expected)
+            transposed = z3_answer_bitarray(answer, n, transpose=True)
+            self.assertEqual({(i % n, i // n) for i in transposed.search(1)}, expected)
+            rows = get_z3_bitarray(answer, n, is_ingress=False)
+            self.assertEqual({(a, b) for b in range(n) for a in rows[b].search(1)}, expected)
+            # nothing reaches tier 0, tier 2 reaches nothing
+            self.assertEqual(all_isolated(get_z3_bitarray(answer, n)), [0, 1, 2])
+            self.assertEqual(all_isolated(rows), [6, 7, 8])
+            self.assertEqual(all_reachable(rows), [])
+
+            # constants in the query, unary answers decode to plain ints
+            sat, answer = get_answer(gi.fp, [path(gi.pod_value(0), dst)])
+            self.assertEqual(parse_z3_result(answer), {b for a, b in expected if a == 0})
+            # no variable left: true/false, not a set of tuples
+            sat, answer = get_answer(gi.fp, [path(gi.pod_value(0), gi.pod_value(n - 1))])
+            self.assertIsNone(parse_z3_result(answer))
+            sat, tuples = get_answer_tuples(gi.fp, [path(gi.pod_value(n - 1), dst)])
+            self.assertEqual(list(tuples), [])
+
+    def test_query_runner(self):
+        pods, pols, nams = small_cluster()
+        snapshot = ClusterSnapshot.from_adapters(pods, pols, nams)
+        queries = ["edges", "all_isolated", ("system_isolation", 0), "policy_shadow"]
+        expected = [
+            get_all_edges(snapshot.build(check_select_by_no_policy=True)),
+            all_isolated_native(snapshot.build(check_select_by_no_policy=True)),
+            system_isolation(snapshot.build(check_select_by_no_policy=True), 0),
+            policy_shadow(snapshot.build(check_select_by_no_policy=True)),
+        ]
+
+        results = run_queries(snapshot, queries, max_workers=2, check_select_by_no_policy=True)
+        self.assertEqual([(r.status, r.engine) for r in results], [("ok", "kubesv")] * 4)
+        self.assertEqual([(r.sat, r.result) for r in results], expected)
+
+        # a worker cannot even start in 1ms: every query times out and is answered by the fallback
+        fallback = lambda query, *args: (query, args)
+        results = run_queries(snapshot, queries, timeout=0.001, fallback=fallback)
+        self.assertEqual([r.status for r in results], ["timeout"] * 4)
+        self.assertEqual(results[2].result, ("system_isolation", (0,)))
+        results = run_queries(snapshot, ["policy_shadow"], timeout=0.001, fallback=None)
+        self.assertEqual((results[0].engine, results[0].result), (None, None))
+
+        async def cancelled():
+            async with QueryRunner(snapshot) as runner:
+                task = asyncio.ensure_future(runner.run("edges"))
+                await asyncio.sleep(0.01)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                self.assertEqual((runner.busy, runner.idle), (set(), []))
+                with self.assertRaises(ValueError):
+                    await runner.run("no_such_query")
+        asyncio.run(cancelled())
+
+    @unittest.skipIf(kano_algorithm is None, "the kano fallback needs the kano package")
+    def test_query_runner_kano_fallback(self):
+        # timed out queries are answered by kano, with the same answers as kubesv across namespaces
+        snapshot = two_namespace_cluster()
+        queries = ["all_isolated", ("user_crosscheck", "app"), ("system_isolation", 0)]
+        expected = [
+            all_isolated_native(snapshot.build(check_select_by_no_policy=True))[1],
+            user_crosscheck(snapshot.build(check_select_by_no_policy=True), "app")[1],
+            system_isolation(snapshot.build(check_select_by_no_policy=True), 0)[1],
+        ]
+        self.assertEqual(expected[0], {0})
+
+        results = run_queries(snapshot, queries, timeout=0.001, check_select_by_no_policy=True)
+        self.assertEqual([(r.status, r.engine) for r in results], [("timeout", "kano")] * 3)
+        self.assertEqual([r.result for r in results], expected)
+
+    def test_parallel_checks(self):
+        pods, pols, nams = small_cluster()
+        gi = build(pods, pols, nams, check_select_by_no_policy=True)
+        n_rels = len(gi.core_rels)
+        results = run_checks(gi, DEFAULT_CHECKS + [("user_crosscheck", "team")], max_workers=2)
+        self.assertEqual(len(gi.core_rels), n_rels)
+
+        fresh = lambda: build(pods, pols, nams, check_select_by_no_policy=True)
+        self.assertEqual(results, {
+            "policy_shadow": policy_shadow(fresh()),
+            "policy_conflict": policy_conflict(fresh()),
+            "all_reachable": all_reachable_native(fresh()),
+            "all_isolated": all_isolated_native(fresh()),
+            ("system_isolation", 0): system_isolation(fresh(), 0),
+            ("user_crosscheck", "team"): user_crosscheck(fresh(), "team"),
+        })
+
+        # the image restores in this process too
+        restored = ProgramImage.from_global_info(gi).restore()
+        self.assertEqual(get_all_edges(restored), get_all_edges(fresh()))
+        restored = ProgramImage.from_global_info(build(pods, pols, nams, check_select_by_no_policy=True, bulk_facts=False)).restore()
+        self.assertEqual(get_all_edges(restored), get_all_edges(fresh()))
+        with self.assertRaises(ValueError):
+            ProgramImage.from_global_info(build(pods, pols, nams, finite_domain=True))
+
+    def test_metrics(self):
+        pods, pols, nams = small_cluster()
+        with metrics.collect() as events:
+            gi = build(pods, pols, nams, check_select_by_no_policy=True)
+            sat, reachable = all_reachable_native(gi)
+        self.assertEqual([e.name for e in events], [
+            "kubesv.encode", "kubesv.load_facts", "kubesv.solve", "kubesv.decode", "kubesv.all_reachable"])
+        encode, load, solve, decode, check = events
+        self.assertEqual(encode.counts["pods"], len(pods))
+        # the query added its own rules after the encoding
+        self.assertLess(encode.counts["rules"], gi.n_rules)
+        self.assertEqual(load.counts["facts"], gi.count_facts())
+        self.assertEqual(solve.tags["query"], "all_reachable")
+        self.assertIn("dl.joins", solve.stats)
+        self.assertEqual(check.counts["results"], len(reachable))
+        self.assertGreaterEqual(check.elapsed, solve.elapsed + decode.elapsed)
+
+        # no sink, nothing recorded
+        sink = metrics.ListSink()
+        all_reachable_native(gi)
+        self.assertEqual(sink.events, [])
+
+        stream = io.StringIO()
+        sink = metrics.add_sink(metrics.JsonLinesSink(stream))
+        try:
+            get_all_edges(gi)
+        finally:
+            metrics.remove_sink(sink)
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([line["name"] for line in lines], ["kubesv.solve", "kubesv.decode", "kubesv.pairs"])
+
+    def test_memory_profile(self):
+        pods, pols, nams = small_cluster()
+        with metrics.collect() as events:
+            build(pods, pols, nams)
+        self.assertTrue(all(event.memory == {} for event in events))
+
+        with metrics.profile_memory(), metrics.collect() as events:
+            with metrics.phase("outer"):
+                gi = build(pods, pols, nams)
+                all_reachable_native(gi)
+        by_name = {event.name: event for event in events}
+        outer, encode = by_name["outer"], by_name["kubesv.encode"]
+        for event in events:
+            self.assertGreaterEqual(event.memory["python_peak"], event.memory["python_retained"])
+        # nested peaks are included in the enclosing phase
+        self.assertGreaterEqual(outer.memory["python_peak"], encode.memory["python_peak"])
+        self.assertGreater(encode.memory["python_retained"], 0)
+        self.assertFalse(metrics.memory_enabled())
+
 
 if __name__ == '__main__':
     unittest.main()